@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Benchmark: added per-chunk latency of the Anthropic -> OpenAI stream translator
+
+Starts a local fake Anthropic upstream and the server in-process, then streams
+completions both directly from the fake upstream and through the server. Each
+upstream delta carries the time it was written, so the difference between the
+two runs is the latency the proxy adds per chunk.
+
+Usage:
+    python benchmarks/anthropic_stream.py [--requests 20] [--chunks 200] [--interval 0.002]
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_fake_anthropic(chunks, interval):
+    """Fake Anthropic /v1/messages endpoint that streams timestamped deltas"""
+
+    class FakeAnthropic(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def write_event(self, event, payload):
+            body = f"event: {event}\ndata: {json.dumps(payload)}\n\n".encode('utf-8')
+            self.wfile.write(f"{len(body):x}\r\n".encode('ascii') + body + b"\r\n")
+            self.wfile.flush()
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.write_event('message_start', {
+                "type": "message_start",
+                "message": {"id": "msg_bench", "usage": {"input_tokens": 10}}
+            })
+            for _ in range(chunks):
+                time.sleep(interval)
+                self.write_event('content_block_delta', {
+                    "type": "content_block_delta",
+                    "index": 0,
+                    "delta": {"type": "text_delta", "text": f"{time.perf_counter():.9f}"}
+                })
+            self.write_event('message_delta', {
+                "type": "message_delta",
+                "delta": {"stop_reason": "end_turn"},
+                "usage": {"output_tokens": chunks}
+            })
+            self.write_event('message_stop', {"type": "message_stop"})
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+    return FakeAnthropic
+
+
+def start_in_thread(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def measure(url, headers, body, extract):
+    """Stream one completion and return per-chunk delays in milliseconds"""
+    from server import iter_sse_events
+
+    delays = []
+    with requests.post(url, headers=headers, json=body, stream=True) as response:
+        for _, raw in iter_sse_events(response.iter_content(chunk_size=None)):
+            arrived = time.perf_counter()
+            if raw == '[DONE]':
+                break
+            sent = extract(json.loads(raw))
+            if sent is not None:
+                delays.append((arrived - float(sent)) * 1000)
+    return delays
+
+
+def direct_extract(payload):
+    if payload.get('type') == 'content_block_delta':
+        return payload['delta']['text']
+    return None
+
+
+def proxied_extract(payload):
+    content = payload.get('choices', [{}])[0].get('delta', {}).get('content')
+    return content or None
+
+
+def summarize(delays):
+    delays = sorted(delays)
+    return {
+        "chunks": len(delays),
+        "mean_ms": round(statistics.mean(delays), 4),
+        "p50_ms": round(delays[len(delays) // 2], 4),
+        "p95_ms": round(delays[int(len(delays) * 0.95)], 4),
+        "p99_ms": round(delays[int(len(delays) * 0.99)], 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--chunks', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=0.002)
+    args = parser.parse_args()
+
+    upstream = start_in_thread(ThreadingHTTPServer(
+        ('127.0.0.1', 0), make_fake_anthropic(args.chunks, args.interval)
+    ))
+    upstream_url = f"http://127.0.0.1:{upstream.server_address[1]}"
+
+    os.environ['ANTHROPIC_API_KEY'] = 'bench'
+    os.environ['ANTHROPIC_BASE_URL'] = upstream_url
+    import server
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    proxy = start_in_thread(make_server('127.0.0.1', 0, server.app, threaded=True))
+    proxy_url = f"http://127.0.0.1:{proxy.server_port}"
+
+    body = {
+        "model": "claude-3-5-sonnet-20241022",
+        "messages": [{"role": "user", "content": "bench"}],
+        "stream": True
+    }
+
+    direct, proxied = [], []
+    for _ in range(args.requests):
+        direct += measure(f"{upstream_url}/v1/messages", {}, body, direct_extract)
+        proxied += measure(
+            f"{proxy_url}/v1/chat/completions",
+            {"Authorization": f"Bearer {server.API_KEY}"},
+            body,
+            proxied_extract
+        )
+
+    direct_stats = summarize(direct)
+    proxied_stats = summarize(proxied)
+    print(json.dumps({
+        "direct": direct_stats,
+        "proxied": proxied_stats,
+        "added_p50_ms": round(proxied_stats["p50_ms"] - direct_stats["p50_ms"], 4),
+        "added_p95_ms": round(proxied_stats["p95_ms"] - direct_stats["p95_ms"], 4),
+    }, indent=2))
+
+    proxy.shutdown()
+    upstream.shutdown()
+
+
+if __name__ == '__main__':
+    main()
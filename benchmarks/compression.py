@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Benchmark: bytes saved vs. CPU spent per Content-Encoding
+
+For chat request bodies and completion bodies from 1 KB to 1 MB, reports
+for each available codec (gzip always; br and zstd when brotli/zstandard
+are installed) at the configured levels:
+
+- ratio and bytes_saved: encoded size against the plain JSON body
+- compress_us / decompress_us: mean CPU time per body
+- saved_per_ms: bytes saved per millisecond of compression, the trade-off
+  that decides whether a codec pays off on a given link
+
+Bodies under COMPRESSION_MIN_BYTES are sent uncompressed by the server;
+the smallest size shows why.
+
+Usage:
+    python benchmarks/compression.py [--sizes 1024,16384,131072,1048576] [--budget 0.3]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from json_codec import time_op
+
+# Word-level text: synthetic repeated strings would overstate every ratio
+WORDS = (
+    "the model request response token stream provider latency cache prompt "
+    "context window usage function tool call message assistant user system "
+    "json value error retry upstream client server header body chunk event "
+    "python flask proxy route table batch file limit rate key quota worker"
+).split()
+
+
+def make_text(rng, size):
+    """Roughly `size` bytes of space-separated words with some digits mixed in"""
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS) if rng.random() > 0.1 else str(rng.randrange(100000))
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)
+
+
+def make_bodies(size, seed=0):
+    """A chat request and an OpenAI completion body of about `size` bytes each"""
+    rng = random.Random(seed)
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    turn = 0
+    while sum(len(m["content"]) for m in messages) < size:
+        role = "user" if turn % 2 == 0 else "assistant"
+        messages.append({"role": role, "content": make_text(rng, min(2000, size))})
+        turn += 1
+    request_body = json.dumps({"model": "gpt-4", "messages": messages, "max_tokens": 1024}).encode('utf-8')
+    completion_body = json.dumps({
+        "id": "chatcmpl-bench",
+        "object": "chat.completion",
+        "created": 1700000000,
+        "model": "gpt-4",
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": make_text(rng, size)},
+            "finish_reason": "stop"
+        }],
+        "usage": {"prompt_tokens": 1200, "completion_tokens": size // 4, "total_tokens": 1200 + size // 4}
+    }).encode('utf-8')
+    return {"request": request_body, "completion": completion_body}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', default='1024,16384,131072,1048576')
+    parser.add_argument('--budget', type=float, default=0.3, help="seconds per measurement")
+    args = parser.parse_args()
+
+    import server
+    from server import COMPRESSION_CODECS, RESPONSE_ENCODINGS, REQUEST_MAX_DECOMPRESSED_BYTES
+
+    results = []
+    for size in [int(value) for value in args.sizes.split(',')]:
+        for kind, body in make_bodies(size).items():
+            row = {"kind": kind, "size_bytes": len(body)}
+            for encoding in RESPONSE_ENCODINGS:
+                compress, decompress = COMPRESSION_CODECS[encoding]
+                encoded = compress(body)
+                compress_us = time_op(lambda: compress(body), args.budget)
+                saved = len(body) - len(encoded)
+                row[encoding] = {
+                    "encoded_bytes": len(encoded),
+                    "ratio": round(len(body) / len(encoded), 2),
+                    "bytes_saved": saved,
+                    "compress_us": compress_us,
+                    "decompress_us": time_op(
+                        lambda: decompress(encoded, REQUEST_MAX_DECOMPRESSED_BYTES), args.budget
+                    ),
+                    "saved_per_ms": round(saved / (compress_us / 1000)),
+                }
+            results.append(row)
+
+    print(json.dumps({
+        "encodings": RESPONSE_ENCODINGS,
+        "levels": {
+            "gzip": server.COMPRESSION_GZIP_LEVEL,
+            "br": server.COMPRESSION_BROTLI_LEVEL,
+            "zstd": server.COMPRESSION_ZSTD_LEVEL,
+        },
+        "results": results,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
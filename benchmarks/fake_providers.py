@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Fake upstreams for the OpenAI, Anthropic, Gemini and xAI wire formats
+
+One local HTTP server answers all four APIs, so the proxy can be pointed at
+it with OPENAI_BASE_URL, ANTHROPIC_BASE_URL, GOOGLE_BASE_URL and XAI_BASE_URL:
+
+- POST /v1/chat/completions: OpenAI and xAI (chat.completion / SSE chunks)
+- POST /v1/messages: Anthropic (message / SSE events)
+- POST /v1beta/models/<model>:generateContent and
+  :streamGenerateContent?alt=sse: Gemini
+
+Every response waits `latency` seconds before its first token, then produces
+`tokens` tokens at `token_rate` tokens/s (0 = all at once), either streamed
+one token per event or as a single body. A fraction `error_rate` of requests
+fails with `error_status` instead, in the provider's own error format.
+
+Used by benchmarks/load_test.py; it can also be run on its own:
+    python benchmarks/fake_providers.py [--port 9000] [--latency 0.2] [--token-rate 50]
+        [--tokens 100] [--error-rate 0.01] [--error-status 500]
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+TOKEN = "tok "
+
+ERROR_TYPES = {429: "rate_limit_error", 500: "api_error", 503: "overloaded_error"}
+
+
+class FakeProviderServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # The proxy drops pooled connections when it retries or a client goes away
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeProviders:
+    """Settings shared by every request; may be changed while the server runs"""
+
+    def __init__(self, latency=0.0, token_rate=0.0, tokens=50, error_rate=0.0, error_status=500, seed=None):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.server = None
+
+    def should_fail(self):
+        with self.lock:
+            return self.error_rate > 0 and self.random.random() < self.error_rate
+
+    def token_times(self, started):
+        """Yield the time at which each token is due, without drift from sleep overshoot"""
+        first = started + self.latency
+        for i in range(self.tokens):
+            yield first + (i / self.token_rate if self.token_rate > 0 else 0)
+
+    def start(self, host='127.0.0.1', port=0):
+        """Serve in a background thread; returns the base URL"""
+        self.server = FakeProviderServer((host, port), make_handler(self))
+        threading.Thread(target=self.server.serve_forever, name='fake-providers', daemon=True).start()
+        return f"http://{host}:{self.server.server_address[1]}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def sleep_until(deadline):
+    delay = deadline - time.perf_counter()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def make_handler(config):
+    """Request handler class bound to a FakeProviders config"""
+
+    class FakeProviderHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            started = time.perf_counter()
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            path = urlsplit(self.path).path
+            if path == '/v1/chat/completions':
+                api = 'openai'
+                stream = bool(body.get('stream'))
+            elif path == '/v1/messages':
+                api = 'anthropic'
+                stream = bool(body.get('stream'))
+            elif path.startswith('/v1beta/models/'):
+                api = 'gemini'
+                stream = path.endswith(':streamGenerateContent')
+            else:
+                self.send_json(404, {"error": {"message": f"Unknown path {path}"}})
+                return
+
+            if config.should_fail():
+                sleep_until(started + config.latency)
+                self.send_error_body(api)
+                return
+
+            model = body.get('model') or path.rsplit('/', 1)[-1].split(':')[0]
+            if stream:
+                self.start_stream()
+                getattr(self, f'stream_{api}')(model, config.token_times(started))
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+            else:
+                times = list(config.token_times(started))
+                sleep_until(times[-1] if times else started + config.latency)
+                self.send_json(200, getattr(self, f'complete_{api}')(model, TOKEN * len(times)))
+
+        # Plumbing
+
+        def send_json(self, status, payload, headers=()):
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_error_body(self, api):
+            status = config.error_status
+            message = "Injected failure"
+            headers = [('Retry-After', '0')] if status == 429 else []
+            if api == 'anthropic':
+                payload = {"type": "error", "error": {"type": ERROR_TYPES.get(status, "api_error"), "message": message}}
+            elif api == 'gemini':
+                payload = {"error": {"code": status, "message": message, "status": "UNAVAILABLE"}}
+            else:
+                payload = {"error": {"message": message, "type": ERROR_TYPES.get(status, "server_error")}}
+            self.send_json(status, payload, headers)
+
+        def start_stream(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+
+        def write_chunk(self, data):
+            self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+            self.wfile.flush()
+
+        def write_data(self, payload, event=None):
+            prefix = f"event: {event}\n" if event else ""
+            self.write_chunk(f"{prefix}data: {json.dumps(payload)}\n\n".encode('utf-8'))
+
+        # OpenAI / xAI
+
+        def complete_openai(self, model, text):
+            return {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": config.tokens, "total_tokens": 10 + config.tokens},
+            }
+
+        def stream_openai(self, model, times):
+            frame = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+            for due in times:
+                sleep_until(due)
+                self.write_data(dict(frame, choices=[{"index": 0, "delta": {"content": TOKEN}, "finish_reason": None}]))
+            self.write_data(dict(
+                frame,
+                choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                usage={"prompt_tokens": 10, "completion_tokens": config.tokens, "total_tokens": 10 + config.tokens}
+            ))
+            self.write_chunk(b"data: [DONE]\n\n")
+
+        # Anthropic
+
+        def complete_anthropic(self, model, text):
+            return {
+                "id": "msg_fake",
+                "type": "message",
+                "role": "assistant",
+                "model": model,
+                "content": [{"type": "text", "text": text}],
+                "stop_reason": "end_turn",
+                "usage": {"input_tokens": 10, "output_tokens": config.tokens},
+            }
+
+        def stream_anthropic(self, model, times):
+            self.write_data({
+                "type": "message_start",
+                "message": {"id": "msg_fake", "type": "message", "role": "assistant", "model": model,
+                            "content": [], "usage": {"input_tokens": 10, "output_tokens": 1}}
+            }, 'message_start')
+            self.write_data({"type": "content_block_start", "index": 0,
+                             "content_block": {"type": "text", "text": ""}}, 'content_block_start')
+            for due in times:
+                sleep_until(due)
+                self.write_data({"type": "content_block_delta", "index": 0,
+                                 "delta": {"type": "text_delta", "text": TOKEN}}, 'content_block_delta')
+            self.write_data({"type": "content_block_stop", "index": 0}, 'content_block_stop')
+            self.write_data({"type": "message_delta", "delta": {"stop_reason": "end_turn"},
+                             "usage": {"output_tokens": config.tokens}}, 'message_delta')
+            self.write_data({"type": "message_stop"}, 'message_stop')
+
+        # Gemini
+
+        def usage_gemini(self):
+            return {"promptTokenCount": 10, "candidatesTokenCount": config.tokens, "totalTokenCount": 10 + config.tokens}
+
+        def complete_gemini(self, model, text):
+            return {
+                "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP", "index": 0}],
+                "usageMetadata": self.usage_gemini(),
+            }
+
+        def stream_gemini(self, model, times):
+            times = list(times)
+            for i, due in enumerate(times):
+                sleep_until(due)
+                candidate = {"content": {"parts": [{"text": TOKEN}], "role": "model"}, "index": 0}
+                payload = {"candidates": [candidate]}
+                if i == len(times) - 1:
+                    candidate["finishReason"] = "STOP"
+                    payload["usageMetadata"] = self.usage_gemini()
+                self.write_chunk(f"data: {json.dumps(payload)}\r\n\r\n".encode('utf-8'))
+
+    return FakeProviderHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds before the first token")
+    parser.add_argument('--token-rate', type=float, default=0.0, help="tokens per second (0 = all at once)")
+    parser.add_argument('--tokens', type=int, default=50, help="completion tokens per response")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument('--error-status', type=int, default=500)
+    args = parser.parse_args()
+
+    fakes = FakeProviders(args.latency, args.token_rate, args.tokens, args.error_rate, args.error_status)
+    url = fakes.start(args.host, args.port)
+    print(f"Fake providers on {url}")
+    for name in ('OPENAI', 'ANTHROPIC', 'GOOGLE', 'XAI'):
+        print(f"  {name}_BASE_URL={url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fakes.stop()
+
+
+if __name__ == '__main__':
+    main()
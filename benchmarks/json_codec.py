@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Benchmark: JSON encode/decode cost per backend over realistic payload sizes
+
+For chat requests whose messages arrays range from 1 KB to 2 MB, measures
+with each available backend (stdlib, orjson):
+
+- parse: decoding the request body (request.get_json())
+- encode: encoding the same object (jsonify())
+- fingerprint: the canonical hash used for caching and coalescing
+- roundtrip: decode + re-encode of a completion body of the same size
+  (the old non-streaming OpenAI/xAI path), next to relay, which extracts
+  only the usage block and returns the bytes unchanged (the current path)
+
+Usage:
+    python benchmarks/json_codec.py [--sizes 1024,16384,131072,1048576,2097152] [--budget 0.5]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_request(size):
+    """A chat request whose messages array encodes to roughly `size` bytes"""
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    turn = 0
+    encoded = 0
+    while encoded < size:
+        role = "user" if turn % 2 == 0 else "assistant"
+        content = f"Turn {turn}: " + "lorem ipsum dolor sit amet, été 你好 " * 8
+        messages.append({"role": role, "content": content})
+        encoded += len(json.dumps(messages[-1], ensure_ascii=False).encode('utf-8')) + 1
+        turn += 1
+    return {"model": "gpt-4", "messages": messages, "temperature": 0, "max_tokens": 1024}
+
+
+def make_completion(size):
+    """An OpenAI completion body of roughly `size` bytes, as an upstream sends it"""
+    text = "The quick brown fox jumps over the lazy dog. " * (size // 45 + 1)
+    return json.dumps({
+        "id": "chatcmpl-bench",
+        "object": "chat.completion",
+        "created": 1700000000,
+        "model": "gpt-4",
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": text[:size]},
+            "finish_reason": "stop"
+        }],
+        "usage": {"prompt_tokens": 1200, "completion_tokens": size // 4, "total_tokens": 1200 + size // 4}
+    }, indent=2).encode('utf-8')
+
+
+def time_op(fn, budget):
+    """Mean microseconds per call, repeating for about `budget` seconds"""
+    fn()
+    runs = 0
+    started = time.perf_counter()
+    while True:
+        fn()
+        runs += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= budget and runs >= 3:
+            return round(elapsed / runs * 1e6, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', default='1024,16384,131072,1048576,2097152')
+    parser.add_argument('--budget', type=float, default=0.5, help="seconds per measurement")
+    args = parser.parse_args()
+
+    import server
+    from server import load_json_backend, extract_usage
+
+    backends = {}
+    for name in ('stdlib', 'orjson'):
+        loaded = load_json_backend(name)
+        if loaded[0] == name:
+            backends[name] = loaded
+
+    results = []
+    for size in [int(value) for value in args.sizes.split(',')]:
+        request_obj = make_request(size)
+        completion = make_completion(size)
+        row = {"size_bytes": size, "completion_bytes": len(completion)}
+        for name, (_, dumps, loads) in backends.items():
+            body = dumps(request_obj)
+            row[name] = {
+                "parse_us": time_op(lambda: loads(body), args.budget),
+                "encode_us": time_op(lambda: dumps(request_obj, sort_keys=True), args.budget),
+                "fingerprint_us": time_op(
+                    lambda: server.hashlib.sha256(dumps(request_obj, sort_keys=True)).hexdigest(),
+                    args.budget
+                ),
+                "roundtrip_us": time_op(lambda: dumps(loads(completion), sort_keys=True), args.budget),
+            }
+        row["relay_us"] = time_op(lambda: extract_usage(completion), args.budget)
+        results.append(row)
+
+    print(json.dumps({"backends": list(backends), "results": results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+Load test: throughput, latency and server cost of /v1/chat/completions
+
+Starts the fake upstreams from benchmarks/fake_providers.py and the server in
+a subprocess pointed at them, then for each provider (openai, anthropic,
+google, xai) and mode (stream, nonstream) keeps --concurrency requests in
+flight for --duration seconds and reports:
+
+- rps and error counts by status
+- latency_ms: full response time (p50/p95/p99/mean) of successful requests
+- ttft_ms: time to the first content token of streamed responses
+- server: CPU seconds, CPU ms per request and peak RSS of the server process
+  tree (all workers with --workers; Linux only)
+
+The results are JSON. Save them with --output and pass an earlier file to
+--compare to print the change per scenario, e.g. between two commits.
+With --url an already running server is driven instead (no fake upstreams
+are started and server CPU/RSS is only reported with --server-pid).
+
+Usage:
+    python benchmarks/load_test.py [--concurrency 16] [--duration 10] [--providers openai,anthropic]
+        [--modes stream,nonstream] [--latency 0.05] [--token-rate 200] [--tokens 50]
+        [--error-rate 0] [--workers 1] [--async] [--output results.json] [--compare baseline.json]
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_providers import FakeProviders
+from passthrough_stream import ROOT, free_port, process_cpu_seconds, wait_for_port
+
+# A model the default routing table sends to each provider
+PROVIDER_MODELS = {
+    'openai': 'gpt-4',
+    'anthropic': 'claude-3-5-sonnet-20241022',
+    'google': 'gemini-1.5-flash',
+    'xai': 'grok-beta',
+}
+
+# A non-empty "content" value in an OpenAI chunk frame
+FIRST_TOKEN = re.compile(rb'"content":\s*"[^"]')
+
+
+def process_tree(pid):
+    """pid and all of its descendants (Linux /proc)"""
+    pids = [pid]
+    for current in pids:
+        try:
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def process_rss_bytes(pid):
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class ServerMonitor:
+    """Samples CPU time and RSS of a server's process tree while a scenario runs"""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.cpu = {}
+        self.rss_peak = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        rss = 0
+        for pid in process_tree(self.pid):
+            cpu = process_cpu_seconds(pid)
+            if cpu is not None:
+                # Keep the last value of workers that exit during the run
+                self.cpu[pid] = cpu
+            rss += process_rss_bytes(pid) or 0
+        self.rss_peak = max(self.rss_peak, rss)
+
+    def start(self):
+        self.sample()
+        self.baseline = dict(self.cpu)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+        cpu = sum(value - self.baseline.get(pid, 0) for pid, value in self.cpu.items())
+        return cpu, self.rss_peak
+
+
+def percentiles(values):
+    """p50/p95/p99/mean in milliseconds (nearest rank)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, max(0, int(round(p * len(ordered))) - 1))]
+
+    return {
+        "p50": round(rank(0.50) * 1000, 2),
+        "p95": round(rank(0.95) * 1000, 2),
+        "p99": round(rank(0.99) * 1000, 2),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 2),
+    }
+
+
+def one_request(session, url, headers, body, stream):
+    """Send one completion; returns (status, latency, ttft) with ttft None for non-streams"""
+    started = time.perf_counter()
+    ttft = None
+    with session.post(url, headers=headers, json=body, stream=stream, timeout=300) as response:
+        if stream and response.status_code == 200:
+            tail = b''
+            for chunk in response.raw.stream(65536, decode_content=True):
+                if ttft is None:
+                    if FIRST_TOKEN.search(tail + chunk):
+                        ttft = time.perf_counter() - started
+                    tail = chunk[-32:]
+        else:
+            response.content
+        return response.status_code, time.perf_counter() - started, ttft
+
+
+def run_scenario(url, api_key, provider, stream, concurrency, duration, prompt):
+    """Keep `concurrency` requests in flight for `duration` seconds"""
+    headers = {"Authorization": f"Bearer {api_key}"}
+    body = {
+        "model": PROVIDER_MODELS[provider],
+        "messages": [{"role": "user", "content": prompt}],
+        "stream": stream,
+    }
+    latencies = []
+    ttfts = []
+    errors = {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client():
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            try:
+                status, latency, ttft = one_request(session, url, headers, body, stream)
+            except requests.RequestException as e:
+                status, latency, ttft = type(e).__name__, None, None
+            with lock:
+                if status == 200:
+                    latencies.append(latency)
+                    if ttft is not None:
+                        ttfts.append(ttft)
+                else:
+                    errors[str(status)] = errors.get(str(status), 0) + 1
+        session.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    total = len(latencies) + sum(errors.values())
+    return {
+        "provider": provider,
+        "mode": "stream" if stream else "nonstream",
+        "requests": total,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "rps": round(total / elapsed, 1),
+        "latency_ms": percentiles(latencies),
+        "ttft_ms": percentiles(ttfts) if stream else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def change(old, new):
+    if old in (None, 0) or new is None:
+        return "n/a"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def compare(baseline, current):
+    """Print the change of the headline numbers for every scenario in both runs"""
+    previous = {(s["provider"], s["mode"]): s for s in baseline["scenarios"]}
+    print(f"Compared with {baseline.get('commit') or 'baseline'}:", file=sys.stderr)
+    for scenario in current["scenarios"]:
+        old = previous.get((scenario["provider"], scenario["mode"]))
+        if old is None:
+            continue
+        fields = [
+            ("rps", old["rps"], scenario["rps"]),
+            ("p50", (old["latency_ms"] or {}).get("p50"), (scenario["latency_ms"] or {}).get("p50")),
+            ("p99", (old["latency_ms"] or {}).get("p99"), (scenario["latency_ms"] or {}).get("p99")),
+        ]
+        if scenario["ttft_ms"]:
+            fields.append(("ttft p50", (old["ttft_ms"] or {}).get("p50"), scenario["ttft_ms"]["p50"]))
+        if scenario.get("server") and old.get("server"):
+            fields.append(("cpu/req", old["server"]["cpu_ms_per_request"], scenario["server"]["cpu_ms_per_request"]))
+        summary = ', '.join(f"{name} {change(a, b)}" for name, a, b in fields)
+        print(f"  {scenario['provider']:9} {scenario['mode']:9} {summary}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--providers', default='openai,anthropic,google,xai')
+    parser.add_argument('--modes', default='stream,nonstream')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10, help="seconds per scenario")
+    parser.add_argument('--warmup', type=float, default=1, help="seconds of unmeasured load per scenario")
+    parser.add_argument('--prompt-bytes', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05, help="fake upstream seconds to first token")
+    parser.add_argument('--token-rate', type=float, default=200, help="fake upstream tokens/s (0 = all at once)")
+    parser.add_argument('--tokens', type=int, default=50, help="completion tokens per fake response")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of fake upstream failures")
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--workers', default='1', help="server --workers")
+    parser.add_argument('--async', dest='use_async', action='store_true', help="run the server with --async")
+    parser.add_argument('--url', help="drive an already running server instead (its base URL)")
+    parser.add_argument('--api-key', default='bench')
+    parser.add_argument('--server-pid', type=int, help="with --url: PID to report CPU/RSS for")
+    parser.add_argument('--output', help="also write the JSON results to this file")
+    parser.add_argument('--compare', help="earlier JSON results to compare against")
+    args = parser.parse_args()
+
+    providers = [p.strip() for p in args.providers.split(',') if p.strip()]
+    modes = [m.strip() for m in args.modes.split(',') if m.strip()]
+    prompt = ("bench " * (args.prompt_bytes // 6 + 1))[:args.prompt_bytes]
+
+    fakes = None
+    proxy = None
+    server_pid = args.server_pid
+    base_url = args.url
+    batch_dir = None
+    if base_url is None:
+        fakes = FakeProviders(args.latency, args.token_rate, args.tokens, args.error_rate, args.error_status)
+        upstream_url = fakes.start()
+        port = free_port()
+        batch_dir = tempfile.TemporaryDirectory()
+        env = dict(
+            os.environ,
+            PORT=str(port),
+            HOST='127.0.0.1',
+            API_KEY=args.api_key,
+            OPENAI_API_KEY='bench',
+            ANTHROPIC_API_KEY='bench',
+            GOOGLE_API_KEY='bench',
+            XAI_API_KEY='bench',
+            OPENAI_BASE_URL=upstream_url,
+            ANTHROPIC_BASE_URL=upstream_url,
+            GOOGLE_BASE_URL=upstream_url,
+            XAI_BASE_URL=upstream_url,
+            RESPONSE_CACHE_ENABLED='false',
+            REQUEST_COALESCING='false',
+            RATE_LIMIT_RPM='0',
+            RATE_LIMIT_TPM='0',
+            RATE_LIMIT_MAX_STREAMS='0',
+            BATCH_DIR=batch_dir.name,
+        )
+        command = [sys.executable, os.path.join(ROOT, 'server.py'), '--workers', args.workers]
+        if args.use_async:
+            command.append('--async')
+        proxy = subprocess.Popen(command, env=env, cwd=batch_dir.name,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        server_pid = proxy.pid
+        base_url = f"http://127.0.0.1:{port}"
+
+    try:
+        if proxy is not None:
+            wait_for_port(int(base_url.rsplit(':', 1)[1]))
+        url = f"{base_url.rstrip('/')}/v1/chat/completions"
+        scenarios = []
+        for provider in providers:
+            for mode in modes:
+                stream = mode == 'stream'
+                if args.warmup > 0:
+                    run_scenario(url, args.api_key, provider, stream, args.concurrency, args.warmup, prompt)
+                monitor = ServerMonitor(server_pid) if server_pid else None
+                if monitor is not None:
+                    monitor.start()
+                result = run_scenario(url, args.api_key, provider, stream, args.concurrency, args.duration, prompt)
+                if monitor is not None:
+                    cpu, rss_peak = monitor.stop()
+                    result["server"] = {
+                        "cpu_seconds": round(cpu, 3),
+                        "cpu_ms_per_request": round(cpu / max(result["requests"], 1) * 1000, 3),
+                        "rss_peak_mb": round(rss_peak / 2**20, 1),
+                    }
+                scenarios.append(result)
+                print(f"{provider:9} {mode:9} {result['rps']:8.1f} rps  p50 "
+                      f"{(result['latency_ms'] or {}).get('p50')} ms  errors {result['errors']}", file=sys.stderr)
+
+        results = {
+            "commit": git_commit(),
+            "config": {
+                "concurrency": args.concurrency,
+                "duration": args.duration,
+                "prompt_bytes": args.prompt_bytes,
+                "upstream": None if fakes is None else {
+                    "latency": args.latency,
+                    "token_rate": args.token_rate,
+                    "tokens": args.tokens,
+                    "error_rate": args.error_rate,
+                    "error_status": args.error_status,
+                },
+                "workers": args.workers if proxy is not None else None,
+                "async": args.use_async if proxy is not None else None,
+            },
+            "scenarios": scenarios,
+        }
+        output = json.dumps(results, indent=2)
+        print(output)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output + '\n')
+        if args.compare:
+            with open(args.compare) as f:
+                compare(json.load(f), results)
+    finally:
+        if proxy is not None:
+            proxy.terminate()
+            try:
+                proxy.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proxy.kill()
+        if fakes is not None:
+            fakes.stop()
+        if batch_dir is not None:
+            batch_dir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
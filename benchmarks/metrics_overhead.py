@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Benchmark: cost of the /metrics instrumentation in the request hot path
+
+Measures the raw cost of the metric primitives (counter increment and
+histogram observation) and the per-request overhead of the request hooks,
+by serving the same requests through the Flask app with metrics switched
+on and off.
+
+Usage:
+    python benchmarks/metrics_overhead.py [--ops 200000] [--requests 5000]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def time_op(fn, ops):
+    started = time.perf_counter()
+    for _ in range(ops):
+        fn()
+    return (time.perf_counter() - started) / ops * 1e9
+
+
+def time_requests(client, headers, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        response = client.get('/v1/models', headers=headers)
+        response.close()
+    return (time.perf_counter() - started) / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--ops', type=int, default=200000)
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+
+    import server
+    from server import Metrics
+
+    registry = Metrics(enabled=True)
+    disabled = Metrics(enabled=False)
+    labels = (('provider', 'openai'), ('status', '200'))
+    primitives = {
+        "counter_inc_ns": round(time_op(lambda: registry.inc('bench_total', labels), args.ops), 1),
+        "histogram_observe_ns": round(time_op(lambda: registry.observe('bench_seconds', labels, 0.042), args.ops), 1),
+        "disabled_inc_ns": round(time_op(lambda: disabled.inc("bench_total", labels), args.ops), 1),
+    }
+
+    client = server.app.test_client()
+    headers = {"Authorization": f"Bearer {server.API_KEY}"}
+    time_requests(client, headers, 200)  # warm up
+
+    server.metrics.enabled = False
+    without = time_requests(client, headers, args.requests)
+    server.metrics.enabled = True
+    with_metrics = time_requests(client, headers, args.requests)
+
+    print(json.dumps({
+        "primitives": primitives,
+        "request_us_without_metrics": round(without, 2),
+        "request_us_with_metrics": round(with_metrics, 2),
+        "overhead_us_per_request": round(with_metrics - without, 2),
+        "overhead_percent": round((with_metrics - without) / without * 100, 2),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
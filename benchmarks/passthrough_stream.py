@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Benchmark: throughput and CPU cost of streaming passthrough for OpenAI-compatible providers
+
+Starts a local fake SSE upstream that streams chat.completion.chunk frames as
+fast as it can, runs the server in a subprocess pointed at it, and streams
+completions both directly from the fake upstream and through the server.
+Reports MB/s, chunks/s and the server process's CPU time per stream.
+
+Usage:
+    python benchmarks/passthrough_stream.py [--streams 20] [--frames 5000] [--frame-size 200]
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_fake_openai(frames, frame_size):
+    """Fake OpenAI /v1/chat/completions endpoint streaming fixed-size frames"""
+    content = 'x' * max(frame_size - 120, 1)
+    frame = ('data: ' + json.dumps({
+        "id": "chatcmpl-bench",
+        "object": "chat.completion.chunk",
+        "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+    }) + '\n\n').encode('utf-8')
+    encoded = f"{len(frame):x}\r\n".encode('ascii') + frame + b"\r\n"
+    done = b'data: [DONE]\n\n'
+
+    class FakeOpenAI(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for _ in range(frames):
+                self.wfile.write(encoded)
+            self.wfile.write(f"{len(done):x}\r\n".encode('ascii') + done + b"\r\n0\r\n\r\n")
+            self.wfile.flush()
+
+    return FakeOpenAI, len(frame)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def process_cpu_seconds(pid):
+    """utime + stime of a process from /proc (Linux only)"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def wait_for_port(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+def run_streams(url, headers, body, streams):
+    """Stream sequentially; return (seconds, bytes received)"""
+    received = 0
+    started = time.perf_counter()
+    for _ in range(streams):
+        with requests.post(url, headers=headers, json=body, stream=True) as response:
+            for chunk in response.raw.stream(65536, decode_content=False):
+                received += len(chunk)
+    return time.perf_counter() - started, received
+
+
+def summarize(seconds, received, frames_total, streams, cpu=None):
+    result = {
+        "seconds": round(seconds, 3),
+        "mb_per_s": round(received / seconds / 1e6, 2),
+        "chunks_per_s": round(frames_total / seconds),
+    }
+    if cpu is not None:
+        result["server_cpu_ms_per_stream"] = round(cpu / streams * 1000, 2)
+        result["server_cpu_us_per_chunk"] = round(cpu / frames_total * 1e6, 3)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--streams', type=int, default=20)
+    parser.add_argument('--frames', type=int, default=5000)
+    parser.add_argument('--frame-size', type=int, default=200)
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="run the server with --async (requires gevent)")
+    args = parser.parse_args()
+
+    handler, frame_len = make_fake_openai(args.frames, args.frame_size)
+    upstream = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    upstream_url = f"http://127.0.0.1:{upstream.server_address[1]}"
+
+    port = free_port()
+    env = dict(
+        os.environ,
+        PORT=str(port),
+        HOST='127.0.0.1',
+        API_KEY='bench',
+        OPENAI_API_KEY='bench',
+        OPENAI_BASE_URL=upstream_url,
+        RESPONSE_CACHE_ENABLED='false',
+        REQUEST_COALESCING='false',
+    )
+    command = [sys.executable, os.path.join(ROOT, 'server.py')] + (['--async'] if args.use_async else [])
+    proxy = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        body = {"model": "gpt-4", "messages": [{"role": "user", "content": "bench"}], "stream": True}
+        frames_total = args.frames * args.streams
+
+        direct = run_streams(f"{upstream_url}/v1/chat/completions", {}, body, args.streams)
+
+        run_streams(f"http://127.0.0.1:{port}/v1/chat/completions",
+                    {"Authorization": "Bearer bench"}, body, 1)  # warm up
+        cpu_before = process_cpu_seconds(proxy.pid)
+        proxied = run_streams(f"http://127.0.0.1:{port}/v1/chat/completions",
+                              {"Authorization": "Bearer bench"}, body, args.streams)
+        cpu_after = process_cpu_seconds(proxy.pid)
+        cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+
+        print(json.dumps({
+            "streams": args.streams,
+            "frames_per_stream": args.frames,
+            "frame_bytes": frame_len,
+            "direct": summarize(*direct, frames_total, args.streams),
+            "proxied": summarize(*proxied, frames_total, args.streams, cpu),
+        }, indent=2))
+    finally:
+        proxy.terminate()
+        proxy.wait()
+        upstream.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Benchmark: cold start, from launching the server to serving requests
+
+Starts the server as a fresh process several times against the fake
+upstreams and measures from the moment the process is spawned:
+
+- listening_ms: the port accepts connections
+- first_response_ms: GET /v1/models has returned 200
+- first_completion_ms: latency of the first chat completion, sent right
+  after the first response (or after --idle seconds)
+- warm_completion_ms: latency of a second completion, for comparison
+
+plus import_ms, the time `import server` takes in a fresh interpreter.
+Each launch style is measured: `python server.py` compiles the source on
+every start, `python -m server` loads the cached bytecode.
+
+Usage:
+    python benchmarks/startup.py [--runs 10] [--launch script,module] [--prewarm] [--async]
+        [--idle 0] [--env KEY=VALUE ...]
+"""
+
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_providers import FakeProviders
+from passthrough_stream import ROOT, free_port
+
+API_KEY = 'bench'
+COMPLETION = json.dumps({
+    "model": "gpt-4",
+    "messages": [{"role": "user", "content": "Hello"}],
+}).encode('utf-8')
+
+
+def request(port, method, path, body=None, timeout=30):
+    """Status of one request to the server, or None if it is not accepting yet"""
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        connection.request(method, path, body=body, headers={
+            'Authorization': f'Bearer {API_KEY}',
+            'Content-Type': 'application/json',
+        })
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    except OSError:
+        return None
+    finally:
+        connection.close()
+
+
+def timed_completion(port):
+    started = time.perf_counter()
+    status = request(port, 'POST', '/v1/chat/completions', COMPLETION)
+    if status != 200:
+        raise RuntimeError(f"completion failed with status {status}")
+    return (time.perf_counter() - started) * 1000
+
+
+def poll(check, started, timeout=30):
+    """Milliseconds from `started` until check() is true"""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if check():
+            return (time.perf_counter() - started) * 1000
+        time.sleep(0.002)
+    raise RuntimeError("server did not start")
+
+
+def listening(port):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+    try:
+        connection.connect()
+        return True
+    except OSError:
+        return False
+    finally:
+        connection.close()
+
+
+def launch_once(command, env, cwd, idle):
+    port = free_port()
+    env = dict(env, PORT=str(port))
+    started = time.perf_counter()
+    proc = subprocess.Popen(command, env=env, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        result = {
+            "listening_ms": poll(lambda: listening(port), started),
+            "first_response_ms": poll(lambda: request(port, 'GET', '/v1/models') == 200, started),
+        }
+        time.sleep(idle)
+        result["first_completion_ms"] = timed_completion(port)
+        result["warm_completion_ms"] = timed_completion(port)
+        return result
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def import_ms(env, cwd):
+    code = "import time; started = time.perf_counter(); import server; print((time.perf_counter() - started) * 1000)"
+    output = subprocess.run([sys.executable, '-c', code], env=env, cwd=cwd, capture_output=True, text=True, check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def summarize(samples):
+    return {
+        name: {
+            "median": round(statistics.median(sample[name] for sample in samples), 1),
+            "min": round(min(sample[name] for sample in samples), 1),
+        }
+        for name in samples[0]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--launch', default='script,module', help="script (python server.py), module (python -m server)")
+    parser.add_argument('--prewarm', action='store_true', help="start the server with UPSTREAM_PREWARM=true")
+    parser.add_argument('--async', dest='use_async', action='store_true', help="run the server with --async")
+    parser.add_argument('--idle', type=float, default=0.0, help="seconds between the first response and the first completion")
+    parser.add_argument('--env', action='append', default=[], help="extra server environment, KEY=VALUE")
+    args = parser.parse_args()
+
+    fakes = FakeProviders(tokens=10)
+    upstream_url = fakes.start()
+    workdir = tempfile.TemporaryDirectory()
+    env = dict(
+        os.environ,
+        PYTHONPATH=ROOT,
+        HOST='127.0.0.1',
+        API_KEY=API_KEY,
+        OPENAI_API_KEY='bench',
+        OPENAI_BASE_URL=upstream_url,
+        RESPONSE_CACHE_ENABLED='false',
+        BATCH_DIR=os.path.join(workdir.name, 'batches'),
+        UPSTREAM_PREWARM='true' if args.prewarm else 'false',
+    )
+    for item in args.env:
+        key, _, value = item.partition('=')
+        env[key] = value
+    # Make sure the bytecode cache exists, as it would after any earlier start
+    subprocess.run([sys.executable, '-m', 'compileall', '-q', os.path.join(ROOT, 'server.py')], check=True)
+
+    commands = {
+        "script": [sys.executable, os.path.join(ROOT, 'server.py')],
+        "module": [sys.executable, '-m', 'server'],
+    }
+    results = {}
+    try:
+        for launch in [name.strip() for name in args.launch.split(',') if name.strip()]:
+            command = commands[launch] + (['--async'] if args.use_async else [])
+            samples = [launch_once(command, env, workdir.name, args.idle) for _ in range(args.runs)]
+            results[launch] = summarize(samples)
+        imports = [import_ms(env, workdir.name) for _ in range(args.runs)]
+    finally:
+        fakes.stop()
+        workdir.cleanup()
+
+    print(json.dumps({
+        "config": {"runs": args.runs, "prewarm": args.prewarm, "async": args.use_async, "idle": args.idle},
+        "import_ms": {"median": round(statistics.median(imports), 1), "min": round(min(imports), 1)},
+        "launch": results,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Benchmark: peak memory of non-streaming Claude/Gemini completions, buffered vs assembled from a stream
+
+For completions of 1k to 50k tokens, serves non-streaming requests through
+the Flask app against the fake upstreams (run in a separate process so that
+their allocations are not counted) in both modes:
+
+- buffered: the upstream JSON body is read whole, parsed and rebuilt
+- assembled: the completion is streamed from upstream and assembled
+  (UPSTREAM_STREAM_ASSEMBLY=true)
+
+Reports the peak Python heap allocated while serving one request
+(tracemalloc), relative to the completion text size, and the mean time per
+request without tracing. The request time includes the fake upstream
+writing every token as its own HTTP chunk; assemble_ms isolates the
+server's own work, parsing a recorded upstream stream (read in
+UPSTREAM_STREAM_READ_SIZE pieces) into a completion.
+
+Usage:
+    python benchmarks/stream_assembly.py [--tokens 1000,10000,50000] [--requests 5]
+"""
+
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_providers import TOKEN
+from passthrough_stream import ROOT, free_port, wait_for_port
+
+MODELS = {"anthropic": "claude-3-5-sonnet-20241022", "google": "gemini-1.5-pro"}
+
+
+def serve(client, model):
+    response = client.post(
+        '/v1/chat/completions',
+        json={"model": model, "messages": [{"role": "user", "content": "Write a long story."}]},
+        headers={"Authorization": "Bearer bench"}
+    )
+    body = response.get_data()
+    response.close()
+    if response.status_code != 200:
+        raise RuntimeError(f"{model}: status {response.status_code}: {body[:200]!r}")
+    return body
+
+
+def peak_bytes(client, model):
+    """Peak traced heap while serving one request, above what was allocated before it"""
+    serve(client, model)  # warm up connections and caches
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    serve(client, model)
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return peak
+
+
+def record_stream(port, provider, model):
+    """The raw upstream event stream of one streamed completion"""
+    if provider == 'anthropic':
+        path = '/v1/messages'
+        body = {"model": model, "stream": True, "messages": [{"role": "user", "content": "hi"}]}
+    else:
+        path = f'/v1beta/models/{model}:streamGenerateContent?alt=sse'
+        body = {"contents": [{"role": "user", "parts": [{"text": "hi"}]}]}
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        connection.request('POST', path, body=json.dumps(body), headers={'Content-Type': 'application/json'})
+        return connection.getresponse().read()
+    finally:
+        connection.close()
+
+
+def assemble_ms(server, provider, model, raw, requests):
+    size = server.UPSTREAM_STREAM_READ_SIZE
+    chunks = [raw[i:i + size] for i in range(0, len(raw), size)]
+    started = time.perf_counter()
+    for _ in range(requests):
+        if provider == 'anthropic':
+            events = server.anthropic_completion_events(chunks)
+        else:
+            events = server.gemini_completion_events(chunks, model)
+        server.assemble_completion(events, model)
+    return (time.perf_counter() - started) / requests * 1000
+
+
+def mean_ms(client, model, requests):
+    started = time.perf_counter()
+    for _ in range(requests):
+        serve(client, model)
+    return (time.perf_counter() - started) / requests * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--tokens', default='1000,10000,50000', help="completion tokens per response")
+    parser.add_argument('--requests', type=int, default=5, help="requests per timing")
+    args = parser.parse_args()
+
+    port = free_port()
+    upstream_url = f"http://127.0.0.1:{port}"
+    os.environ.update(
+        API_KEY='bench',
+        ANTHROPIC_API_KEY='bench',
+        GOOGLE_API_KEY='bench',
+        ANTHROPIC_BASE_URL=upstream_url,
+        GOOGLE_BASE_URL=upstream_url,
+        RESPONSE_CACHE_ENABLED='false',
+        ANTHROPIC_PROMPT_CACHING='false',
+    )
+    sys.path.insert(0, ROOT)
+    import server
+
+    client = server.app.test_client()
+    results = []
+    for tokens in [int(value) for value in args.tokens.split(',')]:
+        fakes = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_providers.py'),
+             '--port', str(port), '--tokens', str(tokens)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            wait_for_port(port)
+            text_bytes = len(TOKEN) * tokens
+            for provider, model in MODELS.items():
+                row = {"provider": provider, "tokens": tokens, "text_kb": round(text_bytes / 1024, 1)}
+                for mode, assembled in (("buffered", False), ("assembled", True)):
+                    server.UPSTREAM_STREAM_ASSEMBLY = assembled
+                    peak = peak_bytes(client, model)
+                    row[mode] = {
+                        "peak_kb": round(peak / 1024, 1),
+                        "peak_per_text_byte": round(peak / text_bytes, 2),
+                        "ms_per_request": round(mean_ms(client, model, args.requests), 2),
+                    }
+                row["peak_reduction_percent"] = round(
+                    (1 - row["assembled"]["peak_kb"] / row["buffered"]["peak_kb"]) * 100, 1
+                )
+                raw = record_stream(port, provider, model)
+                row["assembled"]["assemble_ms"] = round(assemble_ms(server, provider, model, raw, args.requests), 2)
+                results.append(row)
+                print(f"{provider:9} {tokens:6} tokens: buffered {row['buffered']['peak_kb']} KB, "
+                      f"assembled {row['assembled']['peak_kb']} KB", file=sys.stderr)
+        finally:
+            fakes.terminate()
+            fakes.wait()
+            # The next fake upstream reuses the port: drop pooled connections to this one
+            for pool in server._upstream_pools.values():
+                pool.session.close()
+            server._upstream_pools.clear()
+
+    print(json.dumps({"results": results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
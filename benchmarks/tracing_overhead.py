@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Benchmark: per-request cost of request IDs and tracing
+
+Serves the same authenticated requests through the Flask app under each
+tracing setup and reports the mean time per request:
+
+- off: sampling and Server-Timing off (only the X-Request-ID header)
+- propagate: off, but the client sends a traceparent, which is kept for upstreams
+- server_timing: spans recorded for the Server-Timing header, nothing exported
+- sampled_file: every request sampled and written to an OTLP/JSON file
+
+Usage:
+    python benchmarks/tracing_overhead.py [--requests 5000]
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TRACEPARENT = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-00"
+
+
+def time_requests(client, headers, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        response = client.get('/v1/models', headers=headers)
+        response.close()
+    return (time.perf_counter() - started) / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+
+    import server
+    from server import FileSpanExporter
+
+    client = server.app.test_client()
+    headers = {"Authorization": f"Bearer {server.API_KEY}"}
+    tracer = server.tracer
+    time_requests(client, headers, 200)  # warm up
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        setups = {
+            "off": (0, [], False, headers),
+            "propagate": (0, [], False, dict(headers, traceparent=TRACEPARENT)),
+            "server_timing": (0, [], True, headers),
+            "sampled_file": (1, [FileSpanExporter(os.path.join(tmp, 'traces.jsonl'))], False, headers),
+        }
+        for name, (rate, exporters, server_timing, request_headers) in setups.items():
+            tracer.sample_rate, tracer.exporters, tracer.server_timing = rate, exporters, server_timing
+            results[name] = round(time_requests(client, request_headers, args.requests), 2)
+
+    baseline = results["off"]
+    print(json.dumps({
+        "request_us": results,
+        "overhead_us_per_request": {
+            name: round(value - baseline, 2) for name, value in results.items() if name != "off"
+        },
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,83 @@ OpenAI-Compatible Web Server
 Hosts an API with OpenAI-compatible endpoints
 """
 
+import sys
+
+# Async serving mode: cooperative sockets must be patched before anything
+# else (requests, threading, ssl) is imported
+if __name__ == '__main__' and '--async' in sys.argv:
+    try:
+        from gevent import monkey
+        monkey.patch_all()
+    except ImportError:
+        sys.exit("--async requires gevent. Install it with: pip install gevent")
+
 import os
-from flask import Flask, request, jsonify, render_template, Response, stream_with_context
+import argparse
+import signal
+import socket
+from flask import Flask, request, jsonify, render_template, Response, g, has_request_context, send_file
+from flask.json.provider import DefaultJSONProvider
 from functools import wraps
 from dotenv import load_dotenv
 import time
-import requests
+import threading
+import hashlib
+import sqlite3
+import random
+import bisect
+import uuid
+import contextlib
+import importlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import OrderedDict, deque
 import json
+import mimetypes
+import gzip
+import io
+import zlib
+from werkzeug.wsgi import get_input_stream, ClosingIterator
+
+try:
+    import brotli
+except ImportError:  # br is offered only when brotli is installed
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # zstd is offered only when zstandard is installed
+    zstandard = None
+
+
+class LazyModule:
+    """
+    A module that is imported on first attribute access. requests and
+    urllib3 (about a quarter of the import time) are only needed once an
+    upstream is called, so they stay out of startup.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+
+requests = LazyModule('requests')
+urllib3 = LazyModule('urllib3')
+
+try:
+    import fcntl
+except ImportError:  # Windows: batches are not locked across processes
+    fcntl = None
+
+# The environment before .env is applied; a reloading master re-executes
+# with it so that changed .env values take effect
+STARTUP_ENVIRON = dict(os.environ)
 
 # Load environment variables
 load_dotenv()
@@ -22,12 +92,129 @@ CUSTOM_ENDPOINT_URL = os.getenv('CUSTOM_ENDPOINT_URL', '')
 PORT = int(os.getenv('PORT', 5000))
 HOST = os.getenv('HOST', '0.0.0.0')
 
+def parse_list(value):
+    """Split a comma-separated setting into a list of non-empty values"""
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+
+# Client API keys: API_KEY may hold several comma-separated keys
+CLIENT_API_KEYS = set(parse_list(API_KEY))
+
+# Per-key rate limits (0 = unlimited), overridable per key in API_KEYS_FILE
+RATE_LIMIT_RPM = int(os.getenv('RATE_LIMIT_RPM', 0))
+RATE_LIMIT_TPM = int(os.getenv('RATE_LIMIT_TPM', 0))
+RATE_LIMIT_MAX_STREAMS = int(os.getenv('RATE_LIMIT_MAX_STREAMS', 0))
+API_KEYS_FILE = os.getenv('API_KEYS_FILE', '')
+# SQLite file shared by worker processes; limits are per process when empty
+RATE_LIMIT_STORE = os.getenv('RATE_LIMIT_STORE', '')
+
+
 # Provider API Keys (configure these in .env for actual API access)
+# Each may hold several comma-separated keys to spread load across them
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
 ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY', '')
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY', '')
 XAI_API_KEY = os.getenv('XAI_API_KEY', '')
 
+# Provider base URLs (override to point at a proxy or a local stub upstream)
+# Several comma-separated endpoints may be given per provider
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com')
+ANTHROPIC_BASE_URL = os.getenv('ANTHROPIC_BASE_URL', 'https://api.anthropic.com')
+GOOGLE_BASE_URL = os.getenv('GOOGLE_BASE_URL', 'https://generativelanguage.googleapis.com')
+XAI_BASE_URL = os.getenv('XAI_BASE_URL', 'https://api.x.ai')
+
+# Upstream load balancing across keys/endpoints
+UPSTREAM_BALANCING = os.getenv('UPSTREAM_BALANCING', 'round_robin')  # or least_outstanding
+UPSTREAM_COOLDOWN = float(os.getenv('UPSTREAM_COOLDOWN', 30))
+
+# Upstream timeouts, retries and hedging
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', 5))
+UPSTREAM_READ_TIMEOUT = float(os.getenv('UPSTREAM_READ_TIMEOUT', 300))
+UPSTREAM_MAX_RETRIES = int(os.getenv('UPSTREAM_MAX_RETRIES', 2))
+UPSTREAM_RETRY_BACKOFF = float(os.getenv('UPSTREAM_RETRY_BACKOFF', 0.5))
+UPSTREAM_RETRY_BACKOFF_MAX = float(os.getenv('UPSTREAM_RETRY_BACKOFF_MAX', 8))
+UPSTREAM_HEDGING = os.getenv('UPSTREAM_HEDGING', 'false').lower() in ('1', 'true', 'yes')
+UPSTREAM_HEDGE_MIN_DELAY = float(os.getenv('UPSTREAM_HEDGE_MIN_DELAY', 1.0))
+# Fetch non-streaming Claude/Gemini completions as streams and assemble them here
+UPSTREAM_STREAM_ASSEMBLY = os.getenv('UPSTREAM_STREAM_ASSEMBLY', 'false').lower() in ('1', 'true', 'yes')
+
+# Upstream connection pool settings
+UPSTREAM_POOL_CONNECTIONS = int(os.getenv('UPSTREAM_POOL_CONNECTIONS', 4))
+UPSTREAM_POOL_MAXSIZE = int(os.getenv('UPSTREAM_POOL_MAXSIZE', 32))
+UPSTREAM_KEEP_ALIVE = os.getenv('UPSTREAM_KEEP_ALIVE', 'true').lower() in ('1', 'true', 'yes')
+# Connect to configured providers in the background once the server is listening
+UPSTREAM_PREWARM = os.getenv('UPSTREAM_PREWARM', 'false').lower() in ('1', 'true', 'yes')
+
+# Background provider status prober for the access panel
+PROVIDER_STATUS_INTERVAL = float(os.getenv('PROVIDER_STATUS_INTERVAL', 60))
+PROVIDER_STATUS_TIMEOUT = float(os.getenv('PROVIDER_STATUS_TIMEOUT', 5))
+PROVIDER_STATUS_KEEPALIVE = float(os.getenv('PROVIDER_STATUS_KEEPALIVE', 15))
+# Each status stream holds a thread on the threaded server; 0 = unlimited (always so with --async)
+PROVIDER_STATUS_MAX_SUBSCRIBERS = int(os.getenv('PROVIDER_STATUS_MAX_SUBSCRIBERS', 16))
+# ?refresh=1 re-checks a provider only if its cached result is at least this old
+PROVIDER_STATUS_REFRESH_MIN_AGE = float(os.getenv('PROVIDER_STATUS_REFRESH_MIN_AGE', 10))
+
+# Async serving mode (python server.py --async)
+ASYNC_MAX_CONNECTIONS = int(os.getenv('ASYNC_MAX_CONNECTIONS', 10000))
+
+# Prefork workers (python server.py --workers N); 'auto' = one per CPU core
+WORKERS = os.getenv('WORKERS', '1')
+WORKER_MAX_REQUESTS = int(os.getenv('WORKER_MAX_REQUESTS', 0))  # recycle a worker after this many requests (0 = never)
+WORKER_GRACEFUL_TIMEOUT = float(os.getenv('WORKER_GRACEFUL_TIMEOUT', 60))  # seconds to drain in-flight requests
+
+# Response cache for deterministic (temperature 0) chat completions
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 300))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 1024))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+RESPONSE_CACHE_DIR = os.getenv('RESPONSE_CACHE_DIR', '')
+
+# Request coalescing: identical in-flight completions share one upstream call
+REQUEST_COALESCING = os.getenv('REQUEST_COALESCING', 'false').lower() in ('1', 'true', 'yes')
+
+# Prometheus-style metrics at /metrics
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+# Request tracing: spans exported as OTLP/JSON, optional Server-Timing header
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0))  # new traces; sampled parents are always followed
+TRACE_FILE = os.getenv('TRACE_FILE', '')  # append one OTLP/JSON line per trace
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT', '')  # e.g. http://localhost:4318/v1/traces
+TRACE_SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'openai-compatible-server')
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'false').lower() in ('1', 'true', 'yes')
+
+# JSON backend: 'orjson' (used when installed) or 'stdlib'
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'orjson').lower()
+
+# HTTP compression: gzip always; br and zstd when brotli/zstandard are installed
+COMPRESSION_ENABLED = os.getenv('COMPRESSION_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+COMPRESSION_ENCODINGS = os.getenv('COMPRESSION_ENCODINGS', 'zstd,br,gzip')  # server preference order
+COMPRESSION_MIN_BYTES = int(os.getenv('COMPRESSION_MIN_BYTES', 1024))
+COMPRESSION_GZIP_LEVEL = int(os.getenv('COMPRESSION_GZIP_LEVEL', 6))
+COMPRESSION_BROTLI_LEVEL = int(os.getenv('COMPRESSION_BROTLI_LEVEL', 4))
+COMPRESSION_ZSTD_LEVEL = int(os.getenv('COMPRESSION_ZSTD_LEVEL', 3))
+# Compressed request bodies may not expand beyond this (413 otherwise)
+REQUEST_MAX_DECOMPRESSED_BYTES = int(os.getenv('REQUEST_MAX_DECOMPRESSED_BYTES', 64 * 1024 * 1024))
+# Providers whose request bodies are sent gzip-compressed (they must accept Content-Encoding: gzip)
+UPSTREAM_REQUEST_COMPRESSION = os.getenv('UPSTREAM_REQUEST_COMPRESSION', '')
+
+# Prompt-size precheck against the model's context window
+TOKEN_PRECHECK = os.getenv('TOKEN_PRECHECK', 'true').lower() in ('1', 'true', 'yes')
+# Slack for estimated (non-tokenizer) counts before a request is rejected
+TOKEN_ESTIMATE_TOLERANCE = float(os.getenv('TOKEN_ESTIMATE_TOLERANCE', 0.1))
+
+# Automatic Anthropic prompt caching of repeated long prefixes
+ANTHROPIC_PROMPT_CACHING = os.getenv('ANTHROPIC_PROMPT_CACHING', 'true').lower() in ('1', 'true', 'yes')
+ANTHROPIC_PROMPT_CACHE_MIN_HITS = int(os.getenv('ANTHROPIC_PROMPT_CACHE_MIN_HITS', 2))
+ANTHROPIC_PROMPT_CACHE_MIN_TOKENS = int(os.getenv('ANTHROPIC_PROMPT_CACHE_MIN_TOKENS', 1024))
+
+# Batch jobs (/v1/files and /v1/batches)
+BATCH_DIR = os.getenv('BATCH_DIR', 'batches')
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 8))  # concurrent batch requests per provider
+
+# Model routing table (optional JSON file with extra models, prefixes and aliases)
+MODEL_ROUTES_FILE = os.getenv('MODEL_ROUTES_FILE', '')
+MODEL_ROUTES_RELOAD_INTERVAL = float(os.getenv('MODEL_ROUTES_RELOAD_INTERVAL', 5))
+
 # Sample models list - can be customized
 AVAILABLE_MODELS = [
     {
@@ -94,322 +281,4671 @@ AI_PROVIDERS = {
 }
 
 
-def require_api_key(f):
-    """Decorator to require API key authentication"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        # Check Authorization header
-        auth_header = request.headers.get('Authorization')
-        
-        if not auth_header:
-            return jsonify({
-                "error": {
-                    "message": "Missing Authorization header",
-                    "type": "invalid_request_error",
-                    "param": None,
-                    "code": "invalid_api_key"
-                }
-            }), 401
-        
-        # Expected format: "Bearer <API_KEY>"
-        if not auth_header.startswith('Bearer '):
-            return jsonify({
-                "error": {
-                    "message": "Invalid Authorization header format. Expected 'Bearer <API_KEY>'",
-                    "type": "invalid_request_error",
-                    "param": None,
-                    "code": "invalid_api_key"
-                }
-            }), 401
-        
-        provided_key = auth_header[7:]  # Remove "Bearer " prefix
-        
-        if provided_key != API_KEY:
-            return jsonify({
-                "error": {
-                    "message": "Invalid API key provided",
-                    "type": "invalid_request_error",
-                    "param": None,
-                    "code": "invalid_api_key"
-                }
-            }), 401
-        
-        return f(*args, **kwargs)
-    
-    return decorated_function
+def _stdlib_json_dumps(obj, sort_keys=False, default=None):
+    return json.dumps(
+        obj, sort_keys=sort_keys, default=default, separators=(',', ':'), ensure_ascii=False
+    ).encode('utf-8')
 
 
-@app.route('/')
-def index():
-    """Root endpoint - basic info"""
-    return jsonify({
-        "message": "OpenAI-Compatible Web Server",
-        "version": "1.0.0",
-        "endpoints": {
-            "models": "/v1/models",
-            "chat_completions": "/v1/chat/completions",
-            "access_panel": "/access"
+def load_json_backend(name):
+    """
+    Return (name, dumps, loads) for the configured JSON backend
+    dumps(obj, sort_keys=False, default=None) returns compact UTF-8 bytes
+    and loads() accepts bytes or str. orjson falls back to stdlib for
+    objects it cannot encode (non-string keys, out-of-range integers).
+    """
+    if name == 'orjson':
+        try:
+            import orjson
+        except ImportError:
+            pass
+        else:
+            def dumps(obj, sort_keys=False, default=None):
+                try:
+                    return orjson.dumps(obj, default=default, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+                except TypeError:
+                    return _stdlib_json_dumps(obj, sort_keys, default)
+
+            return 'orjson', dumps, orjson.loads
+    return 'stdlib', _stdlib_json_dumps, json.loads
+
+
+JSON_BACKEND_NAME, json_dumps, json_loads = load_json_backend(JSON_BACKEND)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """jsonify() and request.get_json() through the configured JSON backend"""
+
+    def dumps(self, obj, **kwargs):
+        return json_dumps(obj, self.sort_keys, self.default).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return json_loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            json_dumps(obj, self.sort_keys, self.default) + b'\n',
+            mimetype=self.mimetype
+        )
+
+
+app.json = FastJSONProvider(app)
+
+
+class DecompressedSizeExceeded(ValueError):
+    """A compressed request body expands beyond REQUEST_MAX_DECOMPRESSED_BYTES"""
+
+
+def _gzip_compress(data):
+    return gzip.compress(data, COMPRESSION_GZIP_LEVEL, mtime=0)
+
+
+def _gzip_decompress(data, limit):
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    body = decoder.decompress(data, limit + 1)
+    if len(body) > limit:
+        raise DecompressedSizeExceeded(limit)
+    if not decoder.eof:
+        raise ValueError("truncated gzip stream")
+    return body
+
+
+def _deflate_decompress(data, limit):
+    # 'deflate' is the zlib format, though some clients send raw deflate
+    wbits = zlib.MAX_WBITS if data[:1] == b'\x78' else -zlib.MAX_WBITS
+    decoder = zlib.decompressobj(wbits)
+    body = decoder.decompress(data, limit + 1)
+    if len(body) > limit:
+        raise DecompressedSizeExceeded(limit)
+    if not decoder.eof:
+        raise ValueError("truncated deflate stream")
+    return body
+
+
+def _brotli_compress(data):
+    return brotli.compress(data, quality=COMPRESSION_BROTLI_LEVEL)
+
+
+def _brotli_decompress(data, limit):
+    decoder = brotli.Decompressor()
+    try:
+        body = decoder.process(data, output_buffer_limit=limit + 1)
+    except TypeError:  # brotli < 1.2 cannot bound its output
+        body = decoder.process(data)
+    if len(body) > limit:
+        raise DecompressedSizeExceeded(limit)
+    if not decoder.is_finished():
+        raise ValueError("truncated brotli stream")
+    return body
+
+
+def _zstd_compress(data):
+    return zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL).compress(data)
+
+
+def _zstd_decompress(data, limit):
+    with zstandard.ZstdDecompressor().stream_reader(data, read_across_frames=True) as reader:
+        body = reader.read(limit + 1)
+    if len(body) > limit:
+        raise DecompressedSizeExceeded(limit)
+    # The reader stops quietly at the end of a truncated frame
+    declared = zstandard.get_frame_parameters(data).content_size
+    if declared != zstandard.CONTENTSIZE_UNKNOWN and len(body) < declared:
+        raise ValueError("truncated zstd stream")
+    return body
+
+
+def load_compression_codecs():
+    """
+    Return {encoding: (compress, decompress)} for every available codec
+    compress(data) returns bytes; decompress(data, limit) raises
+    DecompressedSizeExceeded once the output would pass `limit` bytes,
+    so a small compression bomb never expands in memory.
+    """
+    codecs = {'gzip': (_gzip_compress, _gzip_decompress), 'deflate': (None, _deflate_decompress)}
+    if brotli is not None:
+        codecs['br'] = (_brotli_compress, _brotli_decompress)
+    if zstandard is not None:
+        codecs['zstd'] = (_zstd_compress, _zstd_decompress)
+    return codecs
+
+
+COMPRESSION_CODECS = load_compression_codecs()
+# Encodings offered for responses, in server preference order
+RESPONSE_ENCODINGS = [
+    name for name in parse_list(COMPRESSION_ENCODINGS)
+    if COMPRESSION_CODECS.get(name, (None,))[0] is not None
+]
+UPSTREAM_COMPRESSED_PROVIDERS = set(parse_list(UPSTREAM_REQUEST_COMPRESSION))
+
+# Response types worth compressing; images, archives and event streams are not
+COMPRESSIBLE_MIMETYPES = ('text/', 'application/json', 'application/javascript', 'application/x-ndjson', 'application/jsonl')
+
+
+def compression_error(message, error_type, status):
+    """Plain WSGI response for a request body that cannot be decoded"""
+    return Response(
+        json_dumps({"error": {"message": message, "type": error_type}}),
+        status=status,
+        mimetype='application/json'
+    )
+
+
+class RequestDecompressionMiddleware:
+    """
+    WSGI middleware that decodes gzip/br/zstd request bodies before Flask
+    sees them, so routes (and request.get_json()) only deal with plain
+    bodies. Decoding stops at max_bytes: larger bodies get a 413 and
+    unknown encodings a 415.
+    """
+
+    def __init__(self, wsgi_app, codecs, max_bytes):
+        self.wsgi_app = wsgi_app
+        self.codecs = codecs
+        self.max_bytes = max_bytes
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding and encoding != 'identity':
+            error = self.decode(environ, encoding)
+            if error is not None:
+                return error(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+    def decode(self, environ, encoding):
+        """Replace the request body with its decoded form; returns an error response or None"""
+        codec = self.codecs.get(encoding)
+        if codec is None:
+            supported = ', '.join(sorted(self.codecs))
+            return compression_error(
+                f"Unsupported Content-Encoding '{encoding}'. Supported: {supported}",
+                'unsupported_media_type', 415
+            )
+        data = get_input_stream(environ).read(self.max_bytes + 1)
+        try:
+            if len(data) > self.max_bytes:
+                raise DecompressedSizeExceeded(self.max_bytes)
+            body = codec[1](data, self.max_bytes)
+        except DecompressedSizeExceeded:
+            return compression_error(
+                f"Request body exceeds {self.max_bytes} bytes after decompression",
+                'request_too_large', 413
+            )
+        except Exception:
+            return compression_error(
+                f"Request body is not valid {encoding} data",
+                'invalid_request_error', 400
+            )
+        metrics.inc('http_compression_bytes_total', (('direction', 'request'), ('encoding', encoding), ('stage', 'encoded')), len(data))
+        metrics.inc('http_compression_bytes_total', (('direction', 'request'), ('encoding', encoding), ('stage', 'original')), len(body))
+        environ['wsgi.input'] = io.BytesIO(body)
+        environ['CONTENT_LENGTH'] = str(len(body))
+        environ.pop('HTTP_CONTENT_ENCODING', None)
+        environ.pop('HTTP_TRANSFER_ENCODING', None)
+        environ['wsgi.input_terminated'] = False
+        return None
+
+
+if COMPRESSION_ENABLED:
+    app.wsgi_app = RequestDecompressionMiddleware(app.wsgi_app, COMPRESSION_CODECS, REQUEST_MAX_DECOMPRESSED_BYTES)
+
+
+# Context window (tokens) by model ID prefix; the longest matching prefix wins.
+# Models matching none of these (and without a "context_window" in the routes
+# file) are not prechecked.
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-3.5-turbo': 16385,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+    'gpt-4-turbo': 128000,
+    'gpt-4-1106': 128000,
+    'gpt-4-0125': 128000,
+    'gpt-4o': 128000,
+    'o1-': 128000,
+    'claude-': 200000,
+    'gemini-pro': 32760,
+    'gemini-1.0-pro': 32760,
+    'gemini-1.5-flash': 1048576,
+    'gemini-1.5-pro': 2097152,
+    'grok-': 131072,
+}
+
+
+# Histogram buckets (seconds) for request and upstream latencies
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class Metrics:
+    """
+    Minimal in-process metrics registry rendered in the Prometheus text format
+    Labels are passed as tuples of (name, value) pairs; every update is a
+    dict lookup plus an addition under one lock, cheap enough for the hot path
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.meta = {}
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def describe(self, name, kind, help_text):
+        self.meta[name] = (kind, help_text)
+
+    def inc(self, name, labels=(), value=1):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge_add(self, name, labels=(), value=1):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, labels=(), value=0.0):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        index = bisect.bisect_left(LATENCY_BUCKETS, value)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+            histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = tuple(labels) + tuple(extra)
+        if not pairs:
+            return ''
+        inner = ','.join(
+            '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in pairs
+        )
+        return '{' + inner + '}'
+
+    def render(self, extra_gauges=()):
+        """Render all metrics; extra_gauges is [(name, labels, value)] computed at scrape time"""
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {k: (list(v[0]), v[1], v[2]) for k, v in self.histograms.items()}
+        for name, labels, value in extra_gauges:
+            gauges[(name, labels)] = value
+
+        series = {}
+        for (name, labels), value in counters.items():
+            series.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), value in gauges.items():
+            series.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in histograms.items():
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + (float('inf'),), buckets):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{name}_bucket{self._labels(labels, (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+
+        output = []
+        for name in sorted(series):
+            kind, help_text = self.meta.get(name, ('untyped', ''))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(series[name])
+        return '\n'.join(output) + '\n'
+
+
+metrics = Metrics(METRICS_ENABLED)
+metrics.describe('http_requests_total', 'counter', 'HTTP requests by route, method and status')
+metrics.describe('http_request_duration_seconds', 'histogram', 'HTTP request latency by route (including streamed bodies)')
+metrics.describe('http_requests_in_flight', 'gauge', 'HTTP requests currently being served by route')
+metrics.describe('upstream_requests_total', 'counter', 'Upstream provider requests by status')
+metrics.describe('upstream_request_duration_seconds', 'histogram', 'Upstream request latency by provider (full body)')
+metrics.describe('upstream_time_to_first_byte_seconds', 'histogram', 'Upstream time to first byte by provider')
+metrics.describe('upstream_in_flight', 'gauge', 'Upstream requests currently in flight by provider')
+metrics.describe('upstream_hedges_total', 'counter', 'Hedge requests by provider and outcome (sent, or skipped because every hedge worker was busy)')
+metrics.describe('upstream_stream_chunks_total', 'counter', 'Chunks streamed from upstream providers')
+metrics.describe('upstream_stream_bytes_total', 'counter', 'Bytes streamed from upstream providers')
+metrics.describe('tokens_total', 'counter', 'Prompt, completion and cached prompt tokens reported in upstream usage')
+metrics.describe('prompt_cache_breakpoints_total', 'counter', 'cache_control breakpoints added to Anthropic requests')
+metrics.describe('http_compression_bytes_total', 'counter', 'Bytes before (original) and after (encoded) compression by direction and encoding')
+metrics.describe('traces_exported_total', 'counter', 'Sampled traces by exporter and result (ok, error, dropped)')
+
+
+# OTLP span kinds and status codes
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+SPAN_STATUS_ERROR = 2
+
+
+class Span:
+    """One timed operation within a traced request"""
+
+    __slots__ = ('name', 'span_id', 'parent_id', 'kind', 'start_ns', 'end_ns', 'attributes', 'error')
+
+    def __init__(self, name, parent_id, kind=SPAN_KIND_INTERNAL, start_ns=None, attributes=None):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.error = False
+
+    def duration_ms(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_otlp(self, trace_id):
+        span = {
+            "traceId": trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [otlp_attribute(key, value) for key, value in self.attributes.items()],
         }
-    })
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.error:
+            span["status"] = {"code": SPAN_STATUS_ERROR}
+        return span
 
 
-@app.route('/access')
-def access_panel():
-    """AI Provider Access Panel - HTML interface"""
-    return render_template('access.html')
+def otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
 
 
-@app.route('/api/providers/<provider_id>/status', methods=['GET'])
-def check_provider_status(provider_id):
+class RequestTrace:
     """
-    Check the status of an AI provider
-    Returns whether the provider is accessible
+    The spans of one request and its W3C trace context
+    A trace that is neither sampled nor timed (recording=False) only
+    carries an incoming traceparent through to upstreams unchanged.
     """
-    if provider_id not in AI_PROVIDERS:
-        return jsonify({
-            "status": "error",
-            "message": "Unknown provider"
-        }), 404
-    
-    provider = AI_PROVIDERS[provider_id]
-    
-    # For now, we'll simulate checking by attempting to access the provider
-    # In a real implementation, this would check if we can reach the provider
-    # and potentially verify authentication status
-    try:
-        import requests
-        # Simple check - just try to reach the main URL with a timeout
-        response = requests.get(provider['url'], timeout=5, allow_redirects=True)
-        
-        if response.status_code < 500:
-            return jsonify({
-                "status": "working",
-                "message": f"Provider is accessible",
-                "provider": provider['name']
-            })
+
+    def __init__(self, tracer, trace_id, parent_id, sampled, recording, traceparent=None, tracestate=None):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.recording = recording
+        self.incoming = traceparent
+        self.tracestate = tracestate
+        self.spans = []
+        self.stack = []
+        self.root = Span('request', parent_id, SPAN_KIND_SERVER) if recording else None
+
+    def start_span(self, name, parent=None, kind=SPAN_KIND_INTERNAL, **attributes):
+        """Start a span under `parent` (default: the innermost open span); finish it with end_span()"""
+        if parent is None:
+            parent = self.stack[-1] if self.stack else self.root
+        return Span(name, parent.span_id, kind, attributes=attributes)
+
+    def end_span(self, span, end_ns=None):
+        span.end_ns = end_ns or time.time_ns()
+        self.spans.append(span)
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """Time a block as a child of the innermost open span"""
+        span = self.start_span(name, **attributes)
+        self.stack.append(span)
+        try:
+            yield span
+        except Exception:
+            span.error = True
+            raise
+        finally:
+            self.stack.pop()
+            self.end_span(span)
+
+    def headers(self, span=None):
+        """traceparent/tracestate for an upstream request made within `span`"""
+        if not self.recording:
+            headers = {'traceparent': self.incoming}
         else:
-            return jsonify({
-                "status": "not-working",
-                "message": f"Provider returned error {response.status_code}",
-                "provider": provider['name']
-            })
-    except Exception as e:
-        return jsonify({
-            "status": "not-working",
-            "message": f"Cannot reach provider: {str(e)}",
-            "provider": provider['name']
-        })
+            flags = '01' if self.sampled else '00'
+            headers = {'traceparent': f"00-{self.trace_id}-{(span or self.root).span_id}-{flags}"}
+        if self.tracestate:
+            headers['tracestate'] = self.tracestate
+        return headers
 
+    def server_timing(self):
+        """Server-Timing header value: finished phase durations (summed by name) and the total"""
+        durations = {}
+        for span in list(self.spans):
+            durations[span.name] = durations.get(span.name, 0) + span.duration_ms()
+        entries = [f"{name};dur={duration:.2f}" for name, duration in durations.items()]
+        entries.append(f"total;dur={self.root.duration_ms():.2f}")
+        return ', '.join(entries)
 
-@app.route('/api/providers/<provider_id>/session', methods=['GET'])
-def get_provider_session(provider_id):
+    def finish(self):
+        """End the request span (once the response is closed) and export a sampled trace"""
+        self.root.end_ns = time.time_ns()
+        if self.sampled:
+            self.tracer.export(self)
+
+
+class FileSpanExporter:
     """
-    Get session token for an AI provider
-    This is a placeholder implementation - real session token retrieval
-    would require browser automation or user authentication
+    Appends each trace as one line of OTLP/JSON (an ExportTraceServiceRequest),
+    the format the OpenTelemetry Collector's file exporter and receiver use
     """
-    if provider_id not in AI_PROVIDERS:
-        return jsonify({
-            "error": "Unknown provider"
-        }), 404
-    
-    provider = AI_PROVIDERS[provider_id]
-    
-    # Note: This is a placeholder implementation
-    # In a real-world scenario, you would need to:
-    # 1. Use browser automation (e.g., Selenium, Playwright) to login
-    # 2. Extract session cookies/tokens from the authenticated session
-    # 3. Store and manage these tokens securely
-    # 4. Handle token refresh when they expire
-    
-    return jsonify({
-        "token": f"[PLACEHOLDER-TOKEN-{provider_id.upper()}-{int(time.time())}]",
-        "message": "This is a placeholder token. Real implementation requires browser automation to extract actual session tokens.",
-        "provider": provider['name'],
-        "note": "Session token extraction requires user authentication and proper security measures"
-    })
+
+    name = 'file'
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.pid = None
+
+    def export(self, payload):
+        # One write() per line with O_APPEND keeps lines from several workers whole
+        if self.pid != os.getpid():
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self.pid = os.getpid()
+        os.write(self.fd, json_dumps(payload) + b'\n')
+        metrics.inc('traces_exported_total', (('exporter', self.name), ('result', 'ok')))
+
+
+class OTLPSpanExporter:
+    """
+    Sends traces to an OTLP/HTTP collector (JSON encoding) from a background
+    thread, batched, so the request path only appends to a bounded queue.
+    Traces that arrive while the queue is full are dropped.
+    """
+
+    name = 'otlp'
+
+    def __init__(self, endpoint, max_queue=2048, batch_size=128, interval=1.0):
+        self.endpoint = endpoint
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = deque()
+        self.ready = threading.Event()
+        self.pid = None
+
+    def export(self, payload):
+        if self.pid != os.getpid():
+            # First export in this process (or after fork): start the sender here
+            self.pid = os.getpid()
+            self.queue = deque()
+            threading.Thread(target=self._run, name='otlp-exporter', daemon=True).start()
+        if len(self.queue) >= self.max_queue:
+            metrics.inc('traces_exported_total', (('exporter', self.name), ('result', 'dropped')))
+            return
+        self.queue.append(payload)
+        if len(self.queue) >= self.batch_size:
+            self.ready.set()
+
+    def _run(self):
+        while True:
+            self.ready.wait(self.interval)
+            self.ready.clear()
+            while self.queue:
+                batch = []
+                while self.queue and len(batch) < self.batch_size:
+                    batch.extend(self.queue.popleft()["resourceSpans"])
+                self._send({"resourceSpans": batch}, len(batch))
+
+    def _send(self, payload, traces):
+        try:
+            response = get_upstream_pool('tracing').post(
+                self.endpoint,
+                data=json_dumps(payload),
+                headers={'Content-Type': 'application/json'},
+                timeout=(UPSTREAM_CONNECT_TIMEOUT, 10)
+            )
+            result = 'ok' if response.status_code < 300 else 'error'
+            response.close()
+        except requests.RequestException:
+            result = 'error'
+        metrics.inc('traces_exported_total', (('exporter', self.name), ('result', result)), traces)
+
+
+class Tracer:
+    """
+    Starts a RequestTrace per request and exports the sampled ones
+
+    Sampling is parent-based: a sampled incoming traceparent is always
+    followed, otherwise a new trace is sampled with probability
+    sample_rate. Nothing is sampled without an exporter. With
+    server_timing on, every request records its spans for the
+    Server-Timing header, whether exported or not. When neither applies,
+    requests get no RequestTrace at all (or, with an incoming traceparent,
+    a non-recording one that forwards it).
+    """
+
+    def __init__(self, sample_rate, exporters, server_timing, service_name):
+        self.sample_rate = sample_rate
+        self.exporters = exporters
+        self.server_timing = server_timing
+        self.resource = {"attributes": [otlp_attribute('service.name', service_name)]}
+
+    def start(self, traceparent=None, tracestate=None):
+        parent = parse_traceparent(traceparent) if traceparent else None
+        if parent is not None:
+            trace_id, parent_id, parent_sampled = parent
+            sampled = parent_sampled and bool(self.exporters)
+        else:
+            trace_id, parent_id = None, None
+            sampled = bool(self.exporters) and self.sample_rate > 0 and random.random() < self.sample_rate
+        recording = sampled or self.server_timing
+        if not recording and parent is None:
+            return None
+        return RequestTrace(
+            self, trace_id or os.urandom(16).hex(), parent_id, sampled, recording,
+            traceparent if parent is not None else None, tracestate if parent is not None else None
+        )
+
+    def export(self, trace):
+        payload = {"resourceSpans": [{
+            "resource": self.resource,
+            "scopeSpans": [{
+                "scope": {"name": "server"},
+                "spans": [span.to_otlp(trace.trace_id) for span in [trace.root] + trace.spans],
+            }],
+        }]}
+        for exporter in self.exporters:
+            try:
+                exporter.export(payload)
+            except OSError:
+                metrics.inc('traces_exported_total', (('exporter', exporter.name), ('result', 'error')))
+
+
+def parse_traceparent(value):
+    """(trace_id, parent_id, sampled) from a W3C traceparent header, or None if invalid"""
+    parts = value.strip().lower().split('-')
+    if len(parts) < 4 or len(parts[0]) != 2 or parts[0] == 'ff':
+        return None
+    version, trace_id, parent_id, flags = parts[:4]
+    if len(trace_id) != 32 or len(parent_id) != 16 or len(flags) != 2:
+        return None
+    try:
+        int(trace_id, 16), int(parent_id, 16)
+        sampled = bool(int(flags, 16) & 1)
+    except ValueError:
+        return None
+    if trace_id == '0' * 32 or parent_id == '0' * 16 or (version == '00' and len(parts) != 4):
+        return None
+    return trace_id, parent_id, sampled
+
+
+def build_tracer():
+    exporters = []
+    if TRACE_FILE:
+        exporters.append(FileSpanExporter(TRACE_FILE))
+    if TRACE_OTLP_ENDPOINT:
+        exporters.append(OTLPSpanExporter(TRACE_OTLP_ENDPOINT))
+    return Tracer(TRACE_SAMPLE_RATE, exporters, SERVER_TIMING, TRACE_SERVICE_NAME)
+
+
+tracer = build_tracer()
+
+# Shared no-op context for untraced requests
+_NO_SPAN = contextlib.nullcontext()
+
+
+def current_trace():
+    """The recording RequestTrace of the current request, or None"""
+    trace = g.get('trace') if has_request_context() else None
+    return trace if trace is not None and trace.recording else None
+
+
+def trace_span(name, **attributes):
+    """Context manager timing a block as a span of the current request (a no-op when untraced)"""
+    trace = current_trace()
+    if trace is None:
+        return _NO_SPAN
+    return trace.span(name, **attributes)
+
+
+# Trace and span of the upstream request this thread is sending
+_upstream_trace = threading.local()
+
+
+class TracedConnectionMixin:
+    """Records each new upstream connection (TCP + TLS handshake) as an upstream.connect span"""
+
+    def connect(self):
+        current = getattr(_upstream_trace, 'current', None)
+        if current is None:
+            return super().connect()
+        trace, parent = current
+        span = trace.start_span('upstream.connect', parent, host=self.host)
+        try:
+            return super().connect()
+        except Exception:
+            span.error = True
+            raise
+        finally:
+            trace.end_span(span)
+
+
+_traced_pool_classes = None
+
+
+def traced_pool_classes():
+    """urllib3 pool classes per scheme whose connections record upstream.connect spans"""
+    global _traced_pool_classes
+    if _traced_pool_classes is None:
+        from urllib3.connection import HTTPConnection, HTTPSConnection
+        from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+        class TracedHTTPConnection(TracedConnectionMixin, HTTPConnection):
+            pass
+
+        class TracedHTTPSConnection(TracedConnectionMixin, HTTPSConnection):
+            pass
+
+        class TracedHTTPConnectionPool(HTTPConnectionPool):
+            ConnectionCls = TracedHTTPConnection
+
+        class TracedHTTPSConnectionPool(HTTPSConnectionPool):
+            ConnectionCls = TracedHTTPSConnection
+
+        _traced_pool_classes = {'http': TracedHTTPConnectionPool, 'https': TracedHTTPSConnectionPool}
+    return _traced_pool_classes
+
+
+def record_usage(provider_id, usage, tokens=None):
+    """
+    Count prompt/completion tokens from an OpenAI-style usage block and
+    settle them against the completion's RequestTokens, if given
+    """
+    if not usage:
+        return
+    prompt_tokens = usage.get('prompt_tokens') or 0
+    completion_tokens = usage.get('completion_tokens') or 0
+    if metrics.enabled:
+        metrics.inc('tokens_total', (('provider', provider_id), ('type', 'prompt')), prompt_tokens)
+        metrics.inc('tokens_total', (('provider', provider_id), ('type', 'completion')), completion_tokens)
+        cached_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens')
+        if cached_tokens:
+            metrics.inc('tokens_total', (('provider', provider_id), ('type', 'cached')), cached_tokens)
+    if tokens is not None:
+        tokens.settle(provider_id, prompt_tokens, prompt_tokens + completion_tokens)
+
+
+class UpstreamPool:
+    """
+    Keep-alive HTTP session for a single upstream provider
+    Connections are pooled per host so repeated completions skip the
+    DNS lookup and TCP/TLS handshake
+    """
+
+    def __init__(self, provider, pool_connections, pool_maxsize, keep_alive=True):
+        self.provider = provider
+        self.keep_alive = keep_alive
+        self.adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=False
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.adapter.poolmanager.pool_classes_by_scheme = traced_pool_classes()
+        # Accept br/zstd upstream responses too when the codecs are installed
+        from urllib3.util.request import ACCEPT_ENCODING
+        self.session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+    def post(self, url, **kwargs):
+        """POST through the pooled session"""
+        return self.session.post(url, **kwargs)
+
+    def get(self, url, **kwargs):
+        """GET through the pooled session"""
+        return self.session.get(url, **kwargs)
+
+    def prewarm(self, url):
+        """Open a keep-alive connection to url's host (with a HEAD request); returns whether it worked"""
+        try:
+            self.session.head(url, timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_CONNECT_TIMEOUT))
+            return True
+        except requests.RequestException:
+            return False
+
+    def stats(self):
+        """Return open/idle/reused/new connection counts across all hosts"""
+        totals = {
+            "open": 0,
+            "idle": 0,
+            "new_connections": 0,
+            "reused_connections": 0,
+            "requests": 0,
+            "hosts": 0,
+        }
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            idle = sum(1 for conn in list(pool.pool.queue) if conn is not None)
+            in_use = max(pool.pool.maxsize - pool.pool.qsize(), 0)
+            totals["hosts"] += 1
+            totals["idle"] += idle
+            totals["open"] += idle + in_use
+            totals["new_connections"] += pool.num_connections
+            totals["requests"] += pool.num_requests
+            totals["reused_connections"] += max(pool.num_requests - pool.num_connections, 0)
+        totals["pool_maxsize"] = self.adapter._pool_maxsize
+        totals["keep_alive"] = self.keep_alive
+        return totals
+
+
+_upstream_pools = {}
+_upstream_pools_lock = threading.Lock()
+
+
+def get_upstream_pool(provider):
+    """Get (or lazily create) the pooled session for a provider"""
+    pool = _upstream_pools.get(provider)
+    if pool is None:
+        with _upstream_pools_lock:
+            pool = _upstream_pools.get(provider)
+            if pool is None:
+                pool = UpstreamPool(
+                    provider,
+                    UPSTREAM_POOL_CONNECTIONS,
+                    UPSTREAM_POOL_MAXSIZE,
+                    keep_alive=UPSTREAM_KEEP_ALIVE
+                )
+                _upstream_pools[provider] = pool
+    return pool
+
+
+def request_fingerprint(data, ignored_fields=('user',), owner=''):
+    """
+    Canonical SHA-256 of a request body, independent of key order
+    The owner tag of the calling API key is hashed in as well, so that
+    requests from different keys never share a fingerprint
+    """
+    canonical = {k: v for k, v in data.items() if k not in ignored_fields}
+    return hashlib.sha256(owner.encode('utf-8') + b'\n' + json_dumps(canonical, sort_keys=True)).hexdigest()
+
+
+class CachedResponse:
+    """A cached completion: the raw body chunks plus enough to replay them"""
+
+    def __init__(self, chunks, streamed, content_type, expires):
+        self.chunks = chunks
+        self.streamed = streamed
+        self.content_type = content_type
+        self.expires = expires
+        self.size = sum(len(chunk) for chunk in chunks)
+
+    def to_response(self):
+        """Replay the cached body (as SSE chunks for streamed entries)"""
+        headers = {'X-Cache': 'HIT'}
+        if self.streamed:
+            headers.update(SSE_HEADERS)
+            return Response(iter(self.chunks), content_type=self.content_type, headers=headers)
+        return Response(b''.join(self.chunks), content_type=self.content_type, headers=headers)
+
+    def to_json(self):
+        # latin-1 round-trips arbitrary bytes (chunks may split UTF-8 sequences)
+        return {
+            "chunks": [chunk.decode('latin-1') for chunk in self.chunks],
+            "streamed": self.streamed,
+            "content_type": self.content_type,
+            "expires": self.expires,
+        }
+
+    @classmethod
+    def from_json(cls, payload):
+        return cls(
+            [chunk.encode('latin-1') for chunk in payload['chunks']],
+            payload['streamed'],
+            payload['content_type'],
+            payload['expires']
+        )
+
+
+class ResponseCache:
+    """
+    In-memory LRU cache with TTL and a byte-size cap, plus an optional
+    on-disk tier that survives restarts and memory evictions
+    """
+
+    # Request fields that do not change the completion
+    IGNORED_FIELDS = ('user',)
+
+    def __init__(self, ttl, max_entries, max_bytes, directory=''):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.counters = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "expirations": 0,
+        }
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def make_key(self, data, owner):
+        """
+        Canonical hash of model, messages and sampling params for one key owner
+        Entries are never shared between API keys: a hit must neither
+        return another tenant's completion nor skip its own accounting
+        """
+        return request_fingerprint(data, self.IGNORED_FIELDS, owner)
+
+    def _disk_path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        """Return a CachedResponse or None"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry.expires > now:
+                    self.entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    return entry
+                self._remove(key)
+                self.counters["expirations"] += 1
+
+        entry = self._read_disk(key, now)
+        with self.lock:
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self.counters["disk_hits"] += 1
+            self._insert(key, entry)
+        return entry
+
+    def set(self, key, entry):
+        if entry.size > self.max_bytes:
+            return
+        with self.lock:
+            self._insert(key, entry)
+            self.counters["stores"] += 1
+        self._write_disk(key, entry)
+
+    def store_response(self, key, result):
+        """
+        Cache a successful route_completion() result and return the response
+        Streamed bodies are captured chunk by chunk while they are relayed
+        """
+        response = app.make_response(result)
+        if response.status_code != 200:
+            response.headers['X-Cache'] = 'MISS'
+            return response
+
+        content_type = response.headers.get('Content-Type', 'application/json')
+        if not response.is_streamed:
+            body = response.get_data()
+            self.set(key, CachedResponse([body], False, content_type, time.time() + self.ttl))
+            response.headers['X-Cache'] = 'MISS'
+            return response
+
+        upstream = response.response
+        cache = self
+
+        def tee():
+            chunks = []
+            complete = False
+            try:
+                for chunk in upstream:
+                    chunks.append(chunk)
+                    yield chunk
+                complete = True
+            finally:
+                if complete and not any(chunk.startswith(b'data: {"error"') for chunk in chunks):
+                    cache.set(key, CachedResponse(chunks, True, content_type, time.time() + cache.ttl))
+
+        headers = dict(response.headers)
+        headers['X-Cache'] = 'MISS'
+        teed = Response(tee(), status=response.status_code, headers=headers)
+        # Closing the original response closes the upstream and runs its own
+        # call_on_close hooks (e.g. a coalesced follower leaving its flight)
+        teed.call_on_close(response.close)
+        return teed
+
+    def _insert(self, key, entry):
+        # Caller holds the lock
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = entry
+        self.bytes += entry.size
+        while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+            oldest = next(iter(self.entries))
+            self._remove(oldest)
+            self.counters["evictions"] += 1
+
+    def _remove(self, key):
+        # Caller holds the lock
+        entry = self.entries.pop(key)
+        self.bytes -= entry.size
+
+    def _read_disk(self, key, now):
+        if not self.directory:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = CachedResponse.from_json(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+        if entry.expires <= now:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return entry
+
+    def _write_disk(self, key, entry):
+        if not self.directory:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry.to_json(), f)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                self.counters,
+                entries=len(self.entries),
+                bytes=self.bytes,
+                max_entries=self.max_entries,
+                max_bytes=self.max_bytes,
+                ttl=self.ttl,
+                disk=bool(self.directory)
+            )
+
+
+def is_cacheable(data):
+    """Only deterministic requests (temperature 0) are served from the cache"""
+    return data.get('temperature') == 0
+
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_MAX_BYTES,
+    RESPONSE_CACHE_DIR
+) if RESPONSE_CACHE_ENABLED else None
+
+
+class Flight:
+    """One in-flight upstream call shared by every identical request"""
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.cond = threading.Condition()
+        self.status = 500
+        self.headers = {}
+        self.body = None
+        self.streamed = False
+        self.chunks = []
+        self.done = False
+        self.subscribers = 1
+
+    def resolve(self, response):
+        self.status = response.status_code
+        self.headers = dict(response.headers)
+        self.streamed = response.is_streamed
+        if not self.streamed:
+            self.body = response.get_data()
+            self.done = True
+        self.ready.set()
+
+    def fail(self, error):
+        self.status = 500
+        self.headers = {'Content-Type': 'application/json'}
+        self.body = json_dumps({
+            "error": {
+                "message": f"Internal server error: {str(error)}",
+                "type": "server_error",
+                "param": None,
+                "code": "internal_error"
+            }
+        })
+        self.done = True
+        self.ready.set()
+
+    def publish(self, chunk):
+        with self.cond:
+            self.chunks.append(chunk)
+            self.cond.notify_all()
+
+    def finish(self):
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+    def join(self):
+        """Subscribe to the flight unless its stream is already over"""
+        with self.cond:
+            if self.done or self.subscribers <= 0:
+                return False
+            self.subscribers += 1
+            return True
+
+    def leave(self):
+        with self.cond:
+            self.subscribers -= 1
+
+    def lead(self, upstream, on_done):
+        """
+        Relay the upstream stream to the leader's client, publishing each
+        chunk to followers. If the leader disconnects while followers are
+        still reading, keep draining the upstream for them.
+        """
+        try:
+            for chunk in upstream:
+                self.publish(chunk)
+                yield chunk
+        finally:
+            self.leave()
+            try:
+                if self.subscribers > 0:
+                    for chunk in upstream:
+                        self.publish(chunk)
+                        if self.subscribers <= 0:
+                            break
+            finally:
+                close = getattr(upstream, 'close', None)
+                if close is not None:
+                    close()
+                self.finish()
+                on_done()
+
+    def follow(self):
+        """Replay published chunks, waiting for new ones until the flight is done"""
+        index = 0
+        while True:
+            with self.cond:
+                while index >= len(self.chunks) and not self.done:
+                    self.cond.wait()
+                pending = self.chunks[index:]
+                done = self.done
+            for chunk in pending:
+                yield chunk
+            index += len(pending)
+            if done and index >= len(self.chunks):
+                return
+
+
+class SingleFlight:
+    """
+    Request coalescing: concurrent identical requests share one upstream call
+    Non-streaming followers get a copy of the leader's response body;
+    streaming followers get the same chunk stream fanned out
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.counters = {
+            "leaders": 0,
+            "coalesced": 0,
+        }
+
+    def run(self, key, fn):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None or not flight.join()
+            if not leader:
+                self.counters["coalesced"] += 1
+            else:
+                flight = Flight()
+                self.flights[key] = flight
+                self.counters["leaders"] += 1
+                leader = True
+
+        if not leader:
+            flight.ready.wait()
+            return self._follower_response(flight)
+
+        try:
+            response = app.make_response(fn())
+        except Exception as e:
+            flight.fail(e)
+            self._forget(key, flight)
+            raise
+
+        flight.resolve(response)
+        if not flight.streamed:
+            self._forget(key, flight)
+            return response
+
+        upstream = response.response
+        response.response = flight.lead(upstream, lambda: self._forget(key, flight))
+        return response
+
+    def _follower_response(self, flight):
+        headers = dict(flight.headers)
+        headers.pop('Content-Length', None)
+        headers['X-Coalesced'] = 'true'
+        if not flight.streamed:
+            return Response(flight.body, status=flight.status, headers=headers)
+        response = Response(flight.follow(), status=flight.status, headers=headers)
+        response.call_on_close(flight.leave)
+        return response
+
+    def _forget(self, key, flight):
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, in_flight=len(self.flights))
+
+
+request_coalescer = SingleFlight() if REQUEST_COALESCING else None
+
+
+class RateLimits:
+    """Per-key limits; 0 means unlimited"""
+
+    def __init__(self, rpm=0, tpm=0, max_streams=0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_streams = max_streams
+
+    @property
+    def enabled(self):
+        return bool(self.rpm or self.tpm or self.max_streams)
+
+    def to_json(self):
+        return {"rpm": self.rpm, "tpm": self.tpm, "max_streams": self.max_streams}
+
+
+class MemoryRateLimitStore:
+    """Token buckets and stream counters held in this process"""
+
+    def __init__(self):
+        self.buckets = {}
+        self.streams = {}
+        self.lock = threading.Lock()
+
+    def take(self, bucket, capacity, rate, cost, now):
+        """
+        Refill the bucket for the time elapsed and take `cost` tokens from it
+        Returns 0 when taken, otherwise the seconds until it could be
+        """
+        with self.lock:
+            tokens, updated = self.buckets.get(bucket, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens < cost:
+                self.buckets[bucket] = (tokens, now)
+                return (cost - tokens) / rate
+            self.buckets[bucket] = (tokens - cost, now)
+            return 0
+
+    def charge(self, bucket, capacity, rate, amount, now):
+        """Take `amount` tokens unconditionally (the balance may go negative; a negative amount refunds)"""
+        with self.lock:
+            tokens, updated = self.buckets.get(bucket, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            self.buckets[bucket] = (min(capacity, tokens - amount), now)
+
+    def peek(self, bucket, capacity, rate, now):
+        with self.lock:
+            tokens, updated = self.buckets.get(bucket, (capacity, now))
+            return min(capacity, tokens + (now - updated) * rate)
+
+    def open_stream(self, key, limit):
+        with self.lock:
+            count = self.streams.get(key, 0)
+            if count >= limit:
+                return False
+            self.streams[key] = count + 1
+            return True
+
+    def close_stream(self, key):
+        with self.lock:
+            self.streams[key] = max(self.streams.get(key, 0) - 1, 0)
+
+    def open_streams(self, key):
+        with self.lock:
+            return self.streams.get(key, 0)
+
+
+class SQLiteRateLimitStore:
+    """
+    Token buckets and stream counters in a SQLite file shared by every
+    worker process on the host. Each operation is a single IMMEDIATE
+    transaction on one row, so limits hold across processes. Stream
+    counts are kept per process, and counts left behind by a process
+    that has exited are dropped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        db = sqlite3.connect(path, timeout=5)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS buckets (bucket TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS streams '
+                       '(key TEXT, pid INTEGER, count INTEGER, PRIMARY KEY (key, pid))')
+            db.commit()
+        finally:
+            db.close()
+
+    def _db(self):
+        # One connection per thread, reopened after a fork
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            self.local.db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self.local.db.execute('PRAGMA synchronous=NORMAL')
+            self.local.pid = pid
+        return self.local.db
+
+    def _refill(self, db, bucket, capacity, rate, now):
+        row = db.execute('SELECT tokens, updated FROM buckets WHERE bucket = ?', (bucket,)).fetchone()
+        tokens, updated = row if row is not None else (capacity, now)
+        return min(capacity, tokens + (now - updated) * rate)
+
+    def _store(self, db, bucket, tokens, now):
+        db.execute('INSERT OR REPLACE INTO buckets (bucket, tokens, updated) VALUES (?, ?, ?)',
+                   (bucket, tokens, now))
+
+    def _immediate(self, fn, *args):
+        """Run fn(db, *args) in one write-locked (IMMEDIATE) transaction"""
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            result = fn(db, *args)
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        return result
+
+    def take(self, bucket, capacity, rate, cost, now):
+        return self._immediate(self._take, bucket, capacity, rate, cost, now)
+
+    def _take(self, db, bucket, capacity, rate, cost, now):
+        tokens = self._refill(db, bucket, capacity, rate, now)
+        if tokens < cost:
+            self._store(db, bucket, tokens, now)
+            return (cost - tokens) / rate
+        self._store(db, bucket, tokens - cost, now)
+        return 0
+
+    def charge(self, bucket, capacity, rate, amount, now):
+        self._immediate(self._charge, bucket, capacity, rate, amount, now)
+
+    def _charge(self, db, bucket, capacity, rate, amount, now):
+        self._store(db, bucket, min(capacity, self._refill(db, bucket, capacity, rate, now) - amount), now)
+
+    def peek(self, bucket, capacity, rate, now):
+        return self._refill(self._db(), bucket, capacity, rate, now)
+
+    def open_stream(self, key, limit):
+        return self._immediate(self._open_stream, key, limit)
+
+    def _open_stream(self, db, key, limit):
+        if self._count_streams(db, key) >= limit:
+            self._drop_dead_processes(db, key)
+            if self._count_streams(db, key) >= limit:
+                return False
+        db.execute('INSERT INTO streams (key, pid, count) VALUES (?, ?, 1) '
+                   'ON CONFLICT (key, pid) DO UPDATE SET count = count + 1', (key, os.getpid()))
+        return True
+
+    def close_stream(self, key):
+        self._db().execute('UPDATE streams SET count = MAX(count - 1, 0) WHERE key = ? AND pid = ?',
+                           (key, os.getpid()))
+
+    def open_streams(self, key):
+        return self._count_streams(self._db(), key)
+
+    def _count_streams(self, db, key):
+        return db.execute('SELECT COALESCE(SUM(count), 0) FROM streams WHERE key = ?', (key,)).fetchone()[0]
+
+    def _drop_dead_processes(self, db, key):
+        for (pid,) in db.execute('SELECT pid FROM streams WHERE key = ? AND count > 0', (key,)).fetchall():
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                db.execute('DELETE FROM streams WHERE key = ? AND pid = ?', (key, pid))
+            except OSError:
+                pass
+
+
+class RateLimiter:
+    """
+    Per-API-key requests-per-minute, tokens-per-minute and concurrent
+    stream limits, each an O(1) token bucket or counter in the store.
+    Tokens are charged from upstream usage once a completion finishes;
+    a key whose token bucket is in debt is refused until it refills.
+    """
+
+    def __init__(self, store, default_limits, key_limits):
+        self.store = store
+        self.default_limits = default_limits
+        self.key_limits = key_limits
+
+    def limits_for(self, api_key):
+        return self.key_limits.get(api_key, self.default_limits)
+
+    def _bucket_id(self, api_key):
+        # Raw keys are never written to the (possibly shared) store
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+    def check_request(self, api_key):
+        """
+        Admit one request for the key
+        Returns None, or a (limit_type, limit, retry_after) tuple when refused
+        """
+        limits = self.limits_for(api_key)
+        bucket = self._bucket_id(api_key)
+        now = time.time()
+        if limits.tpm:
+            wait_for = self.store.take(f'tpm:{bucket}', limits.tpm, limits.tpm / 60.0, 0, now)
+            if wait_for:
+                return 'tokens', limits.tpm, wait_for
+        if limits.rpm:
+            wait_for = self.store.take(f'rpm:{bucket}', limits.rpm, limits.rpm / 60.0, 1, now)
+            if wait_for:
+                return 'requests', limits.rpm, wait_for
+        return None
+
+    def charge_tokens(self, api_key, tokens):
+        limits = self.limits_for(api_key)
+        if limits.tpm and tokens:
+            self.store.charge(f'tpm:{self._bucket_id(api_key)}', limits.tpm, limits.tpm / 60.0, tokens, time.time())
+
+    def open_stream(self, api_key):
+        """Reserve a concurrent stream slot; False when the key has none left"""
+        limits = self.limits_for(api_key)
+        if not limits.max_streams:
+            return True
+        return self.store.open_stream(self._bucket_id(api_key), limits.max_streams)
+
+    def close_stream(self, api_key):
+        if self.limits_for(api_key).max_streams:
+            self.store.close_stream(self._bucket_id(api_key))
+
+    def status(self, api_key):
+        limits = self.limits_for(api_key)
+        bucket = self._bucket_id(api_key)
+        now = time.time()
+        remaining = {}
+        if limits.rpm:
+            remaining["requests"] = int(self.store.peek(f'rpm:{bucket}', limits.rpm, limits.rpm / 60.0, now))
+        if limits.tpm:
+            remaining["tokens"] = int(self.store.peek(f'tpm:{bucket}', limits.tpm, limits.tpm / 60.0, now))
+        if limits.max_streams:
+            remaining["streams"] = limits.max_streams - self.store.open_streams(bucket)
+        return {"limits": limits.to_json(), "remaining": remaining}
+
+
+def load_api_keys_file(path):
+    """
+    Read the API keys file:
+    {"keys": {"<api key>": {"rpm": 60, "tpm": 100000, "max_streams": 4}}}
+    Limits left out fall back to the RATE_LIMIT_* defaults
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    return {
+        api_key: RateLimits(
+            int(spec.get('rpm', RATE_LIMIT_RPM)),
+            int(spec.get('tpm', RATE_LIMIT_TPM)),
+            int(spec.get('max_streams', RATE_LIMIT_MAX_STREAMS))
+        )
+        for api_key, spec in config.get('keys', {}).items()
+    }
+
+
+def build_rate_limiter():
+    default_limits = RateLimits(RATE_LIMIT_RPM, RATE_LIMIT_TPM, RATE_LIMIT_MAX_STREAMS)
+    key_limits = load_api_keys_file(API_KEYS_FILE) if API_KEYS_FILE else {}
+    CLIENT_API_KEYS.update(key_limits)
+    if not default_limits.enabled and not any(limits.enabled for limits in key_limits.values()):
+        return None
+    store = SQLiteRateLimitStore(RATE_LIMIT_STORE) if RATE_LIMIT_STORE else MemoryRateLimitStore()
+    return RateLimiter(store, default_limits, key_limits)
+
+
+rate_limiter = build_rate_limiter()
+
+
+def rate_limit_error(message, retry_after, limit_type='requests'):
+    """OpenAI-style 429 with a Retry-After header (whole seconds)"""
+    response = jsonify({
+        "error": {
+            "message": message,
+            "type": limit_type,
+            "param": None,
+            "code": "rate_limit_exceeded"
+        }
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, int(-(-retry_after // 1))))
+    return response
+
+
+class TokenEstimator:
+    """
+    Local prompt token counts, used before a request is forwarded
+    OpenAI models are counted exactly with tiktoken when it is installed.
+    Everything else gets a character-class estimate per provider (ASCII
+    text at the provider's chars-per-token ratio, other characters at about
+    one token each). The estimate is recalibrated against the usage that
+    providers report. Tokenizer counts are memoized per text, so a repeated
+    system prompt or conversation history costs one dictionary lookup per
+    message. The estimate is only a few length checks and is not memoized.
+    """
+
+    # Chars per token for ASCII text; the calibration factor adjusts these
+    CHARS_PER_TOKEN = {'openai': 4.0, 'xai': 4.0, 'anthropic': 3.5, 'google': 4.0}
+    # Chat format overhead (OpenAI counts 3 per message plus 3 to prime the reply)
+    TOKENS_PER_MESSAGE = 3
+    TOKENS_PER_REPLY = 3
+    # Flat estimate per image part
+    TOKENS_PER_IMAGE = 85
+    # Texts shorter than this are cheaper to tokenize than to look up
+    MEMO_MIN_LENGTH = 64
+    # Smaller prompts are dominated by the per-message overhead guess
+    CALIBRATION_MIN_TOKENS = 256
+
+    def __init__(self, memo_size=4096):
+        self.memo_size = memo_size
+        self.memo = OrderedDict()
+        self.lock = threading.Lock()
+        self.calibration = {}
+        self.encodings = {}
+        # tiktoken is imported on the first OpenAI count (or by warm())
+        self.tiktoken = None
+        self.tiktoken_checked = False
+
+    def _load_tiktoken(self):
+        if not self.tiktoken_checked:
+            try:
+                import tiktoken
+                self.tiktoken = tiktoken
+            except ImportError:
+                pass
+            self.tiktoken_checked = True
+        return self.tiktoken
+
+    def warm(self):
+        """Import tiktoken and load the common encodings ahead of the first request"""
+        if self._load_tiktoken() is not None:
+            for model in ('gpt-4', 'gpt-4o'):
+                self._encoding('openai', model)
+
+    def _encoding(self, provider_id, model):
+        if provider_id != 'openai' or self._load_tiktoken() is None:
+            return None
+        encoding = self.encodings.get(model)
+        if encoding is None:
+            try:
+                encoding = self.tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = self.tiktoken.get_encoding('o200k_base' if model.startswith(('gpt-4o', 'o1')) else 'cl100k_base')
+            self.encodings[model] = encoding
+        return encoding
+
+    def count_text(self, text, provider_id, model='', memo=True):
+        """Token count of a single text"""
+        if not text:
+            return 0
+        encoding = self._encoding(provider_id, model)
+        if encoding is None:
+            # UTF-8 bytes beyond one per character approximate the non-ASCII share
+            extra = 0 if text.isascii() else len(text.encode('utf-8')) - len(text)
+            other = extra // 2
+            return int((len(text) - other) / self.CHARS_PER_TOKEN.get(provider_id, 4.0) + other) + 1
+        memo = memo and len(text) >= self.MEMO_MIN_LENGTH
+        if memo:
+            key = (encoding.name, text)
+            with self.lock:
+                count = self.memo.get(key)
+                if count is not None:
+                    self.memo.move_to_end(key)
+                    return count
+        count = len(encoding.encode(text, disallowed_special=()))
+        if memo:
+            with self.lock:
+                self.memo[key] = count
+                if len(self.memo) > self.memo_size:
+                    self.memo.popitem(last=False)
+        return count
+
+    def count_messages(self, messages, provider_id, model=''):
+        """
+        Estimated prompt tokens of an OpenAI-style messages array
+        Returns (tokens, exact)
+        """
+        exact = self._encoding(provider_id, model) is not None
+        tokens = self.TOKENS_PER_REPLY
+        for message in messages:
+            if not isinstance(message, dict):
+                continue
+            tokens += self.TOKENS_PER_MESSAGE
+            content = message.get('content')
+            if isinstance(content, str):
+                tokens += self.count_text(content, provider_id, model)
+            elif isinstance(content, list):
+                for part in content:
+                    if not isinstance(part, dict):
+                        continue
+                    if part.get('type') == 'text':
+                        tokens += self.count_text(part.get('text', ''), provider_id, model)
+                    elif part.get('type') in ('image_url', 'input_audio', 'file'):
+                        tokens += self.TOKENS_PER_IMAGE
+                        exact = False
+            if message.get('name'):
+                tokens += self.count_text(message['name'], provider_id, model) + 1
+            if message.get('tool_calls'):
+                tokens += self.count_text(json_dumps(message['tool_calls']).decode('utf-8'), provider_id, model)
+                exact = False
+        if not exact:
+            tokens = int(tokens * self.calibration.get(provider_id, 1.0))
+        return tokens, exact
+
+    def calibrate(self, provider_id, estimated, actual):
+        """Move the provider's correction factor towards actual / estimated"""
+        if estimated < self.CALIBRATION_MIN_TOKENS or actual <= 0:
+            return
+        factor = self.calibration.get(provider_id, 1.0)
+        ratio = actual / (estimated / factor)
+        self.calibration[provider_id] = min(max(0.9 * factor + 0.1 * ratio, 0.5), 2.0)
+
+
+token_estimator = TokenEstimator()
+
+
+class RequestTokens:
+    """
+    Token bookkeeping for one completion request
+    The prompt estimate is charged to the client key's tokens-per-minute
+    budget up front. settle() replaces it with the provider-reported usage
+    and uses the difference to calibrate the estimator.
+    """
+
+    def __init__(self, client_key, provider_id, estimate, exact):
+        self.client_key = client_key
+        self.provider_id = provider_id
+        self.estimate = estimate
+        self.exact = exact
+        self.reserved = 0
+        if rate_limiter is not None and client_key is not None:
+            rate_limiter.charge_tokens(client_key, estimate)
+            self.reserved = estimate
+
+    def settle(self, provider_id, prompt_tokens, total_tokens):
+        if not self.exact and provider_id == self.provider_id:
+            token_estimator.calibrate(provider_id, self.estimate, prompt_tokens)
+        if rate_limiter is not None and self.client_key is not None:
+            rate_limiter.charge_tokens(self.client_key, total_tokens - self.reserved)
+        self.reserved = 0
+        self.client_key = None
+
+
+class CompletionCall:
+    """
+    What one chat completion needs from its caller, passed down the
+    completion path explicitly rather than read from flask.g: the client
+    key its tokens are charged to, the trace its spans are recorded on
+    (None when untraced) and, once route_completion() has counted the
+    prompt, its RequestTokens. Batch requests run with one of these and
+    no request context.
+    """
+
+    def __init__(self, client_key=None, trace=None):
+        self.client_key = client_key
+        self.trace = trace if trace is not None and trace.recording else None
+        self.tokens = None
+
+    def span(self, name, **attributes):
+        """Context manager timing a block as a span of the call's trace (a no-op when untraced)"""
+        if self.trace is None:
+            return _NO_SPAN
+        return self.trace.span(name, **attributes)
+
+    def annotate(self, **attributes):
+        if self.trace is not None:
+            self.trace.root.attributes.update(attributes)
+
+
+class PrefixSketch:
+    """
+    Count-min sketch of prompt-prefix fingerprints
+    Memory is fixed (depth x width counters) however many distinct prefixes
+    are seen. Counts can only be overestimated, by colliding prefixes.
+    Every counter is halved after each `decay_every` additions, so prefixes
+    that stop recurring cool down again.
+    """
+
+    def __init__(self, width=4096, depth=4, decay_every=100000):
+        self.width = width
+        self.depth = depth
+        self.decay_every = decay_every
+        self.rows = [[0] * width for _ in range(depth)]
+        self.additions = 0
+        self.lock = threading.Lock()
+
+    def add(self, digest):
+        """Count one occurrence of a 16-byte digest and return its estimated count"""
+        count = None
+        with self.lock:
+            for row_index, row in enumerate(self.rows):
+                column = int.from_bytes(digest[row_index * 4:row_index * 4 + 4], 'little') % self.width
+                row[column] += 1
+                count = row[column] if count is None else min(count, row[column])
+            self.additions += 1
+            if self.additions >= self.decay_every:
+                self.additions = 0
+                for row in self.rows:
+                    row[:] = [value >> 1 for value in row]
+        return count
+
+
+class AnthropicPromptCache:
+    """
+    Adds Anthropic prompt-caching breakpoints (cache_control) to repeated prefixes
+
+    Every converted request is fingerprinted at each prefix boundary: the
+    system prompt, then each leading message, chained so that a boundary's
+    fingerprint covers everything before it. The fingerprints are counted
+    in a PrefixSketch. Breakpoints go on boundaries that have been seen at
+    least `min_hits` times and are long enough for Anthropic to cache: the
+    system prompt, the first hot message boundary (a shared few-shot
+    prefix) and the longest hot boundary (the conversation so far).
+    """
+
+    MAX_BREAKPOINTS = 4
+    CACHE_CONTROL = {"type": "ephemeral"}
+
+    def __init__(self, sketch, min_hits=2, min_tokens=1024):
+        self.sketch = sketch
+        self.min_hits = min_hits
+        self.min_tokens = min_tokens
+
+    def _min_tokens(self, model):
+        # Haiku models only cache prefixes of 2048+ tokens
+        return self.min_tokens * 2 if 'haiku' in model else self.min_tokens
+
+    @staticmethod
+    def _add(chain, content, model):
+        """
+        Add message content to the prefix fingerprint; returns its estimated tokens
+        Base64 image and document data is hashed as it is, not serialized
+        to JSON or run through the token estimate
+        """
+        if isinstance(content, str):
+            chain.update(content.encode('utf-8'))
+            return token_estimator.count_text(content, 'anthropic', model)
+        tokens = 0
+        for block in content if isinstance(content, list) else ():
+            source = block.get('source') if isinstance(block, dict) else None
+            if isinstance(source, dict) and isinstance(source.get('data'), str):
+                chain.update(json_dumps(dict(block, source=dict(source, data=None))))
+                chain.update(source['data'].encode('ascii', 'replace'))
+                tokens += token_estimator.TOKENS_PER_IMAGE
+            elif isinstance(block, dict) and isinstance(block.get('content'), list):
+                # Tool results can hold images too
+                chain.update(json_dumps(dict(block, content=None)))
+                tokens += AnthropicPromptCache._add(chain, block['content'], model)
+            else:
+                encoded = json_dumps(block)
+                chain.update(encoded)
+                tokens += token_estimator.count_text(encoded.decode('utf-8'), 'anthropic', model)
+        return tokens
+
+    def apply(self, anthropic_data):
+        """Add cache_control to anthropic_data in place; returns the number of breakpoints"""
+        model = anthropic_data.get('model', '')
+        min_tokens = self._min_tokens(model)
+        chain = hashlib.blake2b(model.encode('utf-8'), digest_size=16)
+        tokens = 0
+        hot = []
+
+        system = anthropic_data.get('system')
+        if system:
+            tokens += self._add(chain, system, model)
+            if self.sketch.add(chain.digest()) >= self.min_hits and tokens >= min_tokens:
+                hot.append(None)
+
+        for index, message in enumerate(anthropic_data['messages']):
+            chain.update(b'\x00' + message.get('role', '').encode('utf-8') + b'\x00')
+            tokens += self._add(chain, message.get('content', ''), model)
+            if self.sketch.add(chain.digest()) >= self.min_hits and tokens >= min_tokens:
+                hot.append(index)
+
+        if not hot:
+            return 0
+        chosen = []
+        if hot[0] is None:
+            anthropic_data['system'] = self._mark(system)
+            chosen.append(None)
+        message_boundaries = [index for index in hot if index is not None]
+        for index in (message_boundaries[:1] + message_boundaries[-1:])[:self.MAX_BREAKPOINTS - len(chosen)]:
+            if index not in chosen:
+                message = anthropic_data['messages'][index]
+                anthropic_data['messages'][index] = dict(message, content=self._mark(message.get('content', '')))
+                chosen.append(index)
+        return len(chosen)
+
+    def _mark(self, content):
+        """Content as blocks with a breakpoint on the last one (input is never mutated)"""
+        if isinstance(content, str):
+            return [{"type": "text", "text": content, "cache_control": self.CACHE_CONTROL}]
+        if isinstance(content, list) and content and isinstance(content[-1], dict):
+            return content[:-1] + [dict(content[-1], cache_control=self.CACHE_CONTROL)]
+        return content
+
+
+anthropic_prompt_cache = AnthropicPromptCache(
+    PrefixSketch(),
+    ANTHROPIC_PROMPT_CACHE_MIN_HITS,
+    ANTHROPIC_PROMPT_CACHE_MIN_TOKENS
+) if ANTHROPIC_PROMPT_CACHING else None
+
+
+class UpstreamTarget:
+    """One API key + base URL combination of a provider"""
+
+    def __init__(self, api_key, base_url):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.cooldown_until = 0.0
+
+    def stats(self, now):
+        return {
+            "key": f"...{self.api_key[-4:]}" if len(self.api_key) > 8 else "...",
+            "base_url": self.base_url,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "cooling_down": self.cooldown_until > now,
+            "cooldown_remaining": round(max(self.cooldown_until - now, 0), 3),
+        }
+
+
+class UpstreamBalancer:
+    """
+    Spread requests over a provider's keys and endpoints
+    Targets that answer 429/5xx (or fail to connect) are taken out of
+    rotation until their cooldown expires
+    """
+
+    def __init__(self, api_keys, base_urls, strategy='round_robin', cooldown=30):
+        self.targets = [UpstreamTarget(key, url) for key in api_keys for url in base_urls]
+        self.strategy = strategy
+        self.cooldown = cooldown
+        self.next_index = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Pick a target and count it as in flight"""
+        now = time.monotonic()
+        with self.lock:
+            count = len(self.targets)
+            order = [self.targets[(self.next_index + i) % count] for i in range(count)]
+            self.next_index = (self.next_index + 1) % count
+            healthy = [t for t in order if t.cooldown_until <= now]
+            if not healthy:
+                # Everything is cooling down: use whichever recovers first
+                target = min(order, key=lambda t: t.cooldown_until)
+            elif self.strategy == 'least_outstanding':
+                target = min(healthy, key=lambda t: t.in_flight)
+            else:
+                target = healthy[0]
+            target.in_flight += 1
+            target.requests += 1
+            return target
+
+    def release(self, target, status_code=None, retry_after=None, failed=False):
+        """Finish a request on a target, cooling it down on 429/5xx or failure"""
+        with self.lock:
+            target.in_flight -= 1
+            if failed or status_code == 429 or (status_code is not None and status_code >= 500):
+                target.errors += 1
+                delay = self.cooldown
+                try:
+                    if retry_after:
+                        delay = float(retry_after)
+                except ValueError:
+                    pass
+                target.cooldown_until = time.monotonic() + delay
+
+    def has_healthy_target(self):
+        now = time.monotonic()
+        with self.lock:
+            return any(t.cooldown_until <= now for t in self.targets)
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return [target.stats(now) for target in self.targets]
+
+
+class Provider:
+    """An upstream provider that chat completions can be routed to"""
+
+    def __init__(self, provider_id, label, forward, api_keys, api_key_env, base_urls, prefixes=()):
+        self.id = provider_id
+        self.label = label
+        self.forward = forward
+        self.api_keys = api_keys
+        self.api_key_env = api_key_env
+        self.prefixes = tuple(prefixes)
+        self.balancer = UpstreamBalancer(
+            api_keys, base_urls, UPSTREAM_BALANCING, UPSTREAM_COOLDOWN
+        ) if api_keys else None
+
+
+PROVIDERS = {}
+
+
+def register_provider(provider_id, label, forward, api_keys, api_key_env, base_urls, prefixes=()):
+    """
+    Register an upstream provider
+    Requests are balanced over every (api key, base url) combination
+    """
+    PROVIDERS[provider_id] = Provider(
+        provider_id, label, forward, parse_list(api_keys), api_key_env,
+        parse_list(base_urls), prefixes
+    )
+
+
+# Upstream statuses worth retrying (or hedging / falling back on)
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class LatencyTracker:
+    """Recent non-streaming upstream latencies, used to pick the hedge delay"""
+
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, fraction):
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+_upstream_latency = {}
+_hedge_pools = {}
+_hedge_pools_lock = threading.Lock()
+
+
+def get_latency_tracker(provider_id):
+    tracker = _upstream_latency.get(provider_id)
+    if tracker is None:
+        tracker = _upstream_latency.setdefault(provider_id, LatencyTracker())
+    return tracker
+
+
+class HedgePool:
+    """
+    Worker threads for the hedged requests of one provider
+    A request only gets a worker if one is free right away, never a place
+    in a queue: a hedge delay therefore always times a request that is
+    actually running, and a saturated pool sends requests without hedges
+    (on the caller's thread) instead of capping concurrency. Sized like
+    the provider's connection pool (UPSTREAM_POOL_MAXSIZE).
+    """
+
+    def __init__(self, provider_id, size):
+        self.slots = threading.BoundedSemaphore(size)
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix=f'hedge-{provider_id}')
+
+    def try_submit(self, fn, *args):
+        """Run fn(*args) on a free worker; returns its future, or None if all are busy"""
+        if not self.slots.acquire(blocking=False):
+            return None
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+
+def get_hedge_pool(provider_id):
+    pool = _hedge_pools.get(provider_id)
+    if pool is None:
+        with _hedge_pools_lock:
+            pool = _hedge_pools.get(provider_id)
+            if pool is None:
+                pool = _hedge_pools[provider_id] = HedgePool(provider_id, UPSTREAM_POOL_MAXSIZE)
+    return pool
+
+
+def retry_delay(attempt, retry_after=None):
+    """Full-jitter exponential backoff, honouring a short Retry-After"""
+    if retry_after:
+        try:
+            delay = float(retry_after)
+            if 0 <= delay <= UPSTREAM_RETRY_BACKOFF_MAX:
+                return delay
+        except ValueError:
+            pass
+    return random.uniform(0, min(UPSTREAM_RETRY_BACKOFF_MAX, UPSTREAM_RETRY_BACKOFF * (2 ** attempt)))
+
+
+def post_upstream_once(provider_id, path, body, stream, auth, content_encoding=None, trace=None):
+    """
+    Single POST of an encoded JSON body to one balancer target
+    With a trace, the attempt is an upstream span (new connections and
+    time to first byte as children) and carries its traceparent.
+    """
+    balancer = PROVIDERS[provider_id].balancer
+    target = balancer.acquire()
+    headers, params = auth(target)
+    headers = dict(headers, **{'Content-Type': 'application/json'})
+    if content_encoding:
+        headers['Content-Encoding'] = content_encoding
+    span = None
+    if trace is not None:
+        if trace.recording:
+            span = trace.start_span('upstream', kind=SPAN_KIND_CLIENT, provider=provider_id, target=target.base_url)
+            _upstream_trace.current = (trace, span)
+        headers.update(trace.headers(span))
+    started = time.monotonic()
+    try:
+        response = get_upstream_pool(provider_id).post(
+            f'{target.base_url}{path}',
+            headers=headers,
+            params=params,
+            data=body,
+            stream=stream,
+            timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)
+        )
+    except requests.RequestException:
+        balancer.release(target, failed=True)
+        metrics.inc('upstream_requests_total', (('provider', provider_id), ('status', 'error')))
+        if span is not None:
+            span.error = True
+            trace.end_span(span)
+        raise
+    finally:
+        _upstream_trace.current = None
+
+    if span is not None:
+        ttfb = trace.start_span('upstream.ttfb', span)
+        ttfb.start_ns = span.start_ns
+        trace.end_span(ttfb, span.start_ns + int(response.elapsed.total_seconds() * 1e9))
+        span.attributes['http.status_code'] = response.status_code
+        upstream_request_id = response.headers.get('x-request-id') or response.headers.get('request-id')
+        if upstream_request_id:
+            span.attributes['upstream.request_id'] = upstream_request_id
+        span.error = response.status_code >= 400
+        trace.end_span(span)
+
+    labels = (('provider', provider_id),)
+    metrics.inc('upstream_requests_total', (('provider', provider_id), ('status', str(response.status_code))))
+    response.upstream_provider = provider_id
+    response.upstream_started = started
+
+    if stream and response.status_code == 200:
+        response.upstream_release = lambda: balancer.release(target, response.status_code)
+    else:
+        balancer.release(target, response.status_code, response.headers.get('Retry-After'))
+        elapsed = time.monotonic() - started
+        metrics.observe('upstream_time_to_first_byte_seconds', labels, response.elapsed.total_seconds())
+        metrics.observe('upstream_request_duration_seconds', labels, elapsed)
+        if response.status_code == 200:
+            get_latency_tracker(provider_id).record(elapsed)
+    return response
+
+
+def post_upstream_hedged(provider_id, path, body, auth, content_encoding=None, trace=None):
+    """
+    Send a non-streaming request, and if it has not answered within the
+    provider's recent p95 latency, send a second one; the first usable
+    response wins and the other is left to finish in the background
+    """
+    p95 = get_latency_tracker(provider_id).percentile(0.95)
+    delay = max(p95 or 0, UPSTREAM_HEDGE_MIN_DELAY)
+    pool = get_hedge_pool(provider_id)
+    args = (provider_id, path, body, False, auth, content_encoding, trace)
+
+    primary = pool.try_submit(post_upstream_once, *args)
+    if primary is None:
+        # Every worker is busy: a saturated provider gets no extra hedges
+        metrics.inc('upstream_hedges_total', (('provider', provider_id), ('outcome', 'skipped')))
+        return post_upstream_once(*args)
+    done, _ = wait([primary], timeout=delay)
+    if done:
+        return primary.result()
+
+    hedge = pool.try_submit(post_upstream_once, *args)
+    if hedge is None:
+        metrics.inc('upstream_hedges_total', (('provider', provider_id), ('outcome', 'skipped')))
+        return primary.result()
+    metrics.inc('upstream_hedges_total', (('provider', provider_id), ('outcome', 'sent')))
+    pending = {primary, hedge}
+    fallback_response = None
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                response = future.result()
+            except requests.RequestException as e:
+                error = e
+                continue
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                return response
+            fallback_response = response
+    if fallback_response is not None:
+        return fallback_response
+    raise error
+
+
+def send_upstream(provider_id, path, payload, stream=False, auth=None, trace=None):
+    """
+    POST a request to a provider through its balancer and pooled session
+    auth(target) returns the (headers, params) carrying the target's key,
+    and upstream spans are recorded on trace, if given.
+    Connection errors and retryable statuses are retried with jittered
+    exponential backoff on a freshly selected target (for streams, only
+    before the first byte). Streamed responses hold their target until
+    finish_upstream() is called. Bodies for providers listed in
+    UPSTREAM_REQUEST_COMPRESSION are gzipped once, before any attempt.
+    """
+    body = json_dumps(payload)
+    content_encoding = None
+    if provider_id in UPSTREAM_COMPRESSED_PROVIDERS and len(body) >= COMPRESSION_MIN_BYTES:
+        original = len(body)
+        body = _gzip_compress(body)
+        content_encoding = 'gzip'
+        metrics.inc('http_compression_bytes_total', (('direction', 'upstream'), ('encoding', 'gzip'), ('stage', 'original')), original)
+        metrics.inc('http_compression_bytes_total', (('direction', 'upstream'), ('encoding', 'gzip'), ('stage', 'encoded')), len(body))
+    attempts = UPSTREAM_MAX_RETRIES + 1
+    for attempt in range(attempts):
+        last = attempt == attempts - 1
+        try:
+            if UPSTREAM_HEDGING and not stream:
+                response = post_upstream_hedged(provider_id, path, body, auth, content_encoding, trace)
+            else:
+                response = post_upstream_once(provider_id, path, body, stream, auth, content_encoding, trace)
+        except requests.RequestException:
+            if last:
+                raise
+            time.sleep(retry_delay(attempt))
+            continue
+
+        if last or response.status_code not in RETRYABLE_STATUS_CODES:
+            return response
+        finish_upstream(response)
+        # Retry-After only matters when there is no other target to move to
+        retry_after = None
+        if not PROVIDERS[provider_id].balancer.has_healthy_target():
+            retry_after = response.headers.get('Retry-After')
+        time.sleep(retry_delay(attempt, retry_after))
+
+
+# Upper bound for a single read from a streamed upstream body
+UPSTREAM_STREAM_READ_SIZE = 64 * 1024
+
+
+class UpstreamStream:
+    """
+    Iterator over a streamed upstream body that hands on raw bytes as they arrive
+
+    Reads go straight to the urllib3 response: chunked bodies are relayed
+    one transfer chunk at a time, other bodies with read1(), which returns
+    whatever bytes are already available. There are no requests-level
+    generator layers and no re-chunking. Iteration is pull-based: nothing is read
+    from upstream until the client has taken the previous chunk, so a slow
+    client applies backpressure to the upstream socket. close(), called by
+    the WSGI server when the stream ends or the client disconnects, closes
+    the upstream connection straight away and frees its balancer target.
+
+    Also records time to first byte, chunk/byte counts and, for
+    OpenAI-compatible streams, the usage block of the final chunk, which
+    settles the call's tokens.
+    """
+
+    def __init__(self, response, call, scan_usage=False):
+        self.response = response
+        self.scan_usage = scan_usage
+        self.provider_id = getattr(response, 'upstream_provider', 'unknown')
+        self.started = getattr(response, 'upstream_started', time.monotonic())
+        self.request_tokens = call.tokens
+        self.trace = call.trace
+        self.span = self.trace.start_span('upstream.stream', provider=self.provider_id) if self.trace else None
+        self.chunks = 0
+        self.size = 0
+        self.closed = False
+        raw = response.raw
+        if getattr(raw, 'chunked', False) or not hasattr(raw, 'read1'):
+            content = raw.stream(None, decode_content=True)
+            self._read = lambda: next(content, b'')
+        else:
+            self._read = lambda: raw.read1(UPSTREAM_STREAM_READ_SIZE, decode_content=True)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        try:
+            chunk = self._read()
+        except Exception:
+            self.close()
+            raise
+        if not chunk:
+            self.close()
+            raise StopIteration
+        if self.chunks == 0:
+            metrics.observe(
+                'upstream_time_to_first_byte_seconds',
+                (('provider', self.provider_id),),
+                time.monotonic() - self.started
+            )
+        self.chunks += 1
+        self.size += len(chunk)
+        if self.scan_usage and b'"usage":{' in chunk:
+            record_stream_usage(self.provider_id, chunk, self.request_tokens)
+        return chunk
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        labels = (('provider', self.provider_id),)
+        metrics.inc('upstream_stream_chunks_total', labels, self.chunks)
+        metrics.inc('upstream_stream_bytes_total', labels, self.size)
+        metrics.observe('upstream_request_duration_seconds', labels, time.monotonic() - self.started)
+        if self.span is not None:
+            self.span.attributes.update(chunks=self.chunks, bytes=self.size)
+            self.trace.end_span(self.span)
+        finish_upstream(self.response)
+
+
+def passthrough_response(response, call):
+    """
+    Relay an OpenAI-compatible upstream stream to the client unchanged
+    The upstream bytes are handed to the WSGI server as-is (no parsing,
+    no request-context wrapper). Not direct_passthrough: the response's
+    own close() must still run its call_on_close() hooks.
+    """
+    return Response(
+        UpstreamStream(response, call, scan_usage=True),
+        status=response.status_code,
+        content_type=response.headers.get('content-type', 'text/event-stream'),
+        headers=SSE_HEADERS
+    )
+
+
+def record_stream_usage(provider_id, chunk, tokens=None):
+    """Count tokens from the usage block carried in an OpenAI SSE chunk"""
+    for line in chunk.split(b'\n'):
+        if line.startswith(b'data:') and b'"usage":{' in line:
+            try:
+                record_usage(provider_id, json_loads(line[5:]).get('usage'), tokens)
+            except ValueError:
+                pass
+
+
+# Decoder for the usage object at the tail of a raw completion body
+_usage_decoder = json.JSONDecoder()
+
+
+def extract_usage(body):
+    """
+    Parse only the top-level "usage" object out of a raw OpenAI-style body
+    Keys inside string values are escaped, so the last unescaped "usage"
+    key is the top-level one
+    """
+    start = body.rfind(b'"usage":')
+    if start < 0:
+        return None
+    tail = body[start + 8:start + 8 + 4096].decode('utf-8', 'replace').lstrip()
+    try:
+        usage, _ = _usage_decoder.raw_decode(tail)
+    except ValueError:
+        return None
+    return usage if isinstance(usage, dict) else None
+
+
+def relay_response(response, call):
+    """
+    Return an unmodified upstream JSON body to the client as raw bytes
+    Nothing but the usage block is parsed, so large completions are not
+    decoded and re-encoded on the way through
+    """
+    body = response.content
+    record_usage(getattr(response, 'upstream_provider', 'unknown'), extract_usage(body), call.tokens)
+    return Response(
+        body,
+        status=response.status_code,
+        content_type=response.headers.get('content-type', 'application/json')
+    )
+
+
+def finish_upstream(response):
+    """Close a streamed upstream response and free its balancer target"""
+    try:
+        response.close()
+    finally:
+        release = getattr(response, 'upstream_release', None)
+        if release is not None:
+            response.upstream_release = None
+            release()
+
+
+class RoutingTable:
+    """
+    Immutable model -> provider lookup built once from the provider registry
+    and the routes file: exact model IDs and aliases are dict lookups, other
+    names fall back to the longest registered prefix in a trie
+    """
+
+    _END = ''
+
+    def __init__(self, providers, models, extra_prefixes=None, aliases=None, fallbacks=None):
+        self.exact = {}
+        self.models = {}
+        self.aliases = dict(aliases or {})
+        self.fallbacks = dict(fallbacks or {})
+        self.trie = {}
+
+        for provider in providers.values():
+            for prefix in provider.prefixes + tuple((extra_prefixes or {}).get(provider.id, ())):
+                self._insert_prefix(prefix, provider.id)
+
+        for model in models:
+            provider_id = model.get('provider') or self._match_prefix(model['id']) or model.get('owned_by')
+            if provider_id not in providers:
+                continue
+            entry = {k: v for k, v in model.items() if k != 'provider'}
+            self.models[entry['id']] = entry
+            self.exact[entry['id']] = provider_id
+
+        self.model_list = list(self.models.values())
+        self.providers = providers
+
+        self.context_trie = {}
+        for prefix, window in MODEL_CONTEXT_WINDOWS.items():
+            self._insert_prefix(prefix, window, self.context_trie)
+
+    def _insert_prefix(self, prefix, value, trie=None):
+        node = self.trie if trie is None else trie
+        for ch in prefix:
+            node = node.setdefault(ch, {})
+        node[self._END] = value
+
+    def _match_prefix(self, model_id, trie=None):
+        node = self.trie if trie is None else trie
+        match = None
+        for ch in model_id:
+            node = node.get(ch)
+            if node is None:
+                break
+            match = node.get(self._END, match)
+        return match
+
+    def resolve(self, model_id):
+        """Return (provider, upstream model ID) or None"""
+        model_id = self.aliases.get(model_id, model_id)
+        provider_id = self.exact.get(model_id) or self._match_prefix(model_id)
+        if provider_id is None:
+            return None
+        return self.providers[provider_id], model_id
+
+    def fallbacks_for(self, model_id, provider_id):
+        """Fallback models for a model (or, failing that, for its provider)"""
+        return self.fallbacks.get(model_id) or self.fallbacks.get(provider_id) or ()
+
+    def get_model(self, model_id):
+        return self.models.get(self.aliases.get(model_id, model_id))
+
+    def context_window(self, model_id):
+        """Context window in tokens, or None when unknown"""
+        model = self.models.get(model_id)
+        if model is not None and model.get('context_window'):
+            return model['context_window']
+        return self._match_prefix(model_id, self.context_trie)
+
+
+def load_routes_file(path):
+    """
+    Read the routes file:
+    {"providers": {"<id>": {"prefixes": [...], "models": ["id" or {...}]}},
+     "aliases": {"<alias>": "<model id>"},
+     "fallbacks": {"<model id or provider id>": ["<model id>", ...]}}
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    models = []
+    prefixes = {}
+    for provider_id, spec in config.get('providers', {}).items():
+        prefixes[provider_id] = spec.get('prefixes', [])
+        for model in spec.get('models', []):
+            if isinstance(model, str):
+                model = {"id": model}
+            models.append({
+                "id": model['id'],
+                "object": "model",
+                "created": model.get('created', 0),
+                "owned_by": model.get('owned_by', provider_id),
+                "permission": [],
+                "root": model.get('root', model['id']),
+                "parent": model.get('parent'),
+                "provider": provider_id,
+            })
+            if model.get('context_window'):
+                models[-1]["context_window"] = int(model['context_window'])
+    return models, prefixes, config.get('aliases', {}), config.get('fallbacks', {})
+
+
+def build_routing_table():
+    models = list(AVAILABLE_MODELS)
+    prefixes = {}
+    aliases = {}
+    fallbacks = {}
+    if MODEL_ROUTES_FILE:
+        extra_models, prefixes, aliases, fallbacks = load_routes_file(MODEL_ROUTES_FILE)
+        models += extra_models
+    return RoutingTable(PROVIDERS, models, prefixes, aliases, fallbacks)
+
+
+_routing_table = None
+_routing_lock = threading.Lock()
+_routes_mtime = None
+_routes_checked = 0.0
+# mtime of a routes file that failed to load; it is not retried until it changes
+_routes_failed_mtime = None
+
+
+def _routes_file_mtime():
+    try:
+        return os.path.getmtime(MODEL_ROUTES_FILE) if MODEL_ROUTES_FILE else None
+    except OSError:
+        return None
+
+
+def reload_routing_table():
+    """Rebuild the routing table and swap it in atomically"""
+    global _routing_table, _routes_mtime
+    with _routing_lock:
+        mtime = _routes_file_mtime()
+        table = build_routing_table()
+        _routing_table = table
+        _routes_mtime = mtime
+    return table
+
+
+def get_routing_table():
+    """Current routing table, reloaded when the routes file changes"""
+    global _routes_checked, _routes_failed_mtime
+    table = _routing_table
+    if table is None:
+        return reload_routing_table()
+    if MODEL_ROUTES_FILE:
+        now = time.monotonic()
+        if now - _routes_checked >= MODEL_ROUTES_RELOAD_INTERVAL:
+            _routes_checked = now
+            mtime = _routes_file_mtime()
+            if mtime != _routes_mtime and mtime != _routes_failed_mtime:
+                try:
+                    table = reload_routing_table()
+                except (OSError, ValueError, KeyError) as e:
+                    # Keep serving the last good table; warn once per broken version of the file
+                    _routes_failed_mtime = mtime
+                    app.logger.warning("Failed to reload %s, keeping the current routes: %s", MODEL_ROUTES_FILE, e)
+    return table
+
+
+# Client-supplied request IDs are echoed back only if they look like IDs
+REQUEST_ID_CHARS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_.:')
+
+
+@app.before_request
+def start_request_trace():
+    """Assign the request ID and start a trace from any incoming traceparent"""
+    request_id = request.headers.get('X-Request-ID', '')
+    if not request_id or len(request_id) > 128 or not REQUEST_ID_CHARS.issuperset(request_id):
+        request_id = uuid.uuid4().hex
+    g.request_id = request_id
+    g.trace = tracer.start(request.headers.get('traceparent'), request.headers.get('tracestate'))
+
+
+@app.after_request
+def finish_request_trace(response):
+    """
+    Return the request ID (and Server-Timing, if enabled); the request
+    span ends when the response, including any stream, is closed
+    """
+    response.headers['X-Request-ID'] = g.request_id
+    trace = current_trace()
+    if trace is None:
+        return response
+    root = trace.root
+    root.attributes.update({
+        'http.method': request.method,
+        'http.route': request.url_rule.rule if request.url_rule is not None else 'unmatched',
+        'http.status_code': response.status_code,
+        'request.id': g.request_id,
+    })
+    root.error = response.status_code >= 500
+    if tracer.server_timing:
+        response.headers['Server-Timing'] = trace.server_timing()
+    response.call_on_close(trace.finish)
+    return response
+
+
+@app.before_request
+def start_request_metrics():
+    """Track in-flight requests and start the request timer"""
+    if not metrics.enabled:
+        return
+    rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    g.metrics_route = rule
+    g.metrics_started = time.perf_counter()
+    metrics.gauge_add('http_requests_in_flight', (('route', rule),), 1)
+
+
+@app.after_request
+def finish_request_metrics(response):
+    """Record status and latency once the response (including any stream) is closed"""
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    rule = g.metrics_route
+    method = request.method
+    status = str(response.status_code)
+
+    def record():
+        metrics.gauge_add('http_requests_in_flight', (('route', rule),), -1)
+        metrics.inc('http_requests_total', (('route', rule), ('method', method), ('status', status)))
+        metrics.observe('http_request_duration_seconds', (('route', rule),), time.perf_counter() - started)
+
+    response.call_on_close(record)
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    """
+    Compress buffered text/JSON responses with the client's best
+    Accept-Encoding match. Streams (SSE, passthrough, send_file) are
+    left as-is so every chunk still reaches the client immediately.
+    """
+    if not COMPRESSION_ENABLED or response.direct_passthrough or response.is_streamed:
+        return response
+    if not response.mimetype.startswith(COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'Content-Encoding' in response.headers or response.status_code < 200 or response.status_code in (204, 304):
+        return response
+    if request.method == 'HEAD' or (response.content_length or 0) < COMPRESSION_MIN_BYTES:
+        return response
+    encoding = request.accept_encodings.best_match(RESPONSE_ENCODINGS)
+    if encoding is None:
+        return response
+    data = response.get_data()
+    compressed = COMPRESSION_CODECS[encoding][0](data)
+    if len(compressed) >= len(data):
+        return response
+    labels = (('direction', 'response'), ('encoding', encoding))
+    metrics.inc('http_compression_bytes_total', labels + (('stage', 'original'),), len(data))
+    metrics.inc('http_compression_bytes_total', labels + (('stage', 'encoded'),), len(compressed))
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+class ProviderStatusProber:
+    """
+    Checks every AI provider concurrently on a schedule and caches the
+    results, so status requests are served from memory instead of each
+    viewer hitting the external sites. Status changes are published to
+    the stream subscribers from the same single probe loop; on the
+    threaded server at most max_subscribers of them are admitted.
+    """
+
+    def __init__(self, providers, interval, timeout, refresh_min_age=0, max_subscribers=0):
+        self.providers = providers
+        self.interval = interval
+        self.timeout = timeout
+        self.refresh_min_age = refresh_min_age
+        self.max_subscribers = max_subscribers
+        self.subscribers = 0
+        self.results = {}
+        # Monotonic time of each provider's last check, and one lock per
+        # provider so concurrent refreshes share a single probe
+        self.checked = {}
+        self.refresh_locks = {provider_id: threading.Lock() for provider_id in providers}
+        self.lock = threading.Lock()
+        self.changes = threading.Condition()
+        self.version = 0
+        self.events = deque(maxlen=256)
+        self.start_lock = threading.Lock()
+        self.thread = None
+        self.executor = ThreadPoolExecutor(max_workers=len(providers), thread_name_prefix='status-probe')
+
+    def probe(self, provider_id):
+        """Check one provider now and cache the result"""
+        provider = self.providers[provider_id]
+        started = time.monotonic()
+        try:
+            # Only the status line matters, so don't download the page body
+            response = get_upstream_pool('status').get(
+                provider['url'], timeout=self.timeout, allow_redirects=True, stream=True
+            )
+            response.close()
+            if response.status_code < 500:
+                status, message = "working", "Provider is accessible"
+            else:
+                status, message = "not-working", f"Provider returned error {response.status_code}"
+        except Exception as e:
+            status, message = "not-working", f"Cannot reach provider: {str(e)}"
+
+        result = {
+            "status": status,
+            "message": message,
+            "provider": provider['name'],
+            "checked_at": int(time.time()),
+            "latency_ms": round((time.monotonic() - started) * 1000, 1),
+        }
+        with self.lock:
+            previous = self.results.get(provider_id)
+            self.results[provider_id] = result
+            self.checked[provider_id] = time.monotonic()
+        # Latency jitter alone is not worth a push to every subscriber
+        if previous is None or previous['status'] != result['status']:
+            self._publish(provider_id, result)
+        return result
+
+    def refresh(self, provider_id):
+        """
+        Check one provider again, unless its cached result is younger than
+        refresh_min_age, so that clients cannot make the server probe the
+        providers at any rate they like
+        """
+        self.start()
+        with self.refresh_locks[provider_id]:
+            with self.lock:
+                fresh = time.monotonic() - self.checked.get(provider_id, float('-inf')) < self.refresh_min_age
+                if fresh:
+                    return self.results[provider_id]
+            return self.probe(provider_id)
+
+    def _publish(self, provider_id, result):
+        with self.changes:
+            self.version += 1
+            self.events.append((self.version, provider_id, result))
+            self.changes.notify_all()
+
+    def add_subscriber(self):
+        """Count a new stream subscriber; False when max_subscribers are already connected"""
+        with self.lock:
+            if self.max_subscribers and self.subscribers >= self.max_subscribers:
+                return False
+            self.subscribers += 1
+            return True
+
+    def remove_subscriber(self):
+        with self.lock:
+            self.subscribers -= 1
+
+    def serve_on_greenlets(self):
+        """
+        Lift the subscriber cap for the async server, where a stream is a
+        greenlet rather than a thread and ASYNC_MAX_CONNECTIONS bounds them
+        """
+        self.max_subscribers = 0
+
+    def subscribe(self, keepalive):
+        """
+        Yield SSE frames: a snapshot of every provider, then one frame per
+        status change, with keepalive comments while idle
+        """
+        self.start()
+        with self.changes:
+            version = self.version
+        yield b'event: snapshot\ndata: ' + json_dumps({"providers": self.get_all()}) + b'\n\n'
+
+        while True:
+            with self.changes:
+                if self.version == version:
+                    self.changes.wait(keepalive)
+                pending = [event for event in self.events if event[0] > version]
+                missed = bool(self.events) and self.events[0][0] > version + 1
+                version = self.version
+
+            if missed:
+                # Fell behind the event buffer: resend everything
+                yield b'event: snapshot\ndata: ' + json_dumps({"providers": self.get_all()}) + b'\n\n'
+            elif not pending:
+                yield b': keepalive\n\n'
+            else:
+                for _, provider_id, result in pending:
+                    payload = dict(result, id=provider_id)
+                    yield b'event: status\ndata: ' + json_dumps(payload) + b'\n\n'
+
+    def probe_all(self):
+        list(self.executor.map(self.probe, self.providers))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.probe_all()
+
+    def start(self):
+        """Run the first round of checks and start the background loop (once)"""
+        if self.thread is not None:
+            return
+        with self.start_lock:
+            if self.thread is not None:
+                return
+            self.probe_all()
+            self.thread = threading.Thread(target=self._run, name='status-prober', daemon=True)
+            self.thread.start()
+
+    def get(self, provider_id):
+        self.start()
+        with self.lock:
+            return self.results.get(provider_id)
+
+    def get_all(self):
+        self.start()
+        with self.lock:
+            return dict(self.results)
+
+
+provider_prober = ProviderStatusProber(
+    AI_PROVIDERS, PROVIDER_STATUS_INTERVAL, PROVIDER_STATUS_TIMEOUT,
+    PROVIDER_STATUS_REFRESH_MIN_AGE, PROVIDER_STATUS_MAX_SUBSCRIBERS
+)
+
+
+def key_owner(api_key):
+    """Owner tag for the files and batches created with an API key (raw keys are never stored)"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+
+def owner_api_key(owner):
+    """The configured API key behind an owner tag, or None once it is no longer accepted"""
+    for api_key in list(CLIENT_API_KEYS):
+        if key_owner(api_key) == owner:
+            return api_key
+    return None
+
+
+def public_object(obj):
+    """A file or batch object as returned to clients, without its owner tag"""
+    return {key: value for key, value in obj.items() if key != 'owner'}
+
+
+class FileStore:
+    """
+    Uploaded and generated files (OpenAI file objects) under <directory>/files
+    Each file is stored as <id>.jsonl next to an <id>.json metadata record,
+    which also holds the owner tag of the API key that created it
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.join(directory, 'files')
+        self.lock = threading.Lock()
+
+    def path(self, file_id):
+        return os.path.join(self.directory, f"{file_id}.jsonl")
+
+    def _meta_path(self, file_id):
+        return os.path.join(self.directory, f"{file_id}.json")
+
+    def create(self, filename, purpose, owner, upload=None):
+        """Store an upload (a werkzeug FileStorage), or an empty file to be written to"""
+        os.makedirs(self.directory, exist_ok=True)
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        if upload is not None:
+            upload.save(self.path(file_id))
+        else:
+            open(self.path(file_id), 'wb').close()
+        meta = {
+            "id": file_id,
+            "object": "file",
+            "bytes": os.path.getsize(self.path(file_id)),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "owner": owner,
+        }
+        self.save(meta)
+        return meta
+
+    def save(self, meta):
+        tmp_path = f"{self._meta_path(meta['id'])}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(json_dumps(meta))
+        os.replace(tmp_path, self._meta_path(meta['id']))
+
+    def get(self, file_id, owner):
+        """File metadata, or None when it does not exist or belongs to another owner"""
+        # IDs come from URLs: never let one name a path outside the store
+        if not file_id.startswith('file-') or not file_id[5:].isalnum():
+            return None
+        try:
+            with open(self._meta_path(file_id), 'rb') as f:
+                meta = json_loads(f.read())
+        except (OSError, ValueError):
+            return None
+        if meta.get('owner') != owner:
+            return None
+        try:
+            meta["bytes"] = os.path.getsize(self.path(file_id))
+        except OSError:
+            return None
+        return meta
+
+
+class BatchJob:
+    """One batch: its OpenAI batch object plus the state of a run in this process"""
+
+    def __init__(self, state):
+        self.state = state
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.futures = []
+        self.outputs = {}
+        self.saved_at = 0
+
+    @property
+    def id(self):
+        return self.state['id']
+
+    def snapshot(self):
+        with self.lock:
+            return json_loads(json_dumps(self.state))
+
+    def set_status(self, status, **fields):
+        with self.lock:
+            self.state['status'] = status
+            self.state[f'{status}_at'] = int(time.time())
+            self.state.update(fields)
+
+
+class BatchManager:
+    """
+    OpenAI-style batch jobs over /v1/chat/completions
+
+    A batch reads its input JSONL file and runs every request through
+    route_completion() on a bounded worker pool per provider. The pools are
+    shared by all batches, so a provider never sees more than
+    BATCH_CONCURRENCY batch requests at once, and a slow provider does not
+    hold up the others. Each result is appended to the output (or error)
+    JSONL file as soon as it completes. Batch state is saved to disk as it
+    runs. After a restart, unfinished batches resume and skip every
+    custom_id already written. A lock file makes sure that only one process
+    runs a given batch.
+
+    Batches and their files belong to the API key that created them; other
+    keys cannot see them. Every request is admitted through the owner's
+    rate limits before it is dispatched, and its tokens are charged to the
+    owner like those of a direct call.
+    """
+
+    def __init__(self, directory, concurrency):
+        self.directory = os.path.join(directory, 'batches')
+        self.files = FileStore(directory)
+        self.concurrency = concurrency
+        self.jobs = {}
+        self.executors = {}
+        self.lock = threading.Lock()
+        self.started = False
+
+    def _state_path(self, batch_id):
+        return os.path.join(self.directory, f"{batch_id}.json")
+
+    def start(self):
+        """Resume batches left unfinished by a previous run (once)"""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        self.resume()
+
+    def resume(self):
+        """
+        Launch every unfinished batch not already running in this process
+        Batches still locked by another process are skipped by _run().
+        """
+        if not os.path.isdir(self.directory):
+            return
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.json'):
+                continue
+            with self.lock:
+                if name[:-5] in self.jobs:
+                    continue
+            state = self._load(name[:-5])
+            if state is not None and state['status'] in ('validating', 'in_progress', 'finalizing', 'cancelling'):
+                self._launch(BatchJob(state))
+
+    def create(self, input_file_id, endpoint, completion_window, owner, metadata=None):
+        self.start()
+        os.makedirs(self.directory, exist_ok=True)
+        now = int(time.time())
+        state = {
+            "id": f"batch_{uuid.uuid4().hex[:24]}",
+            "object": "batch",
+            "endpoint": endpoint,
+            "errors": None,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": now,
+            "in_progress_at": None,
+            "expires_at": now + 24 * 3600,
+            "finalizing_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "expired_at": None,
+            "cancelling_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": metadata,
+            "owner": owner,
+        }
+        job = BatchJob(state)
+        self._save(job)
+        self._launch(job)
+        return public_object(job.snapshot())
+
+    def _state(self, batch_id, owner):
+        with self.lock:
+            job = self.jobs.get(batch_id)
+        state = job.snapshot() if job is not None else self._load(batch_id)
+        if state is None or state.get('owner') != owner:
+            return None
+        return state
+
+    def get(self, batch_id, owner):
+        self.start()
+        state = self._state(batch_id, owner)
+        return public_object(state) if state is not None else None
+
+    def list(self, owner, limit=20, after=None):
+        self.start()
+        states = []
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith('.json'):
+                    state = self._state(name[:-5], owner)
+                    if state is not None:
+                        states.append(public_object(state))
+        states.sort(key=lambda state: (state['created_at'], state['id']), reverse=True)
+        if after is not None:
+            ids = [state['id'] for state in states]
+            states = states[ids.index(after) + 1:] if after in ids else []
+        return states[:limit], len(states) > limit
+
+    def cancel(self, batch_id, owner):
+        """Stop dispatching new requests; in-flight ones finish and are kept"""
+        if self._state(batch_id, owner) is None:
+            return None
+        with self.lock:
+            job = self.jobs.get(batch_id)
+        if job is None:
+            state = self._load(batch_id)
+            if state is None or state['status'] not in ('validating', 'in_progress'):
+                return public_object(state) if state is not None else None
+            # Running in another process: it picks this up on its next save
+            job = BatchJob(state)
+            job.set_status('cancelling')
+            self._save(job)
+            return public_object(job.snapshot())
+        if job.state['status'] in ('validating', 'in_progress'):
+            job.set_status('cancelling')
+            self._cancel(job)
+            self._save(job)
+        return public_object(job.snapshot())
+
+    def _cancel(self, job):
+        job.cancelled.set()
+        for future in list(job.futures):
+            future.cancel()
+
+    def _load(self, batch_id):
+        if not batch_id.startswith('batch_') or not batch_id[6:].isalnum():
+            return None
+        try:
+            with open(self._state_path(batch_id), 'rb') as f:
+                return json_loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, job):
+        path = self._state_path(job.id)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(json_dumps(job.snapshot()))
+        os.replace(tmp_path, path)
+        job.saved_at = time.monotonic()
+
+    def _launch(self, job):
+        with self.lock:
+            self.jobs[job.id] = job
+        threading.Thread(target=self._run, args=(job,), name=f'batch-{job.id}', daemon=True).start()
+
+    def _executor(self, provider_id):
+        with self.lock:
+            executor = self.executors.get(provider_id)
+            if executor is None:
+                executor = ThreadPoolExecutor(
+                    max_workers=self.concurrency,
+                    thread_name_prefix=f'batch-{provider_id}'
+                )
+                self.executors[provider_id] = executor
+            return executor
+
+    def _acquire_run_lock(self, job):
+        """Exclusive lock on <id>.lock; None when another process holds it"""
+        handle = open(os.path.join(self.directory, f"{job.id}.lock"), 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                handle.close()
+                return None
+        return handle
+
+    def _run(self, job):
+        run_lock = self._acquire_run_lock(job)
+        if run_lock is None:
+            # Another process runs this batch; serve its saved state instead
+            with self.lock:
+                self.jobs.pop(job.id, None)
+            return
+        try:
+            self._process(job)
+        except Exception as e:
+            job.set_status('failed', errors={"object": "list", "data": [
+                {"code": "batch_failed", "message": str(e), "param": None, "line": None}
+            ]})
+        finally:
+            self._close_outputs(job)
+            self._save(job)
+            run_lock.close()
+            with self.lock:
+                self.jobs.pop(job.id, None)
+
+    def _process(self, job):
+        api_key = owner_api_key(job.state.get('owner'))
+        if api_key is None:
+            job.set_status('failed', errors={"object": "list", "data": [{
+                "code": "invalid_api_key",
+                "message": "The API key that created this batch is no longer accepted.",
+                "param": None,
+                "line": None
+            }]})
+            return
+
+        items, errors = self._read_input(job.state['input_file_id'])
+        if errors:
+            job.set_status('failed', errors={"object": "list", "data": errors[:100]})
+            return
+
+        if job.state['status'] == 'cancelling':
+            job.set_status('cancelled')
+            return
+
+        if job.state['output_file_id'] is None:
+            output = self.files.create(f"{job.id}_output.jsonl", 'batch_output', job.state['owner'])
+            error = self.files.create(f"{job.id}_error.jsonl", 'batch_output', job.state['owner'])
+            with job.lock:
+                job.state['output_file_id'] = output['id']
+                job.state['error_file_id'] = error['id']
+
+        # Resume: count and skip every request that already has a result
+        done = set()
+        counts = {"total": len(items), "completed": 0, "failed": 0}
+        for key, name in (('completed', 'output_file_id'), ('failed', 'error_file_id')):
+            path = self.files.path(job.state[name])
+            for custom_id in self._written_ids(path):
+                done.add(custom_id)
+                counts[key] += 1
+            job.outputs[key] = open(path, 'ab')
+
+        if job.state['status'] == 'validating':
+            job.set_status('in_progress', request_counts=counts)
+        else:
+            with job.lock:
+                job.state['request_counts'] = counts
+        self._save(job)
+
+        table = get_routing_table()
+        for custom_id, body in items:
+            if custom_id in done:
+                continue
+            if not self._admit(job, api_key):
+                break
+            route = table.resolve(body.get('model') or '') if isinstance(body, dict) else None
+            provider_id = route[0].id if route is not None else 'unrouted'
+            job.futures.append(self._executor(provider_id).submit(self._execute, job, custom_id, body, api_key))
+        wait(job.futures)
+
+        if job.cancelled.is_set():
+            job.set_status('cancelled')
+            return
+        job.set_status('finalizing')
+        self._save(job)
+        self._close_outputs(job)
+        job.set_status('completed')
+
+    def _admit(self, job, api_key):
+        """
+        Count one request against the owner's rate limits, waiting while they are used up
+        The wait happens here, before dispatch, so a limited key never holds
+        a provider worker that other batches could use. False once cancelled.
+        """
+        while rate_limiter is not None:
+            limited = rate_limiter.check_request(api_key)
+            if limited is None:
+                break
+            if job.cancelled.wait(limited[2]):
+                return False
+        return not job.cancelled.is_set()
+
+    def _read_input(self, file_id):
+        """Parse and validate the input file into (custom_id, body) pairs"""
+        errors = []
+        items = []
+        seen = set()
+
+        def error(code, message, line):
+            errors.append({"code": code, "message": message, "param": None, "line": line})
+
+        try:
+            f = open(self.files.path(file_id), 'rb')
+        except OSError:
+            error('invalid_file', f"Input file '{file_id}' not found", None)
+            return items, errors
+        with f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json_loads(line)
+                except ValueError:
+                    error('invalid_json_line', "This line is not parseable as valid JSON.", number)
+                    continue
+                if not isinstance(entry, dict) or not isinstance(entry.get('custom_id'), str):
+                    error('missing_required_parameter', "Missing required parameter: 'custom_id'.", number)
+                    continue
+                if entry.get('url') != '/v1/chat/completions' or entry.get('method', 'POST') != 'POST':
+                    error('invalid_url', "Only POST /v1/chat/completions requests are supported.", number)
+                    continue
+                if entry['custom_id'] in seen:
+                    error('duplicate_custom_id', "The custom_id for this request is a duplicate of another request.", number)
+                    continue
+                seen.add(entry['custom_id'])
+                items.append((entry['custom_id'], entry.get('body')))
+        if not items and not errors:
+            error('empty_file', "The input file contains no requests.", None)
+        return items, errors
+
+    def _written_ids(self, path):
+        """custom_ids already in a result file; a torn last line from a crash is cut off"""
+        ids = []
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return ids
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+        for line in data[:end].splitlines():
+            try:
+                ids.append(json_loads(line)['custom_id'])
+            except (ValueError, KeyError, TypeError):
+                continue
+        return ids
+
+    def _execute(self, job, custom_id, body, api_key):
+        if job.cancelled.is_set():
+            return
+        result = {"id": f"batch_req_{uuid.uuid4().hex[:24]}", "custom_id": custom_id, "response": None, "error": None}
+        try:
+            if not isinstance(body, dict) or not body.get('model') or not body.get('messages'):
+                raise ValueError("Request body must include 'model' and 'messages'")
+            # Runs as the owner, so its tokens are charged as for a direct call
+            call = CompletionCall(api_key)
+            with app.app_context():
+                response = app.make_response(route_completion(dict(body, stream=False), body['model'], False, call))
+            data = response.get_data()
+            try:
+                data = json_loads(data)
+            except ValueError:
+                data = data.decode('utf-8', 'replace')
+            result["response"] = {
+                "status_code": response.status_code,
+                "request_id": response.headers.get('x-request-id', result["id"]),
+                "body": data,
+            }
+            succeeded = response.status_code == 200
+        except Exception as e:
+            result["error"] = {"code": "request_failed", "message": str(e)}
+            succeeded = False
+        self._write_result(job, result, succeeded)
+
+    def _write_result(self, job, result, succeeded):
+        line = json_dumps(result) + b'\n'
+        key = 'completed' if succeeded else 'failed'
+        with job.lock:
+            output = job.outputs[key]
+            output.write(line)
+            output.flush()
+            job.state['request_counts'][key] += 1
+        # Save progress at most once a second; a cancel from another process is seen here
+        if time.monotonic() - job.saved_at >= 1:
+            state = self._load(job.id)
+            if state is not None and state['status'] == 'cancelling' and not job.cancelled.is_set():
+                job.set_status('cancelling')
+                self._cancel(job)
+            self._save(job)
+
+    def _close_outputs(self, job):
+        with job.lock:
+            outputs, job.outputs = job.outputs, {}
+        for output in outputs.values():
+            output.close()
+
+
+batch_manager = BatchManager(BATCH_DIR, BATCH_CONCURRENCY)
+
+
+def check_api_key():
+    """Authenticate the current request; returns an error response or None"""
+    # Check Authorization header
+    auth_header = request.headers.get('Authorization')
+    
+    if not auth_header:
+        return jsonify({
+            "error": {
+                "message": "Missing Authorization header",
+                "type": "invalid_request_error",
+                "param": None,
+                "code": "invalid_api_key"
+            }
+        }), 401
+    
+    # Expected format: "Bearer <API_KEY>"
+    if not auth_header.startswith('Bearer '):
+        return jsonify({
+            "error": {
+                "message": "Invalid Authorization header format. Expected 'Bearer <API_KEY>'",
+                "type": "invalid_request_error",
+                "param": None,
+                "code": "invalid_api_key"
+            }
+        }), 401
+    
+    provided_key = auth_header[7:]  # Remove "Bearer " prefix
+    
+    if provided_key not in CLIENT_API_KEYS:
+        return jsonify({
+            "error": {
+                "message": "Invalid API key provided",
+                "type": "invalid_request_error",
+                "param": None,
+                "code": "invalid_api_key"
+            }
+        }), 401
+    
+    g.client_key = provided_key
+    return None
+
+
+def require_api_key(f):
+    """Decorator to require API key authentication"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        with trace_span('auth'):
+            error = check_api_key()
+        if error is not None:
+            return error
+        return f(*args, **kwargs)
+    
+    return decorated_function
+
+
+def rate_limited(f):
+    """Decorator applying the calling key's request and token rate limits (after require_api_key)"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if rate_limiter is not None:
+            with trace_span('rate_limit'):
+                limited = rate_limiter.check_request(g.client_key)
+            if limited is not None:
+                limit_type, limit, retry_after = limited
+                return rate_limit_error(
+                    f"Rate limit reached for {limit_type} per minute (limit: {limit}). "
+                    f"Please try again in {retry_after:.1f}s.",
+                    retry_after,
+                    limit_type
+                )
+        return f(*args, **kwargs)
+    
+    return decorated_function
+
+
+@app.route('/')
+def index():
+    """Root endpoint - basic info"""
+    return jsonify({
+        "message": "OpenAI-Compatible Web Server",
+        "version": "1.0.0",
+        "endpoints": {
+            "models": "/v1/models",
+            "chat_completions": "/v1/chat/completions",
+            "access_panel": "/access"
+        }
+    })
+
+
+@app.route('/access')
+def access_panel():
+    """AI Provider Access Panel - HTML interface"""
+    return render_template('access.html')
+
+
+@app.route('/api/providers/status', methods=['GET'])
+def check_all_provider_status():
+    """
+    Status of every AI provider, served from the background prober's cache
+    """
+    return jsonify({
+        "providers": provider_prober.get_all(),
+        "interval": PROVIDER_STATUS_INTERVAL
+    })
+
+
+@app.route('/api/providers/status/stream', methods=['GET'])
+def stream_provider_status():
+    """
+    Server-sent events with provider status changes
+    All subscribers share the background prober's single probe loop. On
+    the threaded server each open stream occupies a thread, so their
+    number is capped by PROVIDER_STATUS_MAX_SUBSCRIBERS; with --async it
+    is not
+    """
+    if not provider_prober.add_subscriber():
+        response = jsonify({
+            "status": "error",
+            "message": "Too many status stream subscribers, poll /api/providers/status instead"
+        })
+        response.status_code = 503
+        response.headers['Retry-After'] = str(int(PROVIDER_STATUS_INTERVAL))
+        return response
+    response = Response(
+        provider_prober.subscribe(PROVIDER_STATUS_KEEPALIVE),
+        content_type='text/event-stream',
+        headers=SSE_HEADERS
+    )
+    response.call_on_close(provider_prober.remove_subscriber)
+    return response
+
+
+@app.route('/api/providers/<provider_id>/status', methods=['GET'])
+def check_provider_status(provider_id):
+    """
+    Check the status of an AI provider
+    Returns whether the provider is accessible, from the background
+    prober's cache (pass ?refresh=1 to check again, at most once every
+    PROVIDER_STATUS_REFRESH_MIN_AGE seconds)
+    """
+    if provider_id not in AI_PROVIDERS:
+        return jsonify({
+            "status": "error",
+            "message": "Unknown provider"
+        }), 404
+    
+    if request.args.get('refresh'):
+        return jsonify(provider_prober.refresh(provider_id))
+    
+    return jsonify(provider_prober.get(provider_id))
+
+
+@app.route('/api/providers/<provider_id>/session', methods=['GET'])
+def get_provider_session(provider_id):
+    """
+    Get session token for an AI provider
+    This is a placeholder implementation - real session token retrieval
+    would require browser automation or user authentication
+    """
+    if provider_id not in AI_PROVIDERS:
+        return jsonify({
+            "error": "Unknown provider"
+        }), 404
+    
+    provider = AI_PROVIDERS[provider_id]
+    
+    # Note: This is a placeholder implementation
+    # In a real-world scenario, you would need to:
+    # 1. Use browser automation (e.g., Selenium, Playwright) to login
+    # 2. Extract session cookies/tokens from the authenticated session
+    # 3. Store and manage these tokens securely
+    # 4. Handle token refresh when they expire
+    
+    return jsonify({
+        "token": f"[PLACEHOLDER-TOKEN-{provider_id.upper()}-{int(time.time())}]",
+        "message": "This is a placeholder token. Real implementation requires browser automation to extract actual session tokens.",
+        "provider": provider['name'],
+        "note": "Session token extraction requires user authentication and proper security measures"
+    })
+
+
+@app.route('/v1/models', methods=['GET'])
+@require_api_key
+def list_models():
+    """
+    List available models endpoint
+    Compatible with OpenAI's GET /v1/models endpoint
+    """
+    return jsonify({
+        "object": "list",
+        "data": get_routing_table().model_list
+    })
+
+
+@app.route('/v1/models/<model_id>', methods=['GET'])
+@require_api_key
+def get_model(model_id):
+    """
+    Get specific model details
+    Compatible with OpenAI's GET /v1/models/{model} endpoint
+    """
+    model = get_routing_table().get_model(model_id)
+    if model is not None:
+        return jsonify(model)
+    
+    return jsonify({
+        "error": {
+            "message": f"Model '{model_id}' not found",
+            "type": "invalid_request_error",
+            "param": None,
+            "code": "model_not_found"
+        }
+    }), 404
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus text-format metrics"""
+    upstream_gauges = [
+        ('upstream_in_flight', (('provider', provider_id),),
+         sum(target['in_flight'] for target in provider.balancer.stats()))
+        for provider_id, provider in sorted(PROVIDERS.items())
+        if provider.balancer is not None
+    ]
+    return Response(
+        metrics.render(upstream_gauges),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
+
+
+@app.route('/api/upstream/pools', methods=['GET'])
+@require_api_key
+def upstream_pool_stats():
+    """
+    Upstream connection pool statistics
+    Useful for sizing UPSTREAM_POOL_MAXSIZE
+    """
+    return jsonify({
+        "object": "list",
+        "data": [
+            dict(provider=name, **pool.stats())
+            for name, pool in sorted(_upstream_pools.items())
+        ]
+    })
+
+
+@app.route('/api/upstream/targets', methods=['GET'])
+@require_api_key
+def upstream_target_stats():
+    """
+    Per key/endpoint load balancing counters
+    Shows how traffic is spread and which targets are cooling down
+    """
+    return jsonify({
+        "object": "list",
+        "strategy": UPSTREAM_BALANCING,
+        "data": [
+            {"provider": provider_id, "targets": provider.balancer.stats()}
+            for provider_id, provider in sorted(PROVIDERS.items())
+            if provider.balancer is not None
+        ]
+    })
+
+
+@app.route('/api/routes/reload', methods=['POST'])
+@require_api_key
+def reload_routes():
+    """Rebuild the model routing table without restarting the server"""
+    try:
+        table = reload_routing_table()
+    except (OSError, ValueError, KeyError) as e:
+        return jsonify({
+            "error": {
+                "message": f"Failed to reload routes: {str(e)}",
+                "type": "server_error",
+                "param": None,
+                "code": "routes_reload_failed"
+            }
+        }), 500
+    
+    return jsonify({
+        "status": "reloaded",
+        "providers": sorted(table.providers),
+        "models": len(table.models),
+        "aliases": len(table.aliases)
+    })
+
+
+@app.route('/api/cache/stats', methods=['GET'])
+@require_api_key
+def response_cache_stats():
+    """Response cache hit/miss/eviction counters"""
+    if response_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(enabled=True, **response_cache.stats()))
+
+
+@app.route('/api/coalescing/stats', methods=['GET'])
+@require_api_key
+def request_coalescing_stats():
+    """Request coalescing counters"""
+    if request_coalescer is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(enabled=True, **request_coalescer.stats()))
+
+
+@app.route('/api/rate-limits', methods=['GET'])
+@require_api_key
+def rate_limit_status():
+    """Limits and remaining budget for the calling API key"""
+    if rate_limiter is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(enabled=True, **rate_limiter.status(g.client_key)))
+
+
+@app.route('/v1/files', methods=['POST'])
+@require_api_key
+def upload_file():
+    """
+    Upload a JSONL file of batch requests
+    Compatible with OpenAI's POST /v1/files endpoint (multipart form with file and purpose)
+    """
+    upload = request.files.get('file')
+    purpose = request.form.get('purpose')
+    if upload is None:
+        return jsonify({
+            "error": {
+                "message": "Missing required parameter: 'file'",
+                "type": "invalid_request_error",
+                "param": "file",
+                "code": "missing_parameter"
+            }
+        }), 400
+    if purpose != 'batch':
+        return jsonify({
+            "error": {
+                "message": "Only files with purpose 'batch' are supported",
+                "type": "invalid_request_error",
+                "param": "purpose",
+                "code": "invalid_purpose"
+            }
+        }), 400
+    meta = batch_manager.files.create(upload.filename or 'upload.jsonl', purpose, key_owner(g.client_key), upload)
+    return jsonify(public_object(meta))
+
+
+@app.route('/v1/files/<file_id>', methods=['GET'])
+@require_api_key
+def get_file(file_id):
+    """Compatible with OpenAI's GET /v1/files/{file_id} endpoint"""
+    meta = batch_manager.files.get(file_id, key_owner(g.client_key))
+    if meta is None:
+        return jsonify({
+            "error": {
+                "message": f"No such File object: {file_id}",
+                "type": "invalid_request_error",
+                "param": "file_id",
+                "code": "file_not_found"
+            }
+        }), 404
+    return jsonify(public_object(meta))
+
+
+@app.route('/v1/files/<file_id>/content', methods=['GET'])
+@require_api_key
+def get_file_content(file_id):
+    """
+    Raw JSONL content of a file
+    Batch output files can be read while the batch is still running
+    """
+    meta = batch_manager.files.get(file_id, key_owner(g.client_key))
+    if meta is None:
+        return jsonify({
+            "error": {
+                "message": f"No such File object: {file_id}",
+                "type": "invalid_request_error",
+                "param": "file_id",
+                "code": "file_not_found"
+            }
+        }), 404
+    return send_file(batch_manager.files.path(file_id), mimetype='application/jsonl', conditional=False, etag=False)
+
+
+@app.route('/v1/batches', methods=['POST'])
+@require_api_key
+@rate_limited
+def create_batch():
+    """
+    Create a batch from an uploaded JSONL file
+    Compatible with OpenAI's POST /v1/batches endpoint
+    """
+    data = request.get_json(silent=True) or {}
+    input_file_id = data.get('input_file_id')
+    owner = key_owner(g.client_key)
+    meta = batch_manager.files.get(input_file_id, owner) if isinstance(input_file_id, str) else None
+    if meta is None or meta['purpose'] != 'batch':
+        return jsonify({
+            "error": {
+                "message": f"Invalid 'input_file_id': '{input_file_id}'. No batch input file with that ID exists.",
+                "type": "invalid_request_error",
+                "param": "input_file_id",
+                "code": "invalid_file"
+            }
+        }), 400
+    if data.get('endpoint') != '/v1/chat/completions':
+        return jsonify({
+            "error": {
+                "message": "Invalid 'endpoint': only '/v1/chat/completions' is supported",
+                "type": "invalid_request_error",
+                "param": "endpoint",
+                "code": "invalid_endpoint"
+            }
+        }), 400
+    if data.get('completion_window') != '24h':
+        return jsonify({
+            "error": {
+                "message": "Invalid 'completion_window': only '24h' is supported",
+                "type": "invalid_request_error",
+                "param": "completion_window",
+                "code": "invalid_completion_window"
+            }
+        }), 400
+    return jsonify(batch_manager.create(
+        input_file_id, data['endpoint'], data['completion_window'], owner, data.get('metadata')
+    ))
+
+
+@app.route('/v1/batches', methods=['GET'])
+@require_api_key
+def list_batches():
+    """Compatible with OpenAI's GET /v1/batches endpoint (limit and after)"""
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    batches, has_more = batch_manager.list(key_owner(g.client_key), limit, request.args.get('after'))
+    return jsonify({
+        "object": "list",
+        "data": batches,
+        "first_id": batches[0]['id'] if batches else None,
+        "last_id": batches[-1]['id'] if batches else None,
+        "has_more": has_more
+    })
+
+
+@app.route('/v1/batches/<batch_id>', methods=['GET'])
+@require_api_key
+def get_batch(batch_id):
+    """
+    Batch status, with request_counts updated as results are written
+    Compatible with OpenAI's GET /v1/batches/{batch_id} endpoint
+    """
+    batch = batch_manager.get(batch_id, key_owner(g.client_key))
+    if batch is None:
+        return jsonify({
+            "error": {
+                "message": f"No such Batch object: {batch_id}",
+                "type": "invalid_request_error",
+                "param": "batch_id",
+                "code": "batch_not_found"
+            }
+        }), 404
+    return jsonify(batch)
+
+
+@app.route('/v1/batches/<batch_id>/cancel', methods=['POST'])
+@require_api_key
+def cancel_batch(batch_id):
+    """Compatible with OpenAI's POST /v1/batches/{batch_id}/cancel endpoint"""
+    batch = batch_manager.cancel(batch_id, key_owner(g.client_key))
+    if batch is None:
+        return jsonify({
+            "error": {
+                "message": f"No such Batch object: {batch_id}",
+                "type": "invalid_request_error",
+                "param": "batch_id",
+                "code": "batch_not_found"
+            }
+        }), 404
+    return jsonify(batch)
+
+
+@app.route('/v1/chat/completions', methods=['POST'])
+@require_api_key
+@rate_limited
+def chat_completions():
+    """
+    Chat completions endpoint
+    Compatible with OpenAI's POST /v1/chat/completions endpoint
+    Forwards requests to configured AI providers based on the model
+    """
+    try:
+        with trace_span('parse'):
+            data = request.get_json()
+        
+        if not data:
+            return jsonify({
+                "error": {
+                    "message": "Request body is required",
+                    "type": "invalid_request_error",
+                    "param": None,
+                    "code": "invalid_request"
+                }
+            }), 400
+        
+        model = data.get('model')
+        messages = data.get('messages', [])
+        stream = data.get('stream', False)
+        
+        if not model:
+            return jsonify({
+                "error": {
+                    "message": "Missing required parameter: 'model'",
+                    "type": "invalid_request_error",
+                    "param": "model",
+                    "code": "missing_parameter"
+                }
+            }), 400
+        
+        if not messages:
+            return jsonify({
+                "error": {
+                    "message": "Missing required parameter: 'messages'",
+                    "type": "invalid_request_error",
+                    "param": "messages",
+                    "code": "missing_parameter"
+                }
+            }), 400
+        
+        # Serve deterministic requests from the response cache when enabled
+        cache_key = None
+        if response_cache is not None and is_cacheable(data) \
+                and 'no-cache' not in request.headers.get('Cache-Control', ''):
+            cache_key = response_cache.make_key(data, key_owner(g.client_key))
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                return cached.to_response()
+        
+        # Streams hold one of the key's concurrent stream slots until they close
+        stream_key = None
+        if stream and rate_limiter is not None:
+            if not rate_limiter.open_stream(g.client_key):
+                limit = rate_limiter.limits_for(g.client_key).max_streams
+                return rate_limit_error(
+                    f"Too many concurrent streams (limit: {limit}). Please try again once a stream has finished.",
+                    1
+                )
+            stream_key = g.client_key
+        
+        call = CompletionCall(g.client_key, current_trace())
+        try:
+            if request_coalescer is not None:
+                # Only requests from the same API key share a flight (cache keys are per key too),
+                # so every key pays for its own completions and sees only its own upstream errors
+                result = request_coalescer.run(
+                    cache_key or request_fingerprint(data, owner=key_owner(g.client_key)),
+                    lambda: route_completion(data, model, stream, call)
+                )
+            else:
+                result = route_completion(data, model, stream, call)
+            
+            if cache_key is not None:
+                result = response_cache.store_response(cache_key, result)
+            if stream_key is not None:
+                result = app.make_response(result)
+                result.call_on_close(lambda: rate_limiter.close_stream(stream_key))
+        except Exception:
+            if stream_key is not None:
+                rate_limiter.close_stream(stream_key)
+            raise
+        return result
+    
+    except Exception as e:
+        return jsonify({
+            "error": {
+                "message": f"Internal server error: {str(e)}",
+                "type": "server_error",
+                "param": None,
+                "code": "internal_error"
+            }
+        }), 500
+
+
+def route_completion(data, model, stream, call):
+    """
+    Route a chat completion to the provider that serves the model
+    Needs an app context but no request context: everything about the
+    caller comes in the CompletionCall
+    """
+    table = get_routing_table()
+    route = table.resolve(model)
+    
+    if route is None:
+        return jsonify({
+            "error": {
+                "message": f"Model '{model}' is not supported",
+                "type": "invalid_request_error",
+                "param": "model",
+                "code": "model_not_supported"
+            }
+        }), 400
+    
+    provider, upstream_model = route
+    
+    if not provider.api_keys:
+        return jsonify({
+            "error": {
+                "message": f"{provider.label} API key not configured. Please set {provider.api_key_env} in .env file",
+                "type": "invalid_request_error",
+                "param": None,
+                "code": "api_key_not_configured"
+            }
+        }), 500
+    
+    call.annotate(**{'llm.model': upstream_model, 'llm.provider': provider.id, 'llm.stream': bool(stream)})
+    with call.span('precheck'):
+        prompt_tokens, exact = token_estimator.count_messages(data.get('messages') or [], provider.id, upstream_model)
+    if TOKEN_PRECHECK:
+        window = table.context_window(upstream_model)
+        max_tokens = data.get('max_completion_tokens') or data.get('max_tokens') or 0
+        if not isinstance(max_tokens, int):
+            max_tokens = 0
+        # Estimated counts get the benefit of the doubt
+        checked_tokens = prompt_tokens if exact else int(prompt_tokens / (1 + TOKEN_ESTIMATE_TOLERANCE))
+        if window and checked_tokens + max_tokens > window:
+            return jsonify({
+                "error": {
+                    "message": f"This model's maximum context length is {window} tokens. However, you requested "
+                               f"about {prompt_tokens + max_tokens} tokens ({prompt_tokens} in the messages, "
+                               f"{max_tokens} in the completion). Please reduce the length of the messages or completion.",
+                    "type": "invalid_request_error",
+                    "param": "messages",
+                    "code": "context_length_exceeded"
+                }
+            }), 400
+    call.tokens = RequestTokens(call.client_key, provider.id, prompt_tokens, exact)
+    
+    if upstream_model != model:
+        data = dict(data, model=upstream_model)
+    
+    result = provider.forward(data, stream, call)
+    
+    # Non-streaming calls that still fail after retries move down the fallback chain
+    fallbacks = () if stream else table.fallbacks_for(upstream_model, provider.id)
+    for fallback_model in fallbacks:
+        response = app.make_response(result)
+        if response.status_code not in RETRYABLE_STATUS_CODES:
+            return response
+        fallback_route = table.resolve(fallback_model)
+        if fallback_route is None or not fallback_route[0].api_keys:
+            continue
+        fallback_provider, fallback_upstream_model = fallback_route
+        result = app.make_response(fallback_provider.forward(dict(data, model=fallback_upstream_model), False, call))
+        result.headers['X-Fallback-Model'] = fallback_upstream_model
+    
+    return result
+
+
+# Streaming (SSE) helpers
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+}
+
+# Anthropic stop_reason -> OpenAI finish_reason
+ANTHROPIC_FINISH_REASONS = {
+    'end_turn': 'stop',
+    'stop_sequence': 'stop',
+    'max_tokens': 'length',
+    'tool_use': 'tool_calls',
+}
+
+
+# Gemini finishReason -> OpenAI finish_reason
+GEMINI_FINISH_REASONS = {
+    'STOP': 'stop',
+    'MAX_TOKENS': 'length',
+    'SAFETY': 'content_filter',
+    'RECITATION': 'content_filter',
+    'BLOCKLIST': 'content_filter',
+    'PROHIBITED_CONTENT': 'content_filter',
+    'SPII': 'content_filter',
+}
+
+
+def iter_sse_events(chunks):
+    """
+    Parse a server-sent event stream incrementally
+    Yields (event, data) tuples as soon as each event is complete,
+    without waiting for the rest of the body
+    """
+    buffer = b''
+    event = None
+    data_lines = []
+    for chunk in chunks:
+        if not chunk:
+            continue
+        # Split each chunk once; the last piece is an incomplete line
+        lines = (buffer + chunk).split(b'\n')
+        buffer = lines.pop()
+        for line in lines:
+            line = line.rstrip(b'\r')
+            if not line:
+                if data_lines:
+                    yield event, b'\n'.join(data_lines).decode('utf-8')
+                event = None
+                data_lines = []
+            elif line.startswith(b'event:'):
+                event = line[6:].strip().decode('utf-8')
+            elif line.startswith(b'data:'):
+                data_lines.append(line[5:].lstrip())
+    if data_lines:
+        yield event, b'\n'.join(data_lines).decode('utf-8')
+
+
+def sse_frame(payload):
+    """Encode a payload as an OpenAI-style SSE data frame"""
+    return b'data: ' + json_dumps(payload) + b'\n\n'
+
+
+SSE_DONE = b'data: [DONE]\n\n'
+
+
+def make_chunk(completion_id, model, created, delta, finish_reason=None):
+    """Build an OpenAI chat.completion.chunk object"""
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "delta": delta,
+            "finish_reason": finish_reason
+        }]
+    }
+
+
+def upstream_stream_failure(error):
+    """OpenAI-style error for an upstream stream that broke off"""
+    return {
+        "message": f"Upstream stream interrupted: {error}",
+        "type": "server_error",
+        "param": None,
+        "code": "upstream_stream_interrupted"
+    }
+
+
+def usage_chunk(completion_id, model, created, usage):
+    """The final chat.completion.chunk that carries usage and no choices"""
+    chunk = make_chunk(completion_id, model, created, {})
+    chunk["choices"] = []
+    chunk["usage"] = usage
+    return chunk
+
+
+# Completion events yielded by the provider stream translators, as
+# (kind, value) tuples: ('start', completion_id), ('content', text),
+# ('tool_call', OpenAI tool call delta), ('finish', finish_reason),
+# ('error', error) and finally ('usage', OpenAI usage). They are small
+# enough to be built per token, and are turned into chunk frames for
+# streaming clients or accumulated directly by assemble_completion().
+
+def anthropic_completion_events(chunks, tokens=None):
+    """
+    Translate Anthropic's native event stream into completion events
+    Each text delta becomes its own event the moment it is parsed. An
+    error event, or an upstream connection that breaks off, becomes an
+    'error' event. Usage is recorded (and settles tokens, a RequestTokens)
+    either way and sent last.
+    """
+    usage = {}
+    # Anthropic content block index -> OpenAI tool call index
+    tool_indexes = {}
+
+    try:
+        for event, raw in iter_sse_events(chunks):
+            try:
+                payload = json_loads(raw)
+            except ValueError:
+                continue
+            event_type = payload.get('type', event)
+
+            if event_type == 'content_block_delta':
+                delta = payload.get('delta', {})
+                if delta.get('type') == 'text_delta':
+                    yield 'content', delta.get('text', '')
+                elif delta.get('type') == 'input_json_delta' and payload.get('index') in tool_indexes:
+                    yield 'tool_call', {
+                        "index": tool_indexes[payload['index']],
+                        "function": {"arguments": delta.get('partial_json', '')}
+                    }
+
+            elif event_type == 'message_start':
+                message = payload.get('message', {})
+                usage = dict(message.get('usage') or {})
+                yield 'start', f"chatcmpl-{message.get('id', '')}"
+
+            elif event_type == 'content_block_start':
+                block = payload.get('content_block', {})
+                if block.get('type') == 'tool_use':
+                    tool_index = tool_indexes[payload.get('index')] = len(tool_indexes)
+                    yield 'tool_call', {
+                        "index": tool_index,
+                        "id": block.get('id'),
+                        "type": "function",
+                        "function": {"name": block.get('name'), "arguments": ""}
+                    }
+
+            elif event_type == 'message_delta':
+                stop_reason = payload.get('delta', {}).get('stop_reason')
+                usage.update(payload.get('usage') or {})
+                if stop_reason:
+                    yield 'finish', ANTHROPIC_FINISH_REASONS.get(stop_reason, 'stop')
+
+            elif event_type == 'message_stop':
+                break
+
+            elif event_type == 'error':
+                yield 'error', payload.get('error', {})
+                break
+    except (OSError, urllib3.exceptions.HTTPError) as e:
+        yield 'error', upstream_stream_failure(e)
+
+    openai_usage = anthropic_usage(usage)
+    record_usage('anthropic', openai_usage, tokens)
+    yield 'usage', openai_usage
+
+
+def gemini_completion_events(chunks, model, prompt_tokens=0, tokens=None):
+    """
+    Translate Gemini streamGenerateContent (alt=sse) events into completion events
+    Every partial candidate is emitted as soon as it arrives. When Gemini
+    sends no usageMetadata, usage is estimated locally (prompt_tokens is
+    the caller's estimate for the prompt). Errors and usage are handled
+    as in anthropic_completion_events().
+    """
+    usage = {}
+    # Local completion estimate, summed per piece so the text is not kept
+    completion_tokens = 0
+    started = False
+    tool_calls = 0
+
+    try:
+        for _, raw in iter_sse_events(chunks):
+            try:
+                payload = json_loads(raw)
+            except ValueError:
+                continue
+
+            if 'error' in payload:
+                yield 'error', payload['error']
+                break
+
+            usage = payload.get('usageMetadata', usage)
+            candidates = payload.get('candidates') or [{}]
+            candidate = candidates[0]
+
+            text, function_calls = gemini_candidate_parts(candidate)
+            if not started:
+                yield 'start', f"chatcmpl-{int(time.time())}"
+                started = True
+            if text:
+                completion_tokens += token_estimator.count_text(text, 'google', model, memo=False)
+                yield 'content', text
+            # Gemini sends each function call whole, in a single part
+            for call in function_calls:
+                tool_call = openai_tool_call(tool_call_id(), call.get('name'), call.get('args') or {})
+                completion_tokens += token_estimator.count_text(tool_call['function']['arguments'], 'google', model, memo=False)
+                yield 'tool_call', {"index": tool_calls, **tool_call}
+                tool_calls += 1
+
+            finish_reason = candidate.get('finishReason')
+            if finish_reason and finish_reason != 'FINISH_REASON_UNSPECIFIED':
+                yield 'finish', 'tool_calls' if tool_calls and finish_reason == 'STOP' else GEMINI_FINISH_REASONS.get(finish_reason, 'stop')
+    except (OSError, urllib3.exceptions.HTTPError) as e:
+        yield 'error', upstream_stream_failure(e)
+
+    openai_usage = gemini_usage(usage, prompt_tokens, completion_tokens)
+    record_usage('google', openai_usage, tokens)
+    yield 'usage', openai_usage
+
+
+def encode_completion_events(events, model, include_usage=False):
+    """
+    OpenAI chat.completion.chunk SSE frames for completion events, ending with [DONE]
+    An error is sent as an {"error": ...} frame. The usage chunk is only
+    sent when the client asked for it (stream_options.include_usage)
+    """
+    completion_id = f"chatcmpl-{int(time.time())}"
+    created = int(time.time())
+    for kind, value in events:
+        if kind == 'content':
+            yield sse_frame(make_chunk(completion_id, model, created, {"content": value}))
+        elif kind == 'tool_call':
+            yield sse_frame(make_chunk(completion_id, model, created, {"tool_calls": [value]}))
+        elif kind == 'start':
+            completion_id = value
+            yield sse_frame(make_chunk(completion_id, model, created, {"role": "assistant", "content": ""}))
+        elif kind == 'finish':
+            yield sse_frame(make_chunk(completion_id, model, created, {}, value))
+        elif kind == 'error':
+            yield sse_frame({"error": value})
+        elif kind == 'usage' and include_usage:
+            yield sse_frame(usage_chunk(completion_id, model, created, value))
+    yield SSE_DONE
+
+
+def translate_anthropic_stream(chunks, model, include_usage=False, tokens=None):
+    """Translate Anthropic's native event stream into OpenAI chunk frames"""
+    return encode_completion_events(anthropic_completion_events(chunks, tokens), model, include_usage)
+
+
+def translate_gemini_stream(chunks, model, include_usage=False, prompt_tokens=0, tokens=None):
+    """Translate Gemini streamGenerateContent events into OpenAI chunk frames"""
+    return encode_completion_events(
+        gemini_completion_events(chunks, model, prompt_tokens, tokens), model, include_usage
+    )
+
+
+def assemble_completion(events, model):
+    """
+    Build a non-streaming chat.completion from completion events
+
+    Content and tool call arguments are appended to UTF-8 buffers (not
+    kept as thousands of small strings) and decoded once at the end, and
+    each upstream chunk is dropped as soon as it has been parsed, so the
+    raw upstream body and a parsed copy of it are never held at the same
+    time. Returns (completion, error). If the stream failed after some
+    output arrived, the completion holds that output with finish_reason
+    None and error describes the failure; if it failed before any output,
+    completion is None.
+    """
+    content = bytearray()
+    # OpenAI tool call index -> call, arguments collected like the content
+    tool_calls = {}
+    completion_id = f"chatcmpl-{int(time.time())}"
+    created = int(time.time())
+    finish_reason = None
+    usage = None
+    error = None
+    for kind, value in events:
+        if kind == 'content':
+            content += value.encode('utf-8')
+        elif kind == 'tool_call':
+            entry = tool_calls.get(value['index'])
+            if entry is None:
+                entry = tool_calls[value['index']] = (value.get('id'), value['function'].get('name'), bytearray())
+            entry[2].extend(value['function'].get('arguments', '').encode('utf-8'))
+        elif kind == 'start':
+            completion_id = value
+        elif kind == 'finish':
+            finish_reason = value
+        elif kind == 'usage':
+            usage = value
+        elif kind == 'error':
+            error = value
+    text = content.decode('utf-8')
+    del content
+    if error is not None and not text and not tool_calls:
+        return None, error
+    message = {"role": "assistant", "content": text if text or not tool_calls else None}
+    if tool_calls:
+        message['tool_calls'] = [
+            {
+                "id": call_id,
+                "type": "function",
+                "function": {"name": name, "arguments": arguments.decode('utf-8')}
+            }
+            for call_id, name, arguments in (tool_calls[index] for index in sorted(tool_calls))
+        ]
+    completion = {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": created,
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": message,
+            "finish_reason": None if error is not None else finish_reason or 'stop'
+        }],
+        "usage": usage
+    }
+    return completion, error
+
+
+def assembled_response(upstream, events, model, call):
+    """
+    Response for a non-streaming request that was streamed from upstream
+    Content that arrived before an upstream failure is still returned,
+    marked with an X-Upstream-Error header; a failure before any content
+    is a 502.
+    """
+    try:
+        with call.span('convert.response'):
+            completion, error = assemble_completion(events, model)
+    finally:
+        upstream.close()
+    if completion is None:
+        return jsonify({"error": error}), 502
+    response = jsonify(completion)
+    if error is not None:
+        response.headers['X-Upstream-Error'] = error.get('code') or error.get('type') or 'error'
+    return response
+
+
+def anthropic_usage(usage):
+    """
+    OpenAI usage from an Anthropic usage block
+    Anthropic's input_tokens leave out cached tokens: prompt_tokens adds
+    cache reads and writes back in, and cache reads are reported as
+    prompt_tokens_details.cached_tokens
+    """
+    cached = usage.get('cache_read_input_tokens') or 0
+    prompt = (usage.get('input_tokens') or 0) + cached + (usage.get('cache_creation_input_tokens') or 0)
+    completion = usage.get('output_tokens') or 0
+    return {
+        "prompt_tokens": prompt,
+        "completion_tokens": completion,
+        "total_tokens": prompt + completion,
+        "prompt_tokens_details": {"cached_tokens": cached}
+    }
+
+
+def gemini_usage(usage_metadata, prompt_tokens, completion_tokens):
+    """OpenAI usage from Gemini's usageMetadata, falling back to local estimates where a count is missing"""
+    prompt = usage_metadata.get('promptTokenCount')
+    if prompt is None:
+        prompt = prompt_tokens
+    completion = usage_metadata.get('candidatesTokenCount')
+    if completion is None:
+        completion = completion_tokens
+    return {
+        "prompt_tokens": prompt,
+        "completion_tokens": completion,
+        "total_tokens": usage_metadata.get('totalTokenCount') or prompt + completion
+    }
+
+
+# Request and response conversion between OpenAI chat completions and the
+# Anthropic Messages / Gemini generateContent formats
+
+class ConversionError(ValueError):
+    """An OpenAI request that cannot be expressed in the provider's format"""
+
+    def __init__(self, message, param=None):
+        super().__init__(message)
+        self.param = param
+
+
+def conversion_error_response(error):
+    """400 response for a ConversionError"""
+    return jsonify({
+        "error": {
+            "message": str(error),
+            "type": "invalid_request_error",
+            "param": error.param,
+            "code": "unsupported_content"
+        }
+    }), 400
+
+
+def parse_data_url(url, param):
+    """
+    (media_type, base64_data) of a base64 data: URL
+    The payload is sliced out as it is: it is never decoded and
+    re-encoded, both providers take the same base64 text.
+    """
+    # Only the header is searched, not a multi-megabyte payload
+    comma = url.find(',', 5, 5 + 256)
+    header = url[5:comma] if comma > 0 else ''
+    if not header.endswith(';base64'):
+        raise ConversionError("Data URLs must be base64-encoded (data:<media type>;base64,...)", param)
+    return header[:-7] or 'application/octet-stream', url[comma + 1:]
+
+
+def image_source(part, param):
+    """
+    (media_type, base64_data, url) of an OpenAI image_url content part
+    Exactly one of base64_data and url is set; media_type is guessed from
+    the URL path for remote images and may be None.
+    """
+    image = part.get('image_url')
+    url = image.get('url') if isinstance(image, dict) else image
+    if not isinstance(url, str) or not url:
+        raise ConversionError("Image content parts need an image_url.url", param)
+    if url.startswith('data:'):
+        media_type, data = parse_data_url(url, param)
+        return media_type, data, None
+    if url.startswith(('http://', 'https://')):
+        return mimetypes.guess_type(url.split('?', 1)[0])[0], None, url
+    raise ConversionError("Image URLs must be http(s) or base64 data: URLs", param)
+
+
+def file_source(part, param):
+    """(media_type, base64_data) of an OpenAI file content part with inline file_data"""
+    file = part.get('file') or {}
+    file_data = file.get('file_data')
+    if not isinstance(file_data, str) or not file_data:
+        raise ConversionError("File content parts need inline file_data (file_id is not supported)", param)
+    if file_data.startswith('data:'):
+        return parse_data_url(file_data, param)
+    # Plain base64 without a data: header, as the OpenAI SDKs send for PDFs
+    return mimetypes.guess_type(file.get('filename') or '')[0] or 'application/pdf', file_data
+
+
+def content_parts(content, param):
+    """(index, type, part) for each part of an OpenAI message content array"""
+    if not isinstance(content, list):
+        raise ConversionError("Message content must be a string or an array of content parts", param)
+    for index, part in enumerate(content):
+        kind = part.get('type') if isinstance(part, dict) else None
+        yield f"{param}[{index}]", kind, part
+
+
+def tool_arguments(call, param):
+    """The arguments object of an OpenAI tool call (sent as a JSON string)"""
+    arguments = (call.get('function') or {}).get('arguments') or '{}'
+    if isinstance(arguments, dict):
+        return arguments
+    try:
+        value = json_loads(arguments)
+    except ValueError:
+        value = None
+    if not isinstance(value, dict):
+        raise ConversionError("Tool call arguments must be a JSON object", param)
+    return value
+
+
+def tool_call_id():
+    """ID for a tool call whose provider does not assign one (Gemini)"""
+    return f"call_{uuid.uuid4().hex[:24]}"
+
+
+def openai_tool_call(call_id, name, arguments):
+    """OpenAI tool call with the arguments object serialized as a JSON string"""
+    return {
+        "id": call_id,
+        "type": "function",
+        "function": {"name": name, "arguments": json_dumps(arguments).decode('utf-8')}
+    }
 
 
-@app.route('/v1/models', methods=['GET'])
-@require_api_key
-def list_models():
-    """
-    List available models endpoint
-    Compatible with OpenAI's GET /v1/models endpoint
-    """
-    return jsonify({
-        "object": "list",
-        "data": AVAILABLE_MODELS
-    })
+def function_tools(data):
+    """(name, description, parameters) of every function tool in an OpenAI request"""
+    for index, tool in enumerate(data.get('tools') or ()):
+        function = tool.get('function') if isinstance(tool, dict) else None
+        if tool.get('type', 'function') != 'function' or not isinstance(function, dict) or not function.get('name'):
+            raise ConversionError("Only function tools with a name are supported", f"tools[{index}]")
+        yield function['name'], function.get('description'), function.get('parameters')
 
 
-@app.route('/v1/models/<model_id>', methods=['GET'])
-@require_api_key
-def get_model(model_id):
+def append_turn(turns, role, key, items):
     """
-    Get specific model details
-    Compatible with OpenAI's GET /v1/models/{model} endpoint
+    Append a message, merged into the previous one when the role repeats
+    Both providers expect user and assistant turns to alternate, and
+    parallel tool results must arrive together in a single turn.
     """
-    for model in AVAILABLE_MODELS:
-        if model['id'] == model_id:
-            return jsonify(model)
-    
-    return jsonify({
-        "error": {
-            "message": f"Model '{model_id}' not found",
-            "type": "invalid_request_error",
-            "param": None,
-            "code": "model_not_found"
-        }
-    }), 404
+    if not turns or turns[-1]['role'] != role:
+        turns.append({'role': role, key: items})
+        return
+    previous = turns[-1][key]
+    # Anthropic string content becomes a text block when it is merged
+    if isinstance(previous, str):
+        previous = [{"type": "text", "text": previous}] if previous else []
+    if isinstance(items, str):
+        items = [{"type": "text", "text": items}] if items else []
+    turns[-1][key] = previous + items
 
 
-@app.route('/v1/chat/completions', methods=['POST'])
-@require_api_key
-def chat_completions():
-    """
-    Chat completions endpoint
-    Compatible with OpenAI's POST /v1/chat/completions endpoint
-    Forwards requests to configured AI providers based on the model
-    """
+def anthropic_blocks(content, param):
+    """Anthropic content blocks for OpenAI message content"""
+    if content is None:
+        return []
+    if isinstance(content, str):
+        return [{"type": "text", "text": content}] if content else []
+    blocks = []
+    for part_param, kind, part in content_parts(content, param):
+        if kind == 'text':
+            # Anthropic rejects empty text blocks
+            if part.get('text'):
+                blocks.append({"type": "text", "text": part['text']})
+        elif kind == 'image_url':
+            media_type, data, url = image_source(part, part_param)
+            if data is not None:
+                source = {"type": "base64", "media_type": media_type, "data": data}
+            else:
+                source = {"type": "url", "url": url}
+            blocks.append({"type": "image", "source": source})
+        elif kind == 'file':
+            media_type, data = file_source(part, part_param)
+            blocks.append({"type": "document", "source": {"type": "base64", "media_type": media_type, "data": data}})
+        else:
+            raise ConversionError(f"Content part type '{kind}' is not supported by Anthropic models", part_param)
+    return blocks
+
+
+def anthropic_request(data, stream):
+    """Anthropic Messages request body for an OpenAI chat completion request"""
+    system = []
+    messages = []
+    for index, msg in enumerate(data.get('messages', [])):
+        param = f"messages[{index}]"
+        role = msg.get('role')
+        content = msg.get('content')
+        if role in ('system', 'developer'):
+            system.append(content if isinstance(content, str) else anthropic_blocks(content, f"{param}.content"))
+            continue
+        if role == 'tool':
+            # Tool results go back in a user turn, as tool_result blocks
+            result = {"type": "tool_result", "tool_use_id": msg.get('tool_call_id')}
+            if content:
+                result['content'] = content if isinstance(content, str) else anthropic_blocks(content, f"{param}.content")
+            append_turn(messages, 'user', 'content', [result])
+            continue
+        if role not in ('user', 'assistant'):
+            raise ConversionError(f"Message role '{role}' is not supported by Anthropic models", f"{param}.role")
+        tool_calls = msg.get('tool_calls') if role == 'assistant' else None
+        if isinstance(content, str) and not tool_calls:
+            # Plain text is sent as it is rather than as a text block
+            append_turn(messages, role, 'content', content)
+            continue
+        blocks = anthropic_blocks(content, f"{param}.content")
+        for call_index, call in enumerate(tool_calls or ()):
+            blocks.append({
+                "type": "tool_use",
+                "id": call.get('id'),
+                "name": (call.get('function') or {}).get('name'),
+                "input": tool_arguments(call, f"{param}.tool_calls[{call_index}]")
+            })
+        append_turn(messages, role, 'content', blocks)
+
+    anthropic_data = {
+        'model': data.get('model', 'claude-3-5-sonnet-20241022'),
+        'messages': messages,
+        'max_tokens': data.get('max_tokens', 4096),
+        'stream': stream
+    }
+    if len(system) == 1:
+        anthropic_data['system'] = system[0]
+    elif system:
+        anthropic_data['system'] = [
+            block
+            for content in system
+            for block in (anthropic_blocks(content, 'messages') if isinstance(content, str) else content)
+        ]
+    if 'temperature' in data:
+        anthropic_data['temperature'] = data['temperature']
+
+    tools = []
+    for name, description, parameters in function_tools(data):
+        tool = {"name": name, "input_schema": parameters or {"type": "object", "properties": {}}}
+        if description:
+            tool['description'] = description
+        tools.append(tool)
+    if tools:
+        anthropic_data['tools'] = tools
+        tool_choice = data.get('tool_choice')
+        if isinstance(tool_choice, dict):
+            choice = {"type": "tool", "name": (tool_choice.get('function') or {}).get('name')}
+        else:
+            choice = {"type": {'none': 'none', 'required': 'any'}.get(tool_choice, 'auto')}
+        if data.get('parallel_tool_calls') is False and choice['type'] != 'none':
+            choice['disable_parallel_tool_use'] = True
+        anthropic_data['tool_choice'] = choice
+    return anthropic_data
+
+
+def anthropic_message(content):
+    """OpenAI assistant message for the content blocks of an Anthropic response"""
+    text = []
+    tool_calls = []
+    for block in content or ():
+        if block.get('type') == 'text':
+            text.append(block.get('text', ''))
+        elif block.get('type') == 'tool_use':
+            tool_calls.append(openai_tool_call(block.get('id'), block.get('name'), block.get('input') or {}))
+    message = {"role": "assistant", "content": ''.join(text) if text or not tool_calls else None}
+    if tool_calls:
+        message['tool_calls'] = tool_calls
+    return message
+
+
+# JSON Schema keywords in the OpenAPI subset that Gemini accepts for function parameters
+GEMINI_SCHEMA_FIELDS = frozenset((
+    'type', 'format', 'title', 'description', 'nullable', 'enum', 'items', 'properties', 'required',
+    'anyOf', 'minItems', 'maxItems', 'minLength', 'maxLength', 'pattern', 'minimum', 'maximum',
+    'minProperties', 'maxProperties', 'propertyOrdering', 'default', 'example',
+))
+
+
+def gemini_schema(schema):
+    """A JSON Schema reduced to what Gemini accepts (unknown keywords such as additionalProperties are dropped)"""
+    if isinstance(schema, list):
+        return [gemini_schema(item) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    result = {}
+    for key, value in schema.items():
+        if key not in GEMINI_SCHEMA_FIELDS:
+            continue
+        if key == 'type' and isinstance(value, list):
+            # ["string", "null"] is a nullable string
+            types = [item for item in value if item != 'null']
+            if len(types) < len(value):
+                result['nullable'] = True
+            value = types[0] if types else 'string'
+        elif key == 'properties' and isinstance(value, dict):
+            value = {name: gemini_schema(item) for name, item in value.items()}
+        elif key in ('items', 'anyOf'):
+            value = gemini_schema(value)
+        result[key] = value
+    return result
+
+
+def gemini_parts(content, param):
+    """Gemini parts for OpenAI message content"""
+    if content is None:
+        return []
+    if isinstance(content, str):
+        return [{'text': content}]
+    parts = []
+    for part_param, kind, part in content_parts(content, param):
+        if kind == 'text':
+            parts.append({'text': part.get('text', '')})
+        elif kind == 'image_url':
+            media_type, data, url = image_source(part, part_param)
+            if data is not None:
+                parts.append({'inlineData': {'mimeType': media_type, 'data': data}})
+            else:
+                parts.append({'fileData': {'mimeType': media_type or 'image/jpeg', 'fileUri': url}})
+        elif kind == 'input_audio':
+            audio = part.get('input_audio') or {}
+            parts.append({'inlineData': {'mimeType': f"audio/{audio.get('format', 'wav')}", 'data': audio.get('data', '')}})
+        elif kind == 'file':
+            media_type, data = file_source(part, part_param)
+            parts.append({'inlineData': {'mimeType': media_type, 'data': data}})
+        else:
+            raise ConversionError(f"Content part type '{kind}' is not supported by Gemini models", part_param)
+    return parts
+
+
+def gemini_function_response(content):
+    """The response object of a Gemini functionResponse for an OpenAI tool message"""
+    if isinstance(content, list):
+        content = ''.join(part.get('text', '') for part in content if isinstance(part, dict))
     try:
-        data = request.get_json()
-        
-        if not data:
-            return jsonify({
-                "error": {
-                    "message": "Request body is required",
-                    "type": "invalid_request_error",
-                    "param": None,
-                    "code": "invalid_request"
-                }
-            }), 400
-        
-        model = data.get('model')
-        messages = data.get('messages', [])
-        stream = data.get('stream', False)
-        
-        if not model:
-            return jsonify({
-                "error": {
-                    "message": "Missing required parameter: 'model'",
-                    "type": "invalid_request_error",
-                    "param": "model",
-                    "code": "missing_parameter"
-                }
-            }), 400
-        
-        if not messages:
-            return jsonify({
-                "error": {
-                    "message": "Missing required parameter: 'messages'",
-                    "type": "invalid_request_error",
-                    "param": "messages",
-                    "code": "missing_parameter"
-                }
-            }), 400
-        
-        # Route to appropriate provider based on model
-        if model.startswith('gpt-') or model.startswith('o1-'):
-            if not OPENAI_API_KEY:
-                return jsonify({
-                    "error": {
-                        "message": "OpenAI API key not configured. Please set OPENAI_API_KEY in .env file",
-                        "type": "invalid_request_error",
-                        "param": None,
-                        "code": "api_key_not_configured"
-                    }
-                }), 500
-            
-            return forward_to_openai(data, stream)
-        
-        elif model.startswith('claude-'):
-            if not ANTHROPIC_API_KEY:
-                return jsonify({
-                    "error": {
-                        "message": "Anthropic API key not configured. Please set ANTHROPIC_API_KEY in .env file",
-                        "type": "invalid_request_error",
-                        "param": None,
-                        "code": "api_key_not_configured"
-                    }
-                }), 500
-            
-            return forward_to_anthropic(data, stream)
-        
-        elif model.startswith('gemini-'):
-            if not GOOGLE_API_KEY:
-                return jsonify({
-                    "error": {
-                        "message": "Google API key not configured. Please set GOOGLE_API_KEY in .env file",
-                        "type": "invalid_request_error",
-                        "param": None,
-                        "code": "api_key_not_configured"
-                    }
-                }), 500
-            
-            return forward_to_google(data, stream)
-        
-        elif model.startswith('grok-'):
-            if not XAI_API_KEY:
-                return jsonify({
-                    "error": {
-                        "message": "xAI API key not configured. Please set XAI_API_KEY in .env file",
-                        "type": "invalid_request_error",
-                        "param": None,
-                        "code": "api_key_not_configured"
-                    }
-                }), 500
-            
-            return forward_to_xai(data, stream)
-        
+        value = json_loads(content or '')
+    except ValueError:
+        value = content
+    # JSON objects are passed through; anything else is wrapped
+    return value if isinstance(value, dict) else {"content": value}
+
+
+def gemini_request(data):
+    """Gemini generateContent request body for an OpenAI chat completion request"""
+    system = []
+    contents = []
+    # Gemini matches function responses by name, OpenAI by tool call ID
+    call_names = {}
+    for index, msg in enumerate(data.get('messages', [])):
+        param = f"messages[{index}]"
+        role = msg.get('role')
+        content = msg.get('content')
+        if role in ('system', 'developer'):
+            system.extend(gemini_parts(content, f"{param}.content"))
+        elif role == 'user':
+            append_turn(contents, 'user', 'parts', gemini_parts(content, f"{param}.content"))
+        elif role == 'assistant':
+            tool_calls = msg.get('tool_calls') or ()
+            parts = gemini_parts(content, f"{param}.content") if content or not tool_calls else []
+            for call_index, call in enumerate(tool_calls):
+                name = (call.get('function') or {}).get('name')
+                call_names[call.get('id')] = name
+                parts.append({'functionCall': {
+                    'name': name,
+                    'args': tool_arguments(call, f"{param}.tool_calls[{call_index}]")
+                }})
+            append_turn(contents, 'model', 'parts', parts)
+        elif role == 'tool':
+            name = call_names.get(msg.get('tool_call_id')) or msg.get('name')
+            if not name:
+                raise ConversionError("Tool message does not answer an earlier tool call", f"{param}.tool_call_id")
+            append_turn(contents, 'user', 'parts', [{'functionResponse': {
+                'name': name,
+                'response': gemini_function_response(content)
+            }}])
         else:
-            return jsonify({
-                "error": {
-                    "message": f"Model '{model}' is not supported",
-                    "type": "invalid_request_error",
-                    "param": "model",
-                    "code": "model_not_supported"
-                }
-            }), 400
-    
-    except Exception as e:
-        return jsonify({
-            "error": {
-                "message": f"Internal server error: {str(e)}",
-                "type": "server_error",
-                "param": None,
-                "code": "internal_error"
-            }
-        }), 500
+            raise ConversionError(f"Message role '{role}' is not supported by Gemini models", f"{param}.role")
+
+    gemini_data = {'contents': contents}
+    if system:
+        gemini_data['systemInstruction'] = {'parts': system}
+    if 'temperature' in data:
+        gemini_data['generationConfig'] = {'temperature': data['temperature']}
+
+    declarations = []
+    for name, description, parameters in function_tools(data):
+        declaration = {'name': name}
+        if description:
+            declaration['description'] = description
+        # Gemini rejects object schemas without properties: such tools take no parameters
+        if parameters and parameters.get('properties'):
+            declaration['parameters'] = gemini_schema(parameters)
+        declarations.append(declaration)
+    if declarations:
+        gemini_data['tools'] = [{'functionDeclarations': declarations}]
+        tool_choice = data.get('tool_choice')
+        if isinstance(tool_choice, dict):
+            config = {'mode': 'ANY', 'allowedFunctionNames': [(tool_choice.get('function') or {}).get('name')]}
+        else:
+            config = {'mode': {'none': 'NONE', 'required': 'ANY'}.get(tool_choice, 'AUTO')}
+        gemini_data['toolConfig'] = {'functionCallingConfig': config}
+    return gemini_data
 
 
-def forward_to_openai(data, stream):
+def gemini_candidate_parts(candidate):
+    """
+    (text, function_calls) of a Gemini candidate
+    All text parts are joined; thought summaries are left out.
+    """
+    text = []
+    calls = []
+    for part in (candidate.get('content') or {}).get('parts') or ():
+        if 'functionCall' in part:
+            calls.append(part['functionCall'])
+        elif 'text' in part and not part.get('thought'):
+            text.append(part['text'])
+    return ''.join(text), calls
+
+
+def forward_to_openai(data, stream, call):
     """Forward request to OpenAI API"""
     try:
-        headers = {
-            'Authorization': f'Bearer {OPENAI_API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        
-        response = requests.post(
-            'https://api.openai.com/v1/chat/completions',
-            headers=headers,
-            json=data,
-            stream=stream
+        response = send_upstream(
+            'openai', '/v1/chat/completions', data, stream,
+            auth=lambda target: ({'Authorization': f'Bearer {target.api_key}'}, None),
+            trace=call.trace
         )
         
         if stream:
-            def generate():
-                for chunk in response.iter_content(chunk_size=None):
-                    if chunk:
-                        yield chunk
-            
-            return Response(
-                stream_with_context(generate()),
-                content_type=response.headers.get('content-type', 'text/event-stream')
-            )
+            return passthrough_response(response, call)
         else:
-            return jsonify(response.json()), response.status_code
+            return relay_response(response, call)
     
     except Exception as e:
         return jsonify({
@@ -422,85 +4958,86 @@ def forward_to_openai(data, stream):
         }), 500
 
 
-def forward_to_anthropic(data, stream):
+def forward_to_anthropic(data, stream, call):
     """Forward request to Anthropic API (Claude)"""
     try:
-        # Convert OpenAI format to Anthropic format
-        messages = data.get('messages', [])
-        anthropic_messages = []
-        system_message = None
-        
-        for msg in messages:
-            if msg['role'] == 'system':
-                system_message = msg['content']
-            else:
-                anthropic_messages.append({
-                    'role': msg['role'],
-                    'content': msg['content']
-                })
-        
-        anthropic_data = {
-            'model': data.get('model', 'claude-3-5-sonnet-20241022'),
-            'messages': anthropic_messages,
-            'max_tokens': data.get('max_tokens', 4096),
-            'stream': stream
-        }
-        
-        if system_message:
-            anthropic_data['system'] = system_message
+        # Non-streaming requests are streamed from upstream too with UPSTREAM_STREAM_ASSEMBLY
+        upstream_stream = stream or UPSTREAM_STREAM_ASSEMBLY
         
-        if 'temperature' in data:
-            anthropic_data['temperature'] = data['temperature']
+        # Convert OpenAI format to Anthropic format
+        with call.span('convert.request'):
+            anthropic_data = anthropic_request(data, upstream_stream)
         
-        headers = {
-            'x-api-key': ANTHROPIC_API_KEY,
-            'anthropic-version': '2023-06-01',
-            'Content-Type': 'application/json'
-        }
+            if anthropic_prompt_cache is not None:
+                breakpoints = anthropic_prompt_cache.apply(anthropic_data)
+                if breakpoints:
+                    metrics.inc('prompt_cache_breakpoints_total', (), breakpoints)
         
-        response = requests.post(
-            'https://api.anthropic.com/v1/messages',
-            headers=headers,
-            json=anthropic_data,
-            stream=stream
+        response = send_upstream(
+            'anthropic', '/v1/messages', anthropic_data, upstream_stream,
+            auth=lambda target: ({
+                'x-api-key': target.api_key,
+                'anthropic-version': '2023-06-01'
+            }, None),
+            trace=call.trace
         )
         
-        if stream:
+        # Error bodies are relayed as they are, never parsed as a message
+        if response.status_code != 200:
+            return relay_response(response, call)
+        
+        if upstream_stream:
+            upstream = UpstreamStream(response, call)
+            if not stream:
+                return assembled_response(
+                    upstream,
+                    anthropic_completion_events(upstream, call.tokens),
+                    data.get('model'),
+                    call
+                )
+            
+            include_usage = bool((data.get('stream_options') or {}).get('include_usage'))
+            
             def generate():
-                for chunk in response.iter_content(chunk_size=None):
-                    if chunk:
-                        yield chunk
+                try:
+                    for frame in translate_anthropic_stream(
+                        upstream,
+                        data.get('model'),
+                        include_usage,
+                        call.tokens
+                    ):
+                        yield frame
+                finally:
+                    upstream.close()
             
             return Response(
-                stream_with_context(generate()),
-                content_type=response.headers.get('content-type', 'text/event-stream')
+                generate(),
+                content_type='text/event-stream',
+                headers=SSE_HEADERS
             )
         else:
-            # Convert Anthropic response to OpenAI format
-            anthropic_response = response.json()
+            with call.span('convert.response'):
+                # Convert Anthropic response to OpenAI format
+                anthropic_response = json_loads(response.content)
             
-            openai_response = {
-                "id": f"chatcmpl-{anthropic_response.get('id', '')}",
-                "object": "chat.completion",
-                "created": int(time.time()),
-                "model": data.get('model'),
-                "choices": [{
-                    "index": 0,
-                    "message": {
-                        "role": "assistant",
-                        "content": anthropic_response.get('content', [{}])[0].get('text', '')
-                    },
-                    "finish_reason": anthropic_response.get('stop_reason', 'stop')
-                }],
-                "usage": {
-                    "prompt_tokens": anthropic_response.get('usage', {}).get('input_tokens', 0),
-                    "completion_tokens": anthropic_response.get('usage', {}).get('output_tokens', 0),
-                    "total_tokens": anthropic_response.get('usage', {}).get('input_tokens', 0) + anthropic_response.get('usage', {}).get('output_tokens', 0)
+                openai_response = {
+                    "id": f"chatcmpl-{anthropic_response.get('id', '')}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": data.get('model'),
+                    "choices": [{
+                        "index": 0,
+                        "message": anthropic_message(anthropic_response.get('content')),
+                        "finish_reason": ANTHROPIC_FINISH_REASONS.get(anthropic_response.get('stop_reason'), 'stop')
+                    }],
+                    "usage": anthropic_usage(anthropic_response.get('usage') or {})
                 }
-            }
             
-            return jsonify(openai_response), response.status_code
+            record_usage('anthropic', openai_response['usage'], call.tokens)
+            return jsonify(openai_response), 200
     
+    except ConversionError as e:
+        return conversion_error_response(e)
     except Exception as e:
         return jsonify({
             "error": {
@@ -512,73 +5049,108 @@ def forward_to_anthropic(data, stream):
         }), 500
 
 
-def forward_to_google(data, stream):
+def forward_to_google(data, stream, call):
     """Forward request to Google Gemini API"""
     try:
-        # Convert OpenAI format to Gemini format
-        messages = data.get('messages', [])
-        gemini_contents = []
-        
-        for msg in messages:
-            role = 'user' if msg['role'] in ['user', 'system'] else 'model'
-            gemini_contents.append({
-                'role': role,
-                'parts': [{'text': msg['content']}]
-            })
-        
-        model_name = data.get('model', 'gemini-pro')
-        
-        gemini_data = {
-            'contents': gemini_contents,
-        }
+        # Non-streaming requests are streamed from upstream too with UPSTREAM_STREAM_ASSEMBLY
+        upstream_stream = stream or UPSTREAM_STREAM_ASSEMBLY
         
-        if 'temperature' in data:
-            gemini_data['generationConfig'] = {'temperature': data['temperature']}
+        # Convert OpenAI format to Gemini format
+        with call.span('convert.request'):
+            messages = data.get('messages', [])
+            model_name = data.get('model', 'gemini-pro')
+            gemini_data = gemini_request(data)
         
-        # Gemini API uses URL parameters for API key
-        url = f'https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent'
-        params = {'key': GOOGLE_API_KEY}
+            # Gemini API uses URL parameters for API key
+            if upstream_stream:
+                path = f'/v1beta/models/{model_name}:streamGenerateContent'
+                auth = lambda target: ({}, {'key': target.api_key, 'alt': 'sse'})
+            else:
+                path = f'/v1beta/models/{model_name}:generateContent'
+                auth = lambda target: ({}, {'key': target.api_key})
         
-        response = requests.post(
-            url,
-            params=params,
-            json=gemini_data
-        )
+        response = send_upstream('google', path, gemini_data, upstream_stream, auth=auth, trace=call.trace)
+        # The precheck's estimate, unless it was made for another provider (a fallback)
+        if call.tokens is not None and call.tokens.provider_id == 'google':
+            prompt_tokens = call.tokens.estimate
+        else:
+            prompt_tokens = token_estimator.count_messages(messages, 'google', model_name)[0]
         
         if response.status_code != 200:
-            return jsonify(response.json()), response.status_code
+            return relay_response(response, call)
+        
+        if upstream_stream:
+            upstream = UpstreamStream(response, call)
+            if not stream:
+                return assembled_response(
+                    upstream,
+                    gemini_completion_events(upstream, data.get('model'), prompt_tokens, call.tokens),
+                    data.get('model'),
+                    call
+                )
+            
+            include_usage = bool((data.get('stream_options') or {}).get('include_usage'))
+            
+            def generate():
+                try:
+                    for frame in translate_gemini_stream(
+                        upstream,
+                        data.get('model'),
+                        include_usage,
+                        prompt_tokens,
+                        call.tokens
+                    ):
+                        yield frame
+                finally:
+                    upstream.close()
+            
+            return Response(
+                generate(),
+                content_type='text/event-stream',
+                headers=SSE_HEADERS
+            )
         
         # Convert Gemini response to OpenAI format
-        gemini_response = response.json()
+        with call.span('convert.response'):
+            gemini_response = json_loads(response.content)
         
-        content = ''
-        if 'candidates' in gemini_response and len(gemini_response['candidates']) > 0:
-            candidate = gemini_response['candidates'][0]
-            if 'content' in candidate and 'parts' in candidate['content']:
-                content = candidate['content']['parts'][0].get('text', '')
+            candidate = (gemini_response.get('candidates') or [{}])[0]
+            content, function_calls = gemini_candidate_parts(candidate)
+            message = {"role": "assistant", "content": content if content or not function_calls else None}
+            if function_calls:
+                message['tool_calls'] = [
+                    openai_tool_call(tool_call_id(), call.get('name'), call.get('args') or {})
+                    for call in function_calls
+                ]
+                finish_reason = 'tool_calls'
+            else:
+                finish_reason = GEMINI_FINISH_REASONS.get(candidate.get('finishReason'), 'stop')
+            completion_tokens = token_estimator.count_text(content, 'google', model_name, memo=False)
+            for call in message.get('tool_calls', ()):
+                completion_tokens += token_estimator.count_text(call['function']['arguments'], 'google', model_name, memo=False)
         
-        openai_response = {
-            "id": f"chatcmpl-{int(time.time())}",
-            "object": "chat.completion",
-            "created": int(time.time()),
-            "model": data.get('model'),
-            "choices": [{
-                "index": 0,
-                "message": {
-                    "role": "assistant",
-                    "content": content
-                },
-                "finish_reason": "stop"
-            }],
-            "usage": {
-                "prompt_tokens": 0,
-                "completion_tokens": 0,
-                "total_tokens": 0
+            openai_response = {
+                "id": f"chatcmpl-{int(time.time())}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": data.get('model'),
+                "choices": [{
+                    "index": 0,
+                    "message": message,
+                    "finish_reason": finish_reason
+                }],
+                "usage": gemini_usage(
+                    gemini_response.get('usageMetadata') or {},
+                    prompt_tokens,
+                    completion_tokens
+                )
             }
-        }
         
+        record_usage('google', openai_response['usage'], call.tokens)
         return jsonify(openai_response), 200
     
+    except ConversionError as e:
+        return conversion_error_response(e)
     except Exception as e:
         return jsonify({
             "error": {
@@ -590,34 +5162,20 @@ def forward_to_google(data, stream):
         }), 500
 
 
-def forward_to_xai(data, stream):
+def forward_to_xai(data, stream, call):
     """Forward request to xAI (Grok) API"""
     try:
         # xAI uses OpenAI-compatible API
-        headers = {
-            'Authorization': f'Bearer {XAI_API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        
-        response = requests.post(
-            'https://api.x.ai/v1/chat/completions',
-            headers=headers,
-            json=data,
-            stream=stream
+        response = send_upstream(
+            'xai', '/v1/chat/completions', data, stream,
+            auth=lambda target: ({'Authorization': f'Bearer {target.api_key}'}, None),
+            trace=call.trace
         )
         
         if stream:
-            def generate():
-                for chunk in response.iter_content(chunk_size=None):
-                    if chunk:
-                        yield chunk
-            
-            return Response(
-                stream_with_context(generate()),
-                content_type=response.headers.get('content-type', 'text/event-stream')
-            )
+            return passthrough_response(response, call)
         else:
-            return jsonify(response.json()), response.status_code
+            return relay_response(response, call)
     
     except Exception as e:
         return jsonify({
@@ -630,6 +5188,19 @@ def forward_to_xai(data, stream):
         }), 500
 
 
+# Provider registry
+register_provider('openai', 'OpenAI', forward_to_openai, OPENAI_API_KEY, 'OPENAI_API_KEY',
+                  OPENAI_BASE_URL, prefixes=('gpt-', 'o1-'))
+register_provider('anthropic', 'Anthropic', forward_to_anthropic, ANTHROPIC_API_KEY, 'ANTHROPIC_API_KEY',
+                  ANTHROPIC_BASE_URL, prefixes=('claude-',))
+register_provider('google', 'Google', forward_to_google, GOOGLE_API_KEY, 'GOOGLE_API_KEY',
+                  GOOGLE_BASE_URL, prefixes=('gemini-',))
+register_provider('xai', 'xAI', forward_to_xai, XAI_API_KEY, 'XAI_API_KEY',
+                  XAI_BASE_URL, prefixes=('grok-',))
+
+reload_routing_table()
+
+
 @app.errorhandler(404)
 def not_found(error):
     """Handle 404 errors"""
@@ -656,13 +5227,399 @@ def internal_error(error):
     }), 500
 
 
+def prewarm_upstreams():
+    """
+    Do what the first completion would otherwise wait for: import the
+    upstream HTTP client, connect to every configured provider endpoint
+    and load the tokenizer
+    """
+    started = time.perf_counter()
+    endpoints = sorted({
+        (provider.id, target.base_url)
+        for provider in PROVIDERS.values() if provider.api_keys
+        for target in provider.balancer.targets
+    })
+    if endpoints:
+        with ThreadPoolExecutor(max_workers=len(endpoints), thread_name_prefix='upstream-prewarm') as executor:
+            connected = sum(executor.map(lambda endpoint: get_upstream_pool(endpoint[0]).prewarm(endpoint[1]), endpoints))
+    else:
+        connected = 0
+    token_estimator.warm()
+    print(f"Pre-warmed {connected}/{len(endpoints)} upstream endpoint(s) in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+def start_prewarm():
+    """Pre-warm upstreams in the background if enabled; call once the socket is listening"""
+    if UPSTREAM_PREWARM:
+        threading.Thread(target=prewarm_upstreams, name='upstream-prewarm', daemon=True).start()
+
+
+def run_sync_server(host, port):
+    """Serve the app on Werkzeug's threaded server (one thread per connection)"""
+    from werkzeug.serving import make_server
+
+    server = make_server(host, port, app, threaded=True)
+    start_prewarm()
+    server.serve_forever()
+
+
+def run_async_server(host, port, max_connections):
+    """
+    Serve the app on gevent's event loop
+    Every connection runs in a greenlet and upstream I/O yields to the loop,
+    so long streaming completions do not tie up an OS thread each
+    """
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+
+    server = WSGIServer((host, port), app, spawn=Pool(max_connections), log=None)
+    provider_prober.serve_on_greenlets()
+    server.start()
+    start_prewarm()
+    server.serve_forever()
+
+
+def worker_count(value):
+    """Parse WORKERS / --workers: a positive number or 'auto' (one per CPU core)"""
+    if str(value).lower() == 'auto':
+        return os.cpu_count() or 1
+    return max(1, int(value))
+
+
+def bind_reuseport_socket(host, port):
+    """
+    Listening socket bound with SO_REUSEPORT
+    Every worker binds its own, and the kernel spreads new connections
+    across them, so no worker sits in a shared accept() queue.
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        sock.listen(socket.SOMAXCONN)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+class WorkerRequestTracker:
+    """
+    WSGI wrapper counting the requests a worker has taken and those still
+    in flight. A request stays in flight until its response body is closed,
+    so a streaming completion counts until its last chunk is sent.
+    on_limit() is called once when max_requests is reached.
+    """
+
+    def __init__(self, wsgi_app, max_requests=0, on_limit=None):
+        self.wsgi_app = wsgi_app
+        self.max_requests = max_requests
+        self.on_limit = on_limit
+        self.lock = threading.Lock()
+        self.handled = 0
+        self.active = 0
+
+    def __call__(self, environ, start_response):
+        with self.lock:
+            self.handled += 1
+            self.active += 1
+            limit_reached = self.handled == self.max_requests
+        if limit_reached and self.on_limit is not None:
+            self.on_limit()
+        try:
+            result = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self._finished()
+            raise
+        return ClosingIterator(result, self._finished)
+
+    def _finished(self):
+        with self.lock:
+            self.active -= 1
+
+    def wait_idle(self, timeout):
+        """Wait up to `timeout` seconds for in-flight requests; True once there are none"""
+        deadline = time.monotonic() + timeout
+        while self.active > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return self.active <= 0
+
+
+def run_worker(sock, use_async, max_requests, graceful_timeout, retire=None):
+    """
+    Serve on a listening socket until SIGTERM/SIGINT, then stop accepting
+    and let in-flight requests finish (up to graceful_timeout seconds)
+    before exiting. After max_requests the worker calls retire(), which
+    asks the master to start its replacement first and then stop it, or
+    stops straight away without one. SIGUSR1 resumes batches that a
+    worker which has since exited left unfinished.
+
+    With use_async the worker serves on gevent's WSGI server. Otherwise it
+    uses Werkzeug's threaded development server on the inherited socket,
+    as the single-process server does; no production threaded WSGI server
+    is a dependency.
+    """
+    if max_requests > 0:
+        # Spread recycling so that workers do not all restart together
+        max_requests += random.randint(0, max_requests // 10)
+    tracker = WorkerRequestTracker(app, max_requests)
+    batch_manager.start()
+
+    if use_async:
+        import gevent
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIServer
+
+        server = WSGIServer(sock, tracker, spawn=Pool(ASYNC_MAX_CONNECTIONS), log=None)
+        provider_prober.serve_on_greenlets()
+        # serve_forever() waits up to stop_timeout for handlers after close()
+        server.stop_timeout = graceful_timeout
+        tracker.on_limit = retire or (lambda: gevent.spawn(server.close))
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            gevent.signal_handler(signum, server.close)
+        gevent.signal_handler(signal.SIGUSR1, lambda: gevent.spawn(batch_manager.resume))
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        server.start()
+        start_prewarm()
+        server.serve_forever()
+        return
+
+    from werkzeug.serving import make_server
+
+    server = make_server(HOST, PORT, tracker, threaded=True, fd=sock.fileno())
+    sock.close()
+    stopping = threading.Event()
+
+    def stop(*_):
+        if not stopping.is_set():
+            stopping.set()
+            # shutdown() blocks until serve_forever() returns, so not from this thread
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+    tracker.on_limit = retire or stop
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, lambda *_: threading.Thread(target=batch_manager.resume, daemon=True).start())
+    start_prewarm()
+    server.serve_forever()
+    server.server_close()
+    if not tracker.wait_idle(graceful_timeout):
+        print(f"Worker {os.getpid()}: {tracker.active} request(s) still running after {graceful_timeout:g}s, exiting")
+
+
+class PreforkMaster:
+    """
+    Supervises forked worker processes that share HOST:PORT through SO_REUSEPORT
+
+    Workers that exit are replaced. A worker that reaches WORKER_MAX_REQUESTS
+    reports its PID on a pipe, and is drained once its replacement is
+    accepting connections. SIGHUP reloads gracefully: the master re-executes itself with
+    the current code and .env, starts a fresh set of workers, and only then
+    tells the old ones to stop accepting and drain, so in-flight streaming
+    completions run to the end. SIGTERM/SIGINT drain all workers and exit.
+    """
+
+    # Old worker PIDs handed from a master to its re-executed replacement
+    DRAIN_PIDS_ENV = 'SERVER_DRAIN_PIDS'
+
+    def __init__(self, host, port, workers, use_async, max_requests, graceful_timeout):
+        self.host = host
+        self.port = port
+        self.size = workers
+        self.use_async = use_async
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.workers = {}  # pid -> start time
+        self.draining = {}  # pid -> kill deadline
+        self.respawn_at = 0
+        self.reload_requested = False
+        self.stop_requested = False
+        self.retire_read, self.retire_write = os.pipe()
+        os.set_blocking(self.retire_read, False)
+        self.fork, self.waitpid = os.fork, os.waitpid
+        if use_async:
+            # gevent's fork/waitpid reap children inside the event loop, which
+            # loses the status of workers adopted across a reload
+            from gevent import monkey
+            self.fork = monkey.get_original('os', 'fork')
+            self.waitpid = monkey.get_original('os', 'waitpid')
+
+    def spawn(self):
+        sock = bind_reuseport_socket(self.host, self.port)
+        pid = self.fork()
+        if pid == 0:
+            status = 0
+            try:
+                if self.use_async:
+                    import gevent
+                    gevent.reinit()
+                for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                    signal.signal(signum, signal.SIG_DFL)
+                os.close(self.retire_read)
+                run_worker(sock, self.use_async, self.max_requests, self.graceful_timeout, self.retire)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                status = 1
+            finally:
+                # Never fall back into the master's loop
+                os._exit(status)
+        sock.close()
+        self.workers[pid] = time.monotonic()
+        print(f"Worker {pid} started")
+
+    def drain(self, pids):
+        """Ask workers to stop accepting and finish what they are serving"""
+        deadline = time.monotonic() + self.graceful_timeout + 5
+        for pid in pids:
+            self.workers.pop(pid, None)
+            self.draining[pid] = deadline
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reap(self):
+        """Collect exited workers; replacements are started by the main loop"""
+        exited = False
+        while True:
+            try:
+                pid, status = self.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            exited = True
+            started = self.workers.pop(pid, None)
+            if self.draining.pop(pid, None) is not None:
+                print(f"Worker {pid} drained")
+            elif started is not None:
+                code = os.waitstatus_to_exitcode(status)
+                print(f"Worker {pid} exited ({code})")
+                if code != 0 and time.monotonic() - started < 5:
+                    # Failing at startup: don't respawn in a tight loop
+                    self.respawn_at = time.monotonic() + 1
+        if exited:
+            # Batches held by the exited worker can now be picked up
+            for pid in self.workers:
+                try:
+                    os.kill(pid, signal.SIGUSR1)
+                except ProcessLookupError:
+                    pass
+
+    def retire(self):
+        """In a worker: ask the master for a replacement, or just stop if it is gone"""
+        try:
+            os.write(self.retire_write, f"{os.getpid()}\n".encode())
+        except OSError:
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    def retired(self):
+        """PIDs of workers that have reached WORKER_MAX_REQUESTS"""
+        try:
+            data = os.read(self.retire_read, 4096)
+        except BlockingIOError:
+            return []
+        return [int(pid) for pid in data.split()]
+
+    def reload(self):
+        """Re-execute the master with fresh code and .env; workers keep serving meanwhile"""
+        self.reload_requested = False
+        try:
+            with open(os.path.abspath(sys.argv[0]), 'rb') as f:
+                compile(f.read(), sys.argv[0], 'exec')
+        except (OSError, SyntaxError) as e:
+            print(f"Reload aborted, keeping the current workers: {e}")
+            return
+        print("Reloading...")
+        sys.stdout.flush()
+        env = dict(STARTUP_ENVIRON)
+        env[self.DRAIN_PIDS_ENV] = ','.join(str(pid) for pid in list(self.workers) + list(self.draining))
+        # orig_argv keeps "-m server", so the re-executed master also starts from cached bytecode
+        os.execve(sys.executable, [sys.executable] + sys.orig_argv[1:], env)
+
+    def run(self):
+        def request_reload(*_):
+            self.reload_requested = True
+
+        def request_stop(*_):
+            self.stop_requested = True
+
+        signal.signal(signal.SIGHUP, request_reload)
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+
+        previous = [int(pid) for pid in parse_list(os.environ.pop(self.DRAIN_PIDS_ENV, ''))]
+        for _ in range(self.size):
+            self.spawn()
+        if previous:
+            # The new workers are already accepting; retire the old generation
+            self.drain(previous)
+
+        while True:
+            self.reap()
+            now = time.monotonic()
+            for pid, deadline in list(self.draining.items()):
+                if now > deadline:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+            if self.stop_requested:
+                if self.workers:
+                    print("Stopping workers...")
+                    self.drain(list(self.workers))
+                if not self.draining:
+                    return
+            elif self.reload_requested:
+                self.reload()
+            else:
+                for pid in self.retired():
+                    if pid in self.workers:
+                        self.spawn()
+                        self.drain([pid])
+                while len(self.workers) < self.size and now >= self.respawn_at:
+                    self.spawn()
+            time.sleep(0.2)
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="OpenAI-Compatible Web Server")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="serve on an event loop with non-blocking upstream I/O (requires gevent)")
+    parser.add_argument('--workers', default=WORKERS,
+                        help="number of prefork worker processes, or 'auto' for one per CPU core")
+    args = parser.parse_args()
+    workers = worker_count(args.workers)
+    if workers > 1 and not (hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')):
+        sys.exit("--workers needs fork() and SO_REUSEPORT (Linux, macOS or BSD)")
+
     print(f"Starting OpenAI-Compatible Web Server...")
     print(f"API Key: {API_KEY}")
     print(f"Host: {HOST}")
     print(f"Port: {PORT}")
     if CUSTOM_ENDPOINT_URL:
         print(f"Custom Endpoint URL: {CUSTOM_ENDPOINT_URL}")
+    print(f"JSON backend: {JSON_BACKEND_NAME}")
+    if tracer.exporters:
+        print(f"Tracing: sample rate {TRACE_SAMPLE_RATE:g}, exporting to {', '.join(e.name for e in tracer.exporters)}")
+    if COMPRESSION_ENABLED:
+        print(f"Compression: {', '.join(RESPONSE_ENCODINGS)} (requests: {', '.join(sorted(COMPRESSION_CODECS))})")
+    if args.use_async:
+        print(f"Mode: async (max {ASYNC_MAX_CONNECTIONS} concurrent connections)")
+    if workers > 1:
+        print(f"Workers: {workers} (master PID {os.getpid()}; SIGHUP reloads gracefully)")
     print(f"\nServer is running. Use Ctrl+C to stop.")
-    
-    app.run(host=HOST, port=PORT, debug=False)
+
+    if workers > 1:
+        # Batches are resumed by the workers; nothing may start threads before fork()
+        PreforkMaster(HOST, PORT, workers, args.use_async, WORKER_MAX_REQUESTS, WORKER_GRACEFUL_TIMEOUT).run()
+        sys.exit(0)
+    batch_manager.start()
+    if args.use_async:
+        run_async_server(HOST, PORT, ASYNC_MAX_CONNECTIONS)
+    else:
+        run_sync_server(HOST, PORT)
@@ -0,0 +1,118 @@
+"""
+Shared fixtures: the server, imported once and pointed at local fake upstreams
+
+The server reads its configuration at import time, so it is imported once
+per test session with every provider pointed at benchmarks/fake_providers.
+Tests that need other settings patch the module's globals (monkeypatch), or
+swap in a fresh balancer to send one provider elsewhere (use_upstream).
+"""
+
+import importlib
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.fake_providers import FakeProviders  # noqa: E402
+
+KEY = 'test-key'
+OTHER_KEY = 'other-key'
+FAKE_TOKENS = 5
+
+
+def auth(api_key=KEY):
+    return {'Authorization': f'Bearer {api_key}'}
+
+
+def completion(model, content='hi', **fields):
+    return dict({"model": model, "messages": [{"role": "user", "content": content}]}, **fields)
+
+
+def sse_payloads(body):
+    """The JSON payloads of an SSE body, without the final [DONE]"""
+    payloads = []
+    for line in body.decode('utf-8').split('\n'):
+        if line.startswith('data: ') and line != 'data: [DONE]':
+            payloads.append(json.loads(line[6:]))
+    return payloads
+
+
+def start_fake(**settings):
+    fake = FakeProviders(**settings)
+    fake.url = fake.start()
+    return fake
+
+
+@pytest.fixture(scope='session')
+def upstream():
+    """Fake upstream serving every provider; tests may change its settings with monkeypatch"""
+    fake = start_fake(latency=0, tokens=FAKE_TOKENS)
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture(scope='session')
+def server(upstream, tmp_path_factory):
+    environ = dict(
+        API_KEY=f'{KEY},{OTHER_KEY}',
+        BATCH_DIR=str(tmp_path_factory.mktemp('batches')),
+        OPENAI_API_KEY='sk-fake',
+        ANTHROPIC_API_KEY='fake',
+        GOOGLE_API_KEY='fake',
+        XAI_API_KEY='fake',
+        OPENAI_BASE_URL=upstream.url,
+        ANTHROPIC_BASE_URL=upstream.url,
+        GOOGLE_BASE_URL=upstream.url,
+        XAI_BASE_URL=upstream.url,
+        UPSTREAM_MAX_RETRIES='0',
+        UPSTREAM_RETRY_BACKOFF='0',
+        RESPONSE_CACHE_ENABLED='false',
+        REQUEST_COALESCING='false',
+        UPSTREAM_HEDGING='false',
+        UPSTREAM_STREAM_ASSEMBLY='false',
+        RATE_LIMIT_RPM='0',
+        RATE_LIMIT_TPM='0',
+        RATE_LIMIT_MAX_STREAMS='0',
+        API_KEYS_FILE='',
+        MODEL_ROUTES_FILE='',
+        TRACE_SAMPLE_RATE='0',
+    )
+    saved = {name: os.environ.get(name) for name in environ}
+    os.environ.update(environ)
+    sys.modules.pop('server', None)
+    try:
+        yield importlib.import_module('server')
+    finally:
+        sys.modules.pop('server', None)
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+@pytest.fixture
+def client(server):
+    return server.app.test_client()
+
+
+@pytest.fixture
+def use_upstream(server, monkeypatch):
+    """
+    use_upstream(provider_id, *urls) sends a provider to the given base URLs
+    through a fresh balancer (one target per URL) and returns the balancer,
+    whose per-target 'requests' counts the upstream calls of the test
+    """
+    def install(provider_id, *urls, strategy='round_robin', cooldown=30):
+        balancer = server.UpstreamBalancer(['fake-key'], list(urls), strategy, cooldown)
+        monkeypatch.setattr(server.PROVIDERS[provider_id], 'balancer', balancer)
+        return balancer
+    return install
+
+
+def upstream_calls(balancer):
+    return sum(target.requests for target in balancer.targets)
@@ -0,0 +1,100 @@
+"""Anthropic streams translated into OpenAI chunk SSE frames (user-003)"""
+
+import json
+
+from conftest import FAKE_TOKENS, auth, completion, sse_payloads
+
+CLAUDE = 'claude-3-5-sonnet-20241022'
+
+
+def anthropic_sse(*payloads):
+    """An Anthropic event stream body for the given event payloads"""
+    return b''.join(
+        f"event: {payload['type']}\ndata: {json.dumps(payload)}\n\n".encode('utf-8')
+        for payload in payloads
+    )
+
+
+def test_stream_is_translated_into_chunks(client):
+    response = client.post('/v1/chat/completions', json=completion(CLAUDE, stream=True), headers=auth())
+    body = response.get_data()
+    response.close()
+
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    assert body.endswith(b'data: [DONE]\n\n')
+    chunks = sse_payloads(body)
+    assert all(chunk['object'] == 'chat.completion.chunk' for chunk in chunks)
+    assert chunks[0]['id'] == 'chatcmpl-msg_fake'
+    assert chunks[0]['choices'][0]['delta'] == {"role": "assistant", "content": ""}
+    text = ''.join(chunk['choices'][0]['delta'].get('content', '') for chunk in chunks[1:])
+    assert text == 'tok ' * FAKE_TOKENS
+    assert chunks[-1]['choices'][0]['finish_reason'] == 'stop'
+    assert 'usage' not in chunks[-1]
+
+
+def test_usage_chunk_is_sent_when_requested(client):
+    response = client.post(
+        '/v1/chat/completions',
+        json=completion(CLAUDE, stream=True, stream_options={"include_usage": True}),
+        headers=auth()
+    )
+    chunks = sse_payloads(response.get_data())
+    response.close()
+
+    assert chunks[-1]['choices'] == []
+    assert chunks[-1]['usage']['prompt_tokens'] == 10
+    assert chunks[-1]['usage']['completion_tokens'] == FAKE_TOKENS
+
+
+def test_sse_events_are_parsed_across_any_read_boundaries(server):
+    body = b'event: a\ndata: {"n": 1}\r\n\r\nevent: b\ndata: line one\ndata: line two\n\ndata: tail\n\n'
+    expected = [('a', '{"n": 1}'), ('b', 'line one\nline two'), (None, 'tail')]
+
+    assert list(server.iter_sse_events([body])) == expected
+    assert list(server.iter_sse_events([body[i:i + 1] for i in range(len(body))])) == expected
+    assert list(server.iter_sse_events([body[:7], b'', body[7:30], body[30:]])) == expected
+
+
+def test_tool_use_blocks_become_tool_call_deltas(server):
+    body = anthropic_sse(
+        {"type": "message_start", "message": {"id": "msg_1", "usage": {"input_tokens": 12}}},
+        {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+        {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "Let me check."}},
+        {"type": "content_block_start", "index": 1,
+         "content_block": {"type": "tool_use", "id": "toolu_1", "name": "get_weather", "input": {}}},
+        {"type": "content_block_delta", "index": 1, "delta": {"type": "input_json_delta", "partial_json": '{"city": '}},
+        {"type": "content_block_delta", "index": 1, "delta": {"type": "input_json_delta", "partial_json": '"Paris"}'}},
+        {"type": "message_delta", "delta": {"stop_reason": "tool_use"}, "usage": {"output_tokens": 20}},
+        {"type": "message_stop"},
+    )
+    events = list(server.anthropic_completion_events([body]))
+
+    assert events[0] == ('start', 'chatcmpl-msg_1')
+    assert ('content', 'Let me check.') in events
+    tool_calls = [value for kind, value in events if kind == 'tool_call']
+    assert tool_calls[0] == {
+        "index": 0, "id": "toolu_1", "type": "function",
+        "function": {"name": "get_weather", "arguments": ""}
+    }
+    assert ''.join(call['function']['arguments'] for call in tool_calls) == '{"city": "Paris"}'
+    assert ('finish', 'tool_calls') in events
+    assert events[-1][0] == 'usage'
+    assert events[-1][1]['prompt_tokens'] == 12
+    assert events[-1][1]['completion_tokens'] == 20
+
+
+def test_broken_upstream_stream_ends_with_an_error_frame(server):
+    def chunks():
+        yield anthropic_sse(
+            {"type": "message_start", "message": {"id": "msg_2", "usage": {"input_tokens": 3}}},
+            {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "Hel"}},
+        )
+        raise OSError("connection reset")
+
+    frames = list(server.translate_anthropic_stream(chunks(), CLAUDE))
+    payloads = sse_payloads(b''.join(frames))
+
+    assert frames[-1] == b'data: [DONE]\n\n'
+    assert payloads[1]['choices'][0]['delta'] == {"content": "Hel"}
+    assert payloads[-1]['error']['code'] == 'upstream_stream_interrupted'
@@ -0,0 +1,115 @@
+"""Balancing over keys and endpoints with cooldowns (user-008)"""
+
+import pytest
+
+from conftest import auth, completion, start_fake
+
+
+@pytest.fixture(scope='module')
+def failing_upstream():
+    fake = start_fake(latency=0, tokens=5, error_rate=1.0, error_status=503)
+    yield fake
+    fake.stop()
+
+
+def urls(targets):
+    return [target.base_url for target in targets]
+
+
+def take(balancer, count):
+    """Acquire and release count targets without errors"""
+    picked = []
+    for _ in range(count):
+        target = balancer.acquire()
+        balancer.release(target, 200)
+        picked.append(target)
+    return picked
+
+
+def test_round_robin_spreads_over_keys_and_urls(server):
+    balancer = server.UpstreamBalancer(['key-a', 'key-b'], ['http://a', 'http://b/'])
+
+    assert [(t.api_key, t.base_url) for t in balancer.targets] == [
+        ('key-a', 'http://a'), ('key-a', 'http://b'), ('key-b', 'http://a'), ('key-b', 'http://b')
+    ]
+    assert take(balancer, 8) == balancer.targets * 2
+
+
+def test_failed_target_cools_down_and_is_skipped(server):
+    balancer = server.UpstreamBalancer(['key'], ['http://a', 'http://b', 'http://c'], cooldown=30)
+    target = balancer.acquire()
+    balancer.release(target, 503)
+
+    assert target.errors == 1
+    assert target.stats(server.time.monotonic())['cooling_down'] is True
+    assert target not in take(balancer, 6)
+    assert balancer.has_healthy_target()
+
+
+@pytest.mark.parametrize('outcome', [dict(status_code=429), dict(status_code=500), dict(failed=True)])
+def test_rate_limits_server_errors_and_connection_failures_cool_down(server, outcome):
+    balancer = server.UpstreamBalancer(['key'], ['http://a'], cooldown=30)
+    target = balancer.acquire()
+    balancer.release(target, **outcome)
+
+    assert not balancer.has_healthy_target()
+
+
+def test_client_errors_do_not_cool_down(server):
+    balancer = server.UpstreamBalancer(['key'], ['http://a'], cooldown=30)
+    target = balancer.acquire()
+    balancer.release(target, 400)
+
+    assert balancer.has_healthy_target()
+    assert target.errors == 0
+
+
+def test_retry_after_sets_the_cooldown(server):
+    balancer = server.UpstreamBalancer(['key'], ['http://a', 'http://b'], cooldown=30)
+    target = balancer.acquire()
+    balancer.release(target, 429, retry_after='2')
+
+    remaining = target.cooldown_until - server.time.monotonic()
+    assert 1 < remaining <= 2
+
+    other = balancer.acquire()
+    balancer.release(other, 503, retry_after='soon')
+    assert other.cooldown_until - server.time.monotonic() > 2
+
+
+def test_earliest_recovering_target_is_used_when_all_cool_down(server):
+    balancer = server.UpstreamBalancer(['key'], ['http://a', 'http://b', 'http://c'], cooldown=30)
+    first, second, third = [balancer.acquire() for _ in range(3)]
+    for target, retry_after in ((first, '20'), (second, '5'), (third, '10')):
+        balancer.release(target, 503, retry_after=retry_after)
+
+    assert not balancer.has_healthy_target()
+    assert {balancer.acquire() for _ in range(3)} == {second}
+
+
+def test_least_outstanding_picks_the_least_busy_target(server):
+    balancer = server.UpstreamBalancer(['key'], ['http://a', 'http://b', 'http://c'], strategy='least_outstanding')
+    busy = [balancer.acquire(), balancer.acquire()]
+
+    assert urls(busy) == ['http://a', 'http://b']
+    assert balancer.acquire().base_url == 'http://c'
+    balancer.release(busy[0], 200)
+    assert balancer.acquire().base_url == 'http://a'
+
+
+def test_requests_move_off_a_failing_endpoint(client, use_upstream, upstream, failing_upstream):
+    balancer = use_upstream('openai', failing_upstream.url, upstream.url)
+    bad, good = balancer.targets
+
+    statuses = [
+        client.post('/v1/chat/completions', json=completion('gpt-4o-mini', f'q{i}'), headers=auth()).status_code
+        for i in range(4)
+    ]
+
+    # Retries are off: only the request that hit the failing endpoint sees its 503
+    assert statuses == [503, 200, 200, 200]
+    assert (bad.requests, bad.errors) == (1, 1)
+    assert good.requests == 3
+    targets = client.get('/api/upstream/targets', headers=auth()).get_json()['data']
+    openai = next(entry for entry in targets if entry['provider'] == 'openai')
+    assert [target['cooling_down'] for target in openai['targets']] == [True, False]
@@ -0,0 +1,113 @@
+"""Batch API: files, batches, ownership and accounting (user-016)"""
+
+import io
+import json
+import time
+
+import pytest
+
+from conftest import KEY, OTHER_KEY, auth, completion
+
+OWNER_TPM = 600
+
+
+def upload_batch(client, api_key, count, model='gpt-4o-mini'):
+    lines = b''.join(
+        json.dumps({
+            "custom_id": f"request-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": completion(model, f'batch {i}')
+        }).encode() + b'\n'
+        for i in range(count)
+    )
+    response = client.post(
+        '/v1/files',
+        data={'purpose': 'batch', 'file': (io.BytesIO(lines), 'requests.jsonl')},
+        headers=auth(api_key)
+    )
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def create_batch(client, api_key, file_id):
+    return client.post('/v1/batches', json={
+        "input_file_id": file_id,
+        "endpoint": "/v1/chat/completions",
+        "completion_window": "24h"
+    }, headers=auth(api_key))
+
+
+def wait_for_batch(client, api_key, batch_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        batch = client.get(f'/v1/batches/{batch_id}', headers=auth(api_key)).get_json()
+        if batch['status'] in ('completed', 'failed', 'cancelled'):
+            return batch
+        time.sleep(0.05)
+    pytest.fail(f"batch {batch_id} did not finish")
+
+
+def output_lines(client, api_key, file_id):
+    content = client.get(f"/v1/files/{file_id}/content", headers=auth(api_key))
+    return [json.loads(line) for line in content.get_data().splitlines()]
+
+
+def test_batch_runs_as_its_owner(server, client, monkeypatch):
+    limiter = server.RateLimiter(server.MemoryRateLimitStore(), server.RateLimits(), {KEY: server.RateLimits(tpm=OWNER_TPM)})
+    monkeypatch.setattr(server, 'rate_limiter', limiter)
+
+    upload = upload_batch(client, KEY, 3)
+    assert 'owner' not in upload
+    response = create_batch(client, KEY, upload['id'])
+    assert response.status_code == 200
+    assert 'owner' not in response.get_json()
+    batch = wait_for_batch(client, KEY, response.get_json()['id'])
+
+    assert batch['status'] == 'completed'
+    assert batch['request_counts'] == {"total": 3, "completed": 3, "failed": 0}
+    # Each line's usage is charged to the owner's tokens-per-minute budget
+    remaining = client.get('/api/rate-limits', headers=auth(KEY)).get_json()['remaining']
+    assert remaining['tokens'] < OWNER_TPM
+
+    results = output_lines(client, KEY, batch['output_file_id'])
+    assert sorted(result['custom_id'] for result in results) == ['request-0', 'request-1', 'request-2']
+    assert all(result['response']['status_code'] == 200 for result in results)
+
+
+def test_failed_lines_go_to_the_error_file(client):
+    upload = upload_batch(client, KEY, 2, model='llama-3')
+    batch = wait_for_batch(client, KEY, create_batch(client, KEY, upload['id']).get_json()['id'])
+
+    assert batch['status'] == 'completed'
+    assert batch['request_counts'] == {"total": 2, "completed": 0, "failed": 2}
+    errors = output_lines(client, KEY, batch['error_file_id'])
+    assert all(line['response']['status_code'] == 400 for line in errors)
+
+
+def test_batches_are_private_to_their_owner(client):
+    upload = upload_batch(client, KEY, 1)
+    assert client.get(f"/v1/files/{upload['id']}", headers=auth(OTHER_KEY)).status_code == 404
+    assert client.get(f"/v1/files/{upload['id']}/content", headers=auth(OTHER_KEY)).status_code == 404
+    assert create_batch(client, OTHER_KEY, upload['id']).status_code == 400
+
+    batch = create_batch(client, KEY, upload['id']).get_json()
+    assert client.get(f"/v1/batches/{batch['id']}", headers=auth(OTHER_KEY)).status_code == 404
+    assert client.post(f"/v1/batches/{batch['id']}/cancel", headers=auth(OTHER_KEY)).status_code == 404
+    assert batch['id'] not in [b['id'] for b in client.get('/v1/batches', headers=auth(OTHER_KEY)).get_json()['data']]
+    assert batch['id'] in [b['id'] for b in client.get('/v1/batches', headers=auth(KEY)).get_json()['data']]
+
+    assert wait_for_batch(client, KEY, batch['id'])['status'] == 'completed'
+
+
+def test_invalid_batch_requests_are_rejected(client):
+    upload = upload_batch(client, KEY, 1)
+
+    assert create_batch(client, KEY, 'file-missing').status_code == 400
+    response = client.post('/v1/batches', json={
+        "input_file_id": upload['id'], "endpoint": "/v1/embeddings", "completion_window": "24h"
+    }, headers=auth(KEY))
+    assert response.status_code == 400
+    response = client.post('/v1/files', data={'purpose': 'fine-tune', 'file': (io.BytesIO(b'{}\n'), 'x.jsonl')},
+                           headers=auth(KEY))
+    assert response.get_json()['error']['code'] == 'invalid_purpose'
@@ -0,0 +1,89 @@
+"""Coalescing identical in-flight completions into one upstream call (user-006)"""
+
+import threading
+
+import pytest
+
+from conftest import KEY, OTHER_KEY, auth, completion, upstream_calls
+
+# Upstream latency long enough for every concurrent request to join the first one's flight
+LATENCY = 0.3
+
+
+@pytest.fixture
+def coalescer(server, monkeypatch, upstream):
+    coalescer = server.SingleFlight()
+    monkeypatch.setattr(server, 'request_coalescer', coalescer)
+    monkeypatch.setattr(upstream, 'latency', LATENCY)
+    return coalescer
+
+
+@pytest.fixture
+def balancer(use_upstream, upstream):
+    return use_upstream('openai', upstream.url)
+
+
+def post_concurrently(server, bodies_and_keys):
+    """Send the requests at the same time; returns (status, headers, body) per request, in order"""
+    results = [None] * len(bodies_and_keys)
+    barrier = threading.Barrier(len(bodies_and_keys))
+
+    def send(i, body, api_key):
+        client = server.app.test_client()
+        barrier.wait()
+        response = client.post('/v1/chat/completions', json=body, headers=auth(api_key))
+        results[i] = (response.status_code, response.headers, response.get_data())
+        response.close()
+
+    threads = [
+        threading.Thread(target=send, args=(i, body, api_key))
+        for i, (body, api_key) in enumerate(bodies_and_keys)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+def test_identical_requests_share_one_upstream_call(server, coalescer, balancer):
+    body = completion('gpt-4o-mini', 'same question')
+    results = post_concurrently(server, [(body, KEY)] * 4)
+
+    assert [status for status, _, _ in results] == [200] * 4
+    assert upstream_calls(balancer) == 1
+    assert len({data for _, _, data in results}) == 1
+    assert sum(headers.get('X-Coalesced') == 'true' for _, headers, _ in results) == 3
+    assert coalescer.counters == {"leaders": 1, "coalesced": 3}
+    assert coalescer.flights == {}
+
+
+def test_streaming_followers_get_the_same_chunks(server, coalescer, balancer):
+    body = completion('gpt-4o-mini', 'same stream', stream=True)
+    results = post_concurrently(server, [(body, KEY)] * 3)
+
+    assert upstream_calls(balancer) == 1
+    bodies = {data for _, _, data in results}
+    assert len(bodies) == 1
+    assert bodies.pop().endswith(b'data: [DONE]\n\n')
+    assert coalescer.flights == {}
+
+
+def test_different_requests_are_not_coalesced(server, coalescer, balancer):
+    results = post_concurrently(server, [
+        (completion('gpt-4o-mini', 'first question'), KEY),
+        (completion('gpt-4o-mini', 'second question'), KEY),
+    ])
+
+    assert [status for status, _, _ in results] == [200, 200]
+    assert upstream_calls(balancer) == 2
+    assert coalescer.counters["coalesced"] == 0
+
+
+def test_requests_from_different_keys_are_not_coalesced(server, coalescer, balancer):
+    body = completion('gpt-4o-mini', 'same question')
+    results = post_concurrently(server, [(body, KEY), (body, OTHER_KEY)])
+
+    assert [status for status, _, _ in results] == [200, 200]
+    assert upstream_calls(balancer) == 2
+    assert all('X-Coalesced' not in headers for _, headers, _ in results)
@@ -0,0 +1,118 @@
+"""Request and response compression negotiation (user-019)"""
+
+import gzip
+import json
+import zlib
+
+import pytest
+
+from conftest import auth, completion
+
+
+@pytest.fixture
+def decompression(server):
+    """The request decompression middleware, whose max_bytes a test may lower"""
+    middleware = server.app.wsgi_app
+    assert isinstance(middleware, server.RequestDecompressionMiddleware)
+    return middleware
+
+
+@pytest.fixture
+def small_min_bytes(server, monkeypatch):
+    """Compress the model list (a few hundred bytes) like any larger body"""
+    monkeypatch.setattr(server, 'COMPRESSION_MIN_BYTES', 128)
+
+
+def models(client, **headers):
+    return client.get('/v1/models', headers=dict(auth(), **headers))
+
+
+def post_encoded(client, body, encoding):
+    return client.post(
+        '/v1/chat/completions',
+        data=body,
+        headers=dict(auth(), **{'Content-Type': 'application/json', 'Content-Encoding': encoding})
+    )
+
+
+def test_large_json_responses_are_gzipped(server, client, small_min_bytes):
+    plain = models(client)
+    compressed = models(client, **{'Accept-Encoding': 'gzip'})
+
+    assert len(plain.get_data()) >= server.COMPRESSION_MIN_BYTES
+    assert 'Content-Encoding' not in plain.headers
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in compressed.headers['Vary']
+    assert gzip.decompress(compressed.get_data()) == plain.get_data()
+    assert len(compressed.get_data()) < len(plain.get_data())
+
+
+def test_the_best_supported_encoding_is_chosen(server, client, monkeypatch, small_min_bytes):
+    monkeypatch.setattr(server, 'RESPONSE_ENCODINGS', ['gzip'])
+
+    assert models(client, **{'Accept-Encoding': 'br;q=1.0, gzip;q=0.5'}).headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Encoding' not in models(client, **{'Accept-Encoding': 'gzip;q=0, br'}).headers
+    assert 'Content-Encoding' not in models(client, **{'Accept-Encoding': 'identity'}).headers
+
+
+def test_small_responses_and_streams_are_not_compressed(client):
+    small = client.get('/api/rate-limits', headers=dict(auth(), **{'Accept-Encoding': 'gzip'}))
+    stream = client.post(
+        '/v1/chat/completions',
+        json=completion('gpt-4o-mini', stream=True),
+        headers=dict(auth(), **{'Accept-Encoding': 'gzip'})
+    )
+    body = stream.get_data()
+    stream.close()
+
+    assert 'Content-Encoding' not in small.headers
+    assert small.get_json() == {"enabled": False}
+    assert 'Content-Encoding' not in stream.headers
+    assert body.endswith(b'data: [DONE]\n\n')
+
+
+@pytest.mark.parametrize('encoding, compress', [
+    ('gzip', gzip.compress),
+    ('deflate', zlib.compress),
+    ('deflate', lambda data: zlib.compress(data)[2:-4]),  # raw deflate, as some clients send it
+])
+def test_compressed_request_bodies_are_decoded(client, encoding, compress):
+    body = json.dumps(completion('gpt-4o-mini', 'compressed ' * 200)).encode()
+
+    response = post_encoded(client, compress(body), encoding)
+
+    assert response.status_code == 200
+    assert response.get_json()['choices'][0]['message']['content']
+
+
+@pytest.mark.parametrize('encoding, module', [('br', 'brotli'), ('zstd', 'zstandard')])
+def test_optional_codecs_decode_request_bodies(client, encoding, module):
+    codec = pytest.importorskip(module)
+    body = json.dumps(completion('gpt-4o-mini')).encode()
+
+    assert post_encoded(client, codec.compress(body), encoding).status_code == 200
+
+
+def test_unknown_encodings_are_rejected(client):
+    response = post_encoded(client, b'whatever', 'lzma')
+
+    assert response.status_code == 415
+    assert 'gzip' in response.get_json()['error']['message']
+
+
+def test_corrupt_bodies_are_rejected(client):
+    truncated = gzip.compress(json.dumps(completion('gpt-4o-mini')).encode())[:-10]
+
+    assert post_encoded(client, truncated, 'gzip').status_code == 400
+    assert post_encoded(client, b'not gzip at all', 'gzip').status_code == 400
+
+
+def test_compression_bombs_are_stopped_at_the_limit(client, decompression, monkeypatch):
+    monkeypatch.setattr(decompression, 'max_bytes', 64 * 1024)
+    bomb = gzip.compress(b' ' * (10 * 1024 * 1024))
+    assert len(bomb) < decompression.max_bytes
+
+    response = post_encoded(client, bomb, 'gzip')
+
+    assert response.status_code == 413
+    assert response.get_json()['error']['type'] == 'request_too_large'
@@ -0,0 +1,208 @@
+"""Multimodal content, tools and system prompts for Claude and Gemini (user-025)"""
+
+import json
+
+import pytest
+
+from conftest import auth, completion, upstream_calls
+
+PNG = 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk'
+WEATHER_TOOL = {"type": "function", "function": {
+    "name": "get_weather",
+    "description": "Current weather for a city",
+    "parameters": {
+        "type": "object",
+        "properties": {"city": {"type": ["string", "null"]}, "days": {"type": "integer", "minimum": 1}},
+        "required": ["city"],
+        "additionalProperties": False
+    }
+}}
+
+
+def tool_conversation():
+    return {
+        "model": "test-model",
+        "tools": [WEATHER_TOOL],
+        "messages": [
+            {"role": "system", "content": "Be brief."},
+            {"role": "user", "content": "Weather in Paris and Rome?"},
+            {"role": "assistant", "content": None, "tool_calls": [
+                {"id": "call_1", "type": "function", "function": {"name": "get_weather", "arguments": '{"city": "Paris"}'}},
+                {"id": "call_2", "type": "function", "function": {"name": "get_weather", "arguments": '{"city": "Rome"}'}},
+            ]},
+            {"role": "tool", "tool_call_id": "call_1", "content": '{"temp": 18}'},
+            {"role": "tool", "tool_call_id": "call_2", "content": 'sunny'},
+        ]
+    }
+
+
+def image_message(url, text='What is this?'):
+    return {"role": "user", "content": [
+        {"type": "text", "text": text},
+        {"type": "image_url", "image_url": {"url": url}},
+    ]}
+
+
+def test_anthropic_images_and_files(server):
+    data = {"messages": [
+        image_message(f'data:image/png;base64,{PNG}'),
+        {"role": "assistant", "content": "A pixel."},
+        {"role": "user", "content": [
+            {"type": "image_url", "image_url": {"url": 'https://example.com/cat.jpg?size=large'}},
+            {"type": "file", "file": {"filename": "report.pdf", "file_data": 'JVBERi0x'}},
+            {"type": "text", "text": ""},
+        ]},
+    ]}
+
+    messages = server.anthropic_request(data, False)['messages']
+
+    assert messages[0]['content'] == [
+        {"type": "text", "text": "What is this?"},
+        {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": PNG}},
+    ]
+    assert messages[1] == {"role": "assistant", "content": "A pixel."}
+    # Empty text blocks are dropped
+    assert messages[2]['content'] == [
+        {"type": "image", "source": {"type": "url", "url": 'https://example.com/cat.jpg?size=large'}},
+        {"type": "document", "source": {"type": "base64", "media_type": "application/pdf", "data": 'JVBERi0x'}},
+    ]
+
+
+def test_anthropic_tools_and_tool_results(server):
+    converted = server.anthropic_request(dict(tool_conversation(), tool_choice='required'), True)
+
+    assert converted['system'] == "Be brief."
+    assert converted['stream'] is True
+    assert converted['tools'] == [{
+        "name": "get_weather",
+        "description": "Current weather for a city",
+        "input_schema": WEATHER_TOOL['function']['parameters']
+    }]
+    assert converted['tool_choice'] == {"type": "any"}
+    user, assistant, results = converted['messages']
+    assert user == {"role": "user", "content": "Weather in Paris and Rome?"}
+    assert assistant['content'] == [
+        {"type": "tool_use", "id": "call_1", "name": "get_weather", "input": {"city": "Paris"}},
+        {"type": "tool_use", "id": "call_2", "name": "get_weather", "input": {"city": "Rome"}},
+    ]
+    # Parallel results arrive together in one user turn
+    assert results == {"role": "user", "content": [
+        {"type": "tool_result", "tool_use_id": "call_1", "content": '{"temp": 18}'},
+        {"type": "tool_result", "tool_use_id": "call_2", "content": 'sunny'},
+    ]}
+
+
+def test_anthropic_system_prompts_and_tool_choice(server):
+    data = completion('claude-3-5-sonnet-20241022', tools=[WEATHER_TOOL], parallel_tool_calls=False,
+                      tool_choice={"type": "function", "function": {"name": "get_weather"}})
+    data['messages'][:0] = [
+        {"role": "system", "content": "First."},
+        {"role": "developer", "content": [{"type": "text", "text": "Second."}]},
+    ]
+
+    converted = server.anthropic_request(data, False)
+
+    assert converted['system'] == [{"type": "text", "text": "First."}, {"type": "text", "text": "Second."}]
+    assert converted['tool_choice'] == {"type": "tool", "name": "get_weather", "disable_parallel_tool_use": True}
+
+
+def test_anthropic_tool_use_response(server):
+    message = server.anthropic_message([
+        {"type": "text", "text": "Checking."},
+        {"type": "tool_use", "id": "toolu_1", "name": "get_weather", "input": {"city": "Paris"}},
+    ])
+
+    assert message['content'] == "Checking."
+    assert message['tool_calls'][0]['id'] == "toolu_1"
+    assert json.loads(message['tool_calls'][0]['function']['arguments']) == {"city": "Paris"}
+    assert server.anthropic_message([{"type": "tool_use", "id": "t", "name": "f", "input": {}}])['content'] is None
+
+
+def test_gemini_images_audio_and_system(server):
+    data = {"temperature": 0.2, "messages": [
+        {"role": "system", "content": "Be brief."},
+        image_message(f'data:image/png;base64,{PNG}'),
+        {"role": "user", "content": [{"type": "input_audio", "input_audio": {"data": 'UklGRg', "format": "mp3"}}]},
+        {"role": "assistant", "content": "Noted."},
+        {"role": "user", "content": [{"type": "image_url", "image_url": {"url": 'https://example.com/cat.png'}}]},
+    ]}
+
+    converted = server.gemini_request(data)
+
+    assert converted['systemInstruction'] == {"parts": [{"text": "Be brief."}]}
+    assert converted['generationConfig'] == {"temperature": 0.2}
+    first, reply, last = converted['contents']
+    # Consecutive user messages are merged into one turn
+    assert first == {"role": "user", "parts": [
+        {"text": "What is this?"},
+        {"inlineData": {"mimeType": "image/png", "data": PNG}},
+        {"inlineData": {"mimeType": "audio/mp3", "data": 'UklGRg'}},
+    ]}
+    assert reply == {"role": "model", "parts": [{"text": "Noted."}]}
+    assert last['parts'] == [{"fileData": {"mimeType": "image/png", "fileUri": 'https://example.com/cat.png'}}]
+
+
+def test_gemini_tools_and_function_responses(server):
+    converted = server.gemini_request(tool_conversation())
+
+    declaration, = converted['tools'][0]['functionDeclarations']
+    assert declaration['name'] == "get_weather"
+    # Only the OpenAPI subset Gemini accepts is sent
+    assert declaration['parameters'] == {
+        "type": "object",
+        "properties": {"city": {"type": "string", "nullable": True}, "days": {"type": "integer", "minimum": 1}},
+        "required": ["city"]
+    }
+    assert converted['toolConfig'] == {"functionCallingConfig": {"mode": "AUTO"}}
+    _, calls, responses = converted['contents']
+    assert calls == {"role": "model", "parts": [
+        {"functionCall": {"name": "get_weather", "args": {"city": "Paris"}}},
+        {"functionCall": {"name": "get_weather", "args": {"city": "Rome"}}},
+    ]}
+    assert responses == {"role": "user", "parts": [
+        {"functionResponse": {"name": "get_weather", "response": {"temp": 18}}},
+        {"functionResponse": {"name": "get_weather", "response": {"content": "sunny"}}},
+    ]}
+
+
+@pytest.mark.parametrize('convert', ['anthropic', 'gemini'])
+@pytest.mark.parametrize('message, param', [
+    (image_message('data:image/png,notbase64'), 'messages[0].content[1]'),
+    (image_message('ftp://example.com/cat.png'), 'messages[0].content[1]'),
+    ({"role": "user", "content": [{"type": "video", "video": {}}]}, 'messages[0].content[0]'),
+    ({"role": "user", "content": [{"type": "file", "file": {"file_id": "file-1"}}]}, 'messages[0].content[0]'),
+    ({"role": "critic", "content": "Hmm."}, 'messages[0].role'),
+])
+def test_unsupported_content_is_reported_with_its_param(server, convert, message, param):
+    data = {"messages": [message]}
+    with pytest.raises(server.ConversionError) as raised:
+        if convert == 'anthropic':
+            server.anthropic_request(data, False)
+        else:
+            server.gemini_request(data)
+    assert raised.value.param == param
+
+
+def test_bad_tool_arguments_and_orphan_tool_messages(server):
+    data = tool_conversation()
+    data['messages'][2]['tool_calls'][0]['function']['arguments'] = '[1, 2]'
+    with pytest.raises(server.ConversionError, match='JSON object'):
+        server.anthropic_request(data, False)
+
+    orphan = {"messages": [{"role": "tool", "tool_call_id": "call_9", "content": "42"}]}
+    with pytest.raises(server.ConversionError) as raised:
+        server.gemini_request(orphan)
+    assert raised.value.param == 'messages[0].tool_call_id'
+
+
+@pytest.mark.parametrize('model', ['claude-3-5-sonnet-20241022', 'gemini-1.5-flash'])
+def test_unsupported_content_is_a_400(client, model, use_upstream, upstream):
+    balancer = use_upstream('anthropic' if model.startswith('claude') else 'google', upstream.url)
+    body = {"model": model, "messages": [image_message('data:image/png,notbase64')]}
+
+    response = client.post('/v1/chat/completions', json=body, headers=auth())
+
+    assert response.status_code == 400
+    error = response.get_json()['error']
+    assert (error['code'], error['param']) == ('unsupported_content', 'messages[0].content[1]')
+    assert upstream_calls(balancer) == 0
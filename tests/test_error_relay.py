@@ -0,0 +1,53 @@
+"""Upstream error bodies relayed to the client, JSON backend (user-014)"""
+
+import pytest
+
+from conftest import auth, completion, start_fake
+
+
+@pytest.fixture(scope='module')
+def rejecting_upstream():
+    fake = start_fake(latency=0, tokens=5, error_rate=1.0, error_status=400)
+    yield fake
+    fake.stop()
+
+
+@pytest.mark.parametrize('assembly', [False, True])
+@pytest.mark.parametrize('provider_id, model', [
+    ('anthropic', 'claude-3-5-sonnet-20241022'),
+    ('google', 'gemini-1.5-flash'),
+    ('openai', 'gpt-4o-mini'),
+])
+def test_upstream_errors_are_relayed(server, client, monkeypatch, use_upstream, rejecting_upstream,
+                                     assembly, provider_id, model):
+    monkeypatch.setattr(server, 'UPSTREAM_STREAM_ASSEMBLY', assembly)
+    use_upstream(provider_id, rejecting_upstream.url)
+
+    response = client.post('/v1/chat/completions', json=completion(model), headers=auth())
+
+    assert response.status_code == 400
+    body = response.get_json()
+    assert 'Injected failure' in body['error']['message']
+    assert 'choices' not in body
+
+
+def test_successful_bodies_are_relayed_as_json(client):
+    response = client.post('/v1/chat/completions', json=completion('gpt-4o-mini'), headers=auth())
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/json'
+    body = response.get_json()
+    assert body['object'] == 'chat.completion'
+    assert body['usage']['completion_tokens'] == 5
+
+
+@pytest.mark.parametrize('backend', ['orjson', 'stdlib'])
+def test_json_backends_agree(server, backend):
+    _, dumps, loads = server.load_json_backend(backend)
+    value = {"text": "caf\u00e9 \U0001f600", "n": [1, 2.5, None, True], "nested": {"b": 1, "a": 2}}
+
+    assert dumps(value, sort_keys=True) == server._stdlib_json_dumps(value, sort_keys=True)
+    assert loads(dumps(value)) == value
+    assert loads(dumps(value).decode('utf-8')) == value
+    # Keys orjson cannot encode go through the stdlib encoder
+    assert loads(dumps({1: 'one'})) == {"1": "one"}
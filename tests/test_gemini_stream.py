@@ -0,0 +1,98 @@
+"""Gemini streams translated into OpenAI chunk SSE frames (user-004)"""
+
+import json
+
+from conftest import FAKE_TOKENS, auth, completion, sse_payloads
+
+GEMINI = 'gemini-1.5-flash'
+
+
+def gemini_sse(*payloads):
+    """A streamGenerateContent (alt=sse) body for the given payloads"""
+    return b''.join(f"data: {json.dumps(payload)}\r\n\r\n".encode('utf-8') for payload in payloads)
+
+
+def candidate(*parts, finish_reason=None):
+    entry = {"content": {"parts": list(parts), "role": "model"}, "index": 0}
+    if finish_reason:
+        entry['finishReason'] = finish_reason
+    return {"candidates": [entry]}
+
+
+def test_stream_is_translated_into_chunks(client):
+    response = client.post(
+        '/v1/chat/completions',
+        json=completion(GEMINI, stream=True, stream_options={"include_usage": True}),
+        headers=auth()
+    )
+    body = response.get_data()
+    response.close()
+
+    assert response.status_code == 200
+    assert body.endswith(b'data: [DONE]\n\n')
+    chunks = sse_payloads(body)
+    assert chunks[0]['choices'][0]['delta'] == {"role": "assistant", "content": ""}
+    text = ''.join(chunk['choices'][0]['delta'].get('content', '') for chunk in chunks[1:-1])
+    assert text == 'tok ' * FAKE_TOKENS
+    assert chunks[-2]['choices'][0]['finish_reason'] == 'stop'
+    assert chunks[-1]['usage'] == {
+        "prompt_tokens": 10, "completion_tokens": FAKE_TOKENS, "total_tokens": 10 + FAKE_TOKENS
+    }
+
+
+def test_function_calls_become_tool_call_deltas(server):
+    body = gemini_sse(
+        candidate({"text": "Checking."}),
+        candidate(
+            {"functionCall": {"name": "get_weather", "args": {"city": "Paris"}}},
+            {"functionCall": {"name": "get_time", "args": {}}},
+            finish_reason='STOP'
+        ),
+    )
+    events = list(server.gemini_completion_events([body], GEMINI))
+
+    assert events[0][0] == 'start'
+    assert ('content', 'Checking.') in events
+    tool_calls = [value for kind, value in events if kind == 'tool_call']
+    assert [call['index'] for call in tool_calls] == [0, 1]
+    assert tool_calls[0]['type'] == 'function'
+    assert tool_calls[0]['id']
+    assert tool_calls[0]['function']['name'] == 'get_weather'
+    assert json.loads(tool_calls[0]['function']['arguments']) == {"city": "Paris"}
+    assert json.loads(tool_calls[1]['function']['arguments']) == {}
+    # STOP after a function call is reported the way OpenAI does
+    assert ('finish', 'tool_calls') in events
+
+
+def test_finish_reasons_are_mapped(server):
+    body = gemini_sse(candidate({"text": "cut"}, finish_reason='MAX_TOKENS'))
+    events = list(server.gemini_completion_events([body], GEMINI))
+    assert ('finish', 'length') in events
+
+
+def test_usage_is_estimated_without_usage_metadata(server):
+    body = gemini_sse(
+        candidate({"text": "Hello there, "}),
+        candidate({"text": "how are you today?"}, finish_reason='STOP'),
+    )
+    events = list(server.gemini_completion_events([body], GEMINI, prompt_tokens=7))
+
+    kind, usage = events[-1]
+    assert kind == 'usage'
+    assert usage['prompt_tokens'] == 7
+    assert usage['completion_tokens'] > 0
+    assert usage['total_tokens'] == 7 + usage['completion_tokens']
+
+
+def test_error_payload_ends_the_stream(server):
+    body = gemini_sse(
+        candidate({"text": "partial"}),
+        {"error": {"code": 500, "message": "Internal error", "status": "INTERNAL"}},
+        candidate({"text": "never sent"}),
+    )
+    frames = list(server.translate_gemini_stream([body], GEMINI))
+    payloads = sse_payloads(b''.join(frames))
+
+    assert frames[-1] == b'data: [DONE]\n\n'
+    assert payloads[-1]['error']['message'] == 'Internal error'
+    assert all('never sent' not in json.dumps(payload) for payload in payloads)
@@ -0,0 +1,115 @@
+"""Automatic Anthropic prompt-caching breakpoints (user-018)"""
+
+import copy
+import hashlib
+
+import pytest
+
+CLAUDE = 'claude-3-5-sonnet-20241022'
+SYSTEM = 'You are a careful assistant. ' * 20
+CACHED = {"type": "ephemeral"}
+
+
+@pytest.fixture
+def cache(server):
+    return server.AnthropicPromptCache(server.PrefixSketch(), min_hits=2, min_tokens=50)
+
+
+def conversation(*turns, system=SYSTEM, model=CLAUDE):
+    roles = ('user', 'assistant')
+    data = {"model": model, "max_tokens": 100, "messages": [
+        {"role": roles[i % 2], "content": text} for i, text in enumerate(turns)
+    ]}
+    if system:
+        data['system'] = system
+    return data
+
+
+def marked(content):
+    """Whether content carries a breakpoint on its last block"""
+    return isinstance(content, list) and content[-1].get('cache_control') == CACHED
+
+
+def breakpoints(data):
+    marks = ['system'] if marked(data.get('system')) else []
+    return marks + [index for index, message in enumerate(data['messages']) if marked(message['content'])]
+
+
+def test_prefixes_are_marked_once_they_recur(cache):
+    turns = ('Here is a long document. ' * 20, 'Understood.', 'Summarize it.')
+    first, second = conversation(*turns), conversation(*turns)
+
+    assert cache.apply(first) == 0
+    assert breakpoints(first) == []
+
+    assert cache.apply(second) == 3
+    # The system prompt, the first hot message boundary and the last one
+    assert breakpoints(second) == ['system', 0, 2]
+    assert second['system'] == [{"type": "text", "text": SYSTEM, "cache_control": CACHED}]
+    assert second['messages'][2]['content'] == [{"type": "text", "text": 'Summarize it.', "cache_control": CACHED}]
+
+
+def test_only_the_shared_prefix_is_marked(cache):
+    history = ('Here is a long document. ' * 20, 'Understood.')
+    cache.apply(conversation(*history, 'What is the title?'))
+
+    data = conversation(*history, 'Who wrote it?')
+    assert cache.apply(data) == 3
+    assert breakpoints(data) == ['system', 0, 1]
+
+
+def test_short_prefixes_are_not_marked(cache):
+    for _ in range(3):
+        data = conversation('Hi', system='Be brief.')
+        assert cache.apply(data) == 0
+
+
+def test_haiku_needs_twice_the_tokens(server):
+    cache = server.AnthropicPromptCache(server.PrefixSketch(), min_hits=2, min_tokens=100)
+    system = 'x' * 400
+    for model, expected in ((CLAUDE, ['system', 0]), ('claude-3-haiku-20240307', [])):
+        cache.apply(conversation('Hello', system=system, model=model))
+        data = conversation('Hello', system=system, model=model)
+        cache.apply(data)
+        assert breakpoints(data) == expected
+
+
+def test_the_callers_messages_are_not_mutated(cache):
+    blocks = [{"type": "text", "text": 'Shared context. ' * 40}]
+    original = conversation(blocks, 'Ok.')
+    cache.apply(copy.deepcopy(original))
+
+    data = conversation(blocks, 'Ok.')
+    messages = list(data['messages'])
+    cache.apply(data)
+
+    assert marked(data['messages'][0]['content'])
+    assert messages[0]['content'] is blocks
+    assert blocks == [{"type": "text", "text": 'Shared context. ' * 40}]
+    assert 'cache_control' not in messages[0]['content'][-1]
+
+
+def test_image_data_is_part_of_the_prefix(cache):
+    def with_image(data):
+        image = {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": data}}
+        return conversation([image, {"type": "text", "text": 'Describe this. ' * 30}])
+
+    cache.apply(with_image('AAAA'))
+    different = with_image('BBBB')
+    same = with_image('AAAA')
+
+    assert cache.apply(different) == 1
+    assert breakpoints(different) == ['system']
+    assert cache.apply(same) == 2
+    assert breakpoints(same) == ['system', 0]
+
+
+def test_sketch_counts_and_decays(server):
+    sketch = server.PrefixSketch(width=64, depth=4, decay_every=4)
+    digest = hashlib.blake2b(b'prefix', digest_size=16).digest()
+    other = hashlib.blake2b(b'other', digest_size=16).digest()
+
+    assert [sketch.add(digest) for _ in range(3)] == [1, 2, 3]
+    # The fourth addition halves every counter
+    sketch.add(other)
+    assert sketch.add(digest) == 2
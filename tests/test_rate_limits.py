@@ -0,0 +1,120 @@
+"""Per-key rate limits and concurrent stream quotas (user-015)"""
+
+import pytest
+
+from conftest import FAKE_TOKENS, KEY, OTHER_KEY, auth, completion
+
+
+@pytest.fixture
+def limit(server, monkeypatch):
+    """limit(rpm, tpm, max_streams, **per_key) installs a fresh in-memory rate limiter"""
+    def install(rpm=0, tpm=0, max_streams=0, **key_limits):
+        limiter = server.RateLimiter(
+            server.MemoryRateLimitStore(),
+            server.RateLimits(rpm, tpm, max_streams),
+            {key: server.RateLimits(*limits) for key, limits in key_limits.items()}
+        )
+        monkeypatch.setattr(server, 'rate_limiter', limiter)
+        return limiter
+    return install
+
+
+def post(client, body, api_key=KEY):
+    return client.post('/v1/chat/completions', json=body, headers=auth(api_key))
+
+
+def remaining(client, api_key=KEY):
+    return client.get('/api/rate-limits', headers=auth(api_key)).get_json()['remaining']
+
+
+def test_requests_over_the_rpm_limit_get_a_429(client, limit):
+    limit(rpm=2)
+
+    statuses = [post(client, completion('gpt-4o-mini')).status_code for _ in range(2)]
+    refused = post(client, completion('gpt-4o-mini'))
+
+    assert statuses == [200, 200]
+    assert refused.status_code == 429
+    assert int(refused.headers['Retry-After']) >= 1
+    error = refused.get_json()['error']
+    assert (error['code'], error['type']) == ('rate_limit_exceeded', 'requests')
+    # Every key has its own bucket
+    assert post(client, completion('gpt-4o-mini'), OTHER_KEY).status_code == 200
+
+
+def test_per_key_limits_override_the_defaults(client, limit):
+    limit(rpm=1, **{OTHER_KEY: (3, 0, 0)})
+
+    assert post(client, completion('gpt-4o-mini')).status_code == 200
+    assert post(client, completion('gpt-4o-mini')).status_code == 429
+    assert [post(client, completion('gpt-4o-mini'), OTHER_KEY).status_code for _ in range(3)] == [200] * 3
+    assert client.get('/api/rate-limits', headers=auth(OTHER_KEY)).get_json()['limits']['rpm'] == 3
+
+
+def test_usage_is_charged_to_the_token_budget(client, limit):
+    limit(tpm=1000)
+
+    post(client, completion('gpt-4o-mini'))
+
+    # The fake upstream reports 10 prompt and FAKE_TOKENS completion tokens
+    spent = 1000 - remaining(client)['tokens']
+    assert 10 + FAKE_TOKENS - 1 <= spent <= 10 + FAKE_TOKENS
+
+
+def test_keys_in_token_debt_are_refused(client, limit):
+    limiter = limit(tpm=600)
+    limiter.charge_tokens(KEY, 1200)
+
+    refused = post(client, completion('gpt-4o-mini'))
+
+    assert refused.status_code == 429
+    assert refused.get_json()['error']['type'] == 'tokens'
+    # 600 tokens of debt refill at 10 tokens/s
+    assert 55 <= int(refused.headers['Retry-After']) <= 61
+    assert remaining(client)['tokens'] < 0
+
+
+def test_open_streams_count_against_the_stream_quota(client, limit):
+    limit(max_streams=1)
+    body = completion('gpt-4o-mini', stream=True)
+
+    first = post(client, body)
+    assert first.status_code == 200
+    assert remaining(client)['streams'] == 0
+
+    refused = post(client, body)
+    assert refused.status_code == 429
+    assert 'concurrent streams' in refused.get_json()['error']['message']
+    # Non-streaming requests and other keys are not affected
+    assert post(client, completion('gpt-4o-mini')).status_code == 200
+    other = post(client, body, OTHER_KEY)
+    other.close()
+    assert other.status_code == 200
+
+    first.get_data()
+    first.close()
+    assert remaining(client)['streams'] == 1
+    second = post(client, body)
+    assert second.status_code == 200
+    second.close()
+
+
+def test_sqlite_store_is_shared_between_instances(server, tmp_path):
+    path = str(tmp_path / 'limits.db')
+    first, second = server.SQLiteRateLimitStore(path), server.SQLiteRateLimitStore(path)
+
+    assert first.take('rpm:k', 2, 2 / 60.0, 1, 1000.0) == 0
+    assert second.take('rpm:k', 2, 2 / 60.0, 1, 1000.0) == 0
+    assert first.take('rpm:k', 2, 2 / 60.0, 1, 1000.0) == pytest.approx(30)
+
+    second.charge('tpm:k', 100, 1.0, 150, 1000.0)
+    assert first.peek('tpm:k', 100, 1.0, 1010.0) == pytest.approx(-40)
+
+    assert first.open_stream('s', 1)
+    assert not second.open_stream('s', 1)
+    first.close_stream('s')
+    assert second.open_stream('s', 1)
+
+
+def test_limits_are_off_by_default(client):
+    assert client.get('/api/rate-limits', headers=auth()).get_json() == {"enabled": False}
@@ -0,0 +1,147 @@
+"""Upstream retries, hedged requests and fallback models (user-009)"""
+
+import time
+
+import pytest
+
+from conftest import auth, completion, start_fake, upstream_calls
+
+CLAUDE = 'claude-3-5-sonnet-20241022'
+
+
+@pytest.fixture(scope='module')
+def failing_upstream():
+    fake = start_fake(latency=0, tokens=5, error_rate=1.0, error_status=503)
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture(scope='module')
+def slow_upstream():
+    fake = start_fake(latency=0.5, tokens=5)
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def fallbacks(server, monkeypatch):
+    """fallbacks(mapping) installs a routing table with the given fallback chains"""
+    def install(mapping):
+        table = server.RoutingTable(server.PROVIDERS, server.AVAILABLE_MODELS, fallbacks=mapping)
+        monkeypatch.setattr(server, '_routing_table', table)
+    return install
+
+
+def post(client, body):
+    response = client.post('/v1/chat/completions', json=body, headers=auth())
+    response.get_data()
+    response.close()
+    return response
+
+
+def test_retry_delay_uses_jittered_backoff_and_short_retry_after(server, monkeypatch):
+    monkeypatch.setattr(server, 'UPSTREAM_RETRY_BACKOFF', 0.5)
+    monkeypatch.setattr(server, 'UPSTREAM_RETRY_BACKOFF_MAX', 8)
+
+    assert all(0 <= server.retry_delay(0) <= 0.5 for _ in range(50))
+    assert all(0 <= server.retry_delay(2) <= 2 for _ in range(50))
+    assert all(0 <= server.retry_delay(10) <= 8 for _ in range(50))
+    assert server.retry_delay(0, '3') == 3
+    # A Retry-After beyond the backoff cap (or unparseable) falls back to the backoff
+    assert server.retry_delay(0, '60') <= 0.5
+    assert server.retry_delay(0, 'Wed, 21 Oct 2015 07:28:00 GMT') <= 0.5
+
+
+def test_retryable_statuses_are_retried(client, server, monkeypatch, use_upstream, failing_upstream):
+    monkeypatch.setattr(server, 'UPSTREAM_MAX_RETRIES', 2)
+    balancer = use_upstream('openai', failing_upstream.url, cooldown=0)
+
+    response = post(client, completion('gpt-4o-mini'))
+
+    assert response.status_code == 503
+    assert upstream_calls(balancer) == 3
+
+
+def test_retries_move_to_a_healthy_target(client, server, monkeypatch, use_upstream, upstream, failing_upstream):
+    monkeypatch.setattr(server, 'UPSTREAM_MAX_RETRIES', 1)
+    balancer = use_upstream('openai', failing_upstream.url, upstream.url)
+
+    plain = post(client, completion('gpt-4o-mini'))
+    streamed = post(client, completion('gpt-4o-mini', stream=True))
+
+    assert (plain.status_code, streamed.status_code) == (200, 200)
+    assert [target.requests for target in balancer.targets] == [1, 2]
+
+
+def test_client_errors_are_not_retried(client, server, monkeypatch, use_upstream):
+    monkeypatch.setattr(server, 'UPSTREAM_MAX_RETRIES', 2)
+    bad_request = start_fake(latency=0, error_rate=1.0, error_status=400)
+    try:
+        balancer = use_upstream('openai', bad_request.url)
+        response = post(client, completion('gpt-4o-mini'))
+    finally:
+        bad_request.stop()
+
+    assert response.status_code == 400
+    assert upstream_calls(balancer) == 1
+
+
+def test_slow_requests_are_hedged(client, server, monkeypatch, use_upstream, upstream, slow_upstream):
+    monkeypatch.setattr(server, 'UPSTREAM_HEDGING', True)
+    monkeypatch.setattr(server, 'UPSTREAM_HEDGE_MIN_DELAY', 0.05)
+    monkeypatch.setattr(server, '_upstream_latency', {})
+    balancer = use_upstream('openai', slow_upstream.url, upstream.url)
+
+    started = time.monotonic()
+    response = post(client, completion('gpt-4o-mini'))
+    elapsed = time.monotonic() - started
+
+    assert response.status_code == 200
+    assert upstream_calls(balancer) == 2
+    # The hedge to the fast endpoint answered; the slow primary was not waited for
+    assert elapsed < slow_upstream.latency
+
+
+def test_fast_requests_are_not_hedged(client, server, monkeypatch, use_upstream, upstream):
+    monkeypatch.setattr(server, 'UPSTREAM_HEDGING', True)
+    monkeypatch.setattr(server, 'UPSTREAM_HEDGE_MIN_DELAY', 0.5)
+    balancer = use_upstream('openai', upstream.url)
+
+    assert post(client, completion('gpt-4o-mini')).status_code == 200
+    assert upstream_calls(balancer) == 1
+
+
+def test_failed_requests_fall_back_to_another_model(client, fallbacks, use_upstream, upstream, failing_upstream):
+    fallbacks({"gpt-4o-mini": [CLAUDE]})
+    primary = use_upstream('openai', failing_upstream.url)
+    fallback = use_upstream('anthropic', upstream.url)
+
+    response = post(client, completion('gpt-4o-mini'))
+
+    assert response.status_code == 200
+    assert response.headers['X-Fallback-Model'] == CLAUDE
+    assert response.get_json()['choices'][0]['message']['content']
+    assert (upstream_calls(primary), upstream_calls(fallback)) == (1, 1)
+
+
+def test_provider_fallbacks_and_successes_stay_put(client, fallbacks, use_upstream, upstream):
+    fallbacks({"openai": [CLAUDE]})
+    use_upstream('openai', upstream.url)
+    fallback = use_upstream('anthropic', upstream.url)
+
+    response = post(client, completion('gpt-4o-mini'))
+
+    assert response.status_code == 200
+    assert 'X-Fallback-Model' not in response.headers
+    assert upstream_calls(fallback) == 0
+
+
+def test_streams_do_not_fall_back(client, fallbacks, use_upstream, upstream, failing_upstream):
+    fallbacks({"gpt-4o-mini": [CLAUDE]})
+    use_upstream('openai', failing_upstream.url)
+    fallback = use_upstream('anthropic', upstream.url)
+
+    response = post(client, completion('gpt-4o-mini', stream=True))
+
+    assert response.status_code == 503
+    assert upstream_calls(fallback) == 0
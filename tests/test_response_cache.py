@@ -0,0 +1,108 @@
+"""Response cache: MISS/HIT replay of deterministic completions (user-005)"""
+
+import pytest
+
+from conftest import OTHER_KEY, auth, completion, upstream_calls
+
+
+@pytest.fixture
+def cache(server, monkeypatch):
+    cache = server.ResponseCache(60, 100, 10 ** 6)
+    monkeypatch.setattr(server, 'response_cache', cache)
+    return cache
+
+
+@pytest.fixture
+def balancer(use_upstream, upstream):
+    return use_upstream('openai', upstream.url)
+
+
+def post(client, body, **headers):
+    response = client.post('/v1/chat/completions', json=body, headers=dict(auth(), **headers))
+    data = response.get_data()
+    response.close()
+    return response, data
+
+
+def test_deterministic_completion_is_served_from_the_cache(client, cache, balancer):
+    body = completion('gpt-4o-mini', 'cache me', temperature=0)
+
+    first, first_body = post(client, body)
+    second, second_body = post(client, body)
+
+    assert first.headers['X-Cache'] == 'MISS'
+    assert second.headers['X-Cache'] == 'HIT'
+    assert second_body == first_body
+    assert second.mimetype == 'application/json'
+    assert upstream_calls(balancer) == 1
+    assert cache.stats()['hits'] == 1
+
+
+def test_streamed_completion_is_replayed_identically(client, cache, balancer):
+    body = completion('gpt-4o-mini', 'stream me', temperature=0, stream=True)
+
+    first, first_body = post(client, body)
+    second, second_body = post(client, body)
+
+    assert first.headers['X-Cache'] == 'MISS'
+    assert second.headers['X-Cache'] == 'HIT'
+    assert second.mimetype == 'text/event-stream'
+    assert second_body == first_body
+    assert second_body.endswith(b'data: [DONE]\n\n')
+    assert upstream_calls(balancer) == 1
+
+
+def test_field_order_and_user_do_not_change_the_key(client, cache, balancer):
+    post(client, {"temperature": 0, "messages": [{"role": "user", "content": "order"}], "model": "gpt-4o-mini"})
+    response, _ = post(client, completion('gpt-4o-mini', 'order', temperature=0, user='someone'))
+
+    assert response.headers['X-Cache'] == 'HIT'
+    assert upstream_calls(balancer) == 1
+
+
+def test_entries_are_not_shared_between_api_keys(client, cache, balancer):
+    body = completion('gpt-4o-mini', 'mine', temperature=0)
+
+    post(client, body)
+    response = client.post('/v1/chat/completions', json=body, headers=auth(OTHER_KEY))
+
+    assert response.headers['X-Cache'] == 'MISS'
+    assert upstream_calls(balancer) == 2
+
+
+def test_non_deterministic_and_no_cache_requests_bypass_the_cache(client, cache, balancer):
+    post(client, completion('gpt-4o-mini', 'warm', temperature=0))
+
+    sampled, _ = post(client, completion('gpt-4o-mini', 'warm', temperature=0.7))
+    bypassed, _ = post(client, completion('gpt-4o-mini', 'warm', temperature=0), **{'Cache-Control': 'no-cache'})
+
+    assert 'X-Cache' not in sampled.headers
+    assert 'X-Cache' not in bypassed.headers
+    assert upstream_calls(balancer) == 3
+
+
+def test_upstream_errors_are_not_cached(client, cache, use_upstream, upstream, monkeypatch):
+    balancer = use_upstream('openai', upstream.url)
+    monkeypatch.setattr(upstream, 'error_rate', 1.0)
+    body = completion('gpt-4o-mini', 'fails', temperature=0)
+
+    first, _ = post(client, body)
+    second, _ = post(client, body)
+
+    assert first.status_code >= 400
+    assert second.headers.get('X-Cache') != 'HIT'
+    assert upstream_calls(balancer) == 2
+    assert cache.stats()['entries'] == 0
+
+
+def test_disk_tier_survives_a_new_cache(server, client, monkeypatch, balancer, tmp_path):
+    monkeypatch.setattr(server, 'response_cache', server.ResponseCache(60, 100, 10 ** 6, str(tmp_path)))
+    body = completion('gpt-4o-mini', 'persist', temperature=0)
+    _, first_body = post(client, body)
+
+    monkeypatch.setattr(server, 'response_cache', server.ResponseCache(60, 100, 10 ** 6, str(tmp_path)))
+    response, second_body = post(client, body)
+
+    assert response.headers['X-Cache'] == 'HIT'
+    assert second_body == first_body
+    assert upstream_calls(balancer) == 1
@@ -0,0 +1,113 @@
+"""Model routing table, routes file aliases and hot reload (user-007)"""
+
+import json
+import logging
+import os
+
+import pytest
+
+from conftest import auth, completion, upstream_calls
+
+
+@pytest.fixture
+def routes_file(server, tmp_path):
+    """
+    A routes file the server checks on every request; write(config, mtime)
+    replaces it. The built-in table is restored afterwards.
+    """
+    path = tmp_path / 'routes.json'
+    saved = server.MODEL_ROUTES_FILE, server.MODEL_ROUTES_RELOAD_INTERVAL, server._routes_failed_mtime
+
+    def write(config, mtime):
+        path.write_text(config if isinstance(config, str) else json.dumps(config), encoding='utf-8')
+        os.utime(path, (mtime, mtime))
+
+    write({}, 1000)
+    server.MODEL_ROUTES_FILE, server.MODEL_ROUTES_RELOAD_INTERVAL, server._routes_failed_mtime = str(path), 0, None
+    server.reload_routing_table()
+    try:
+        yield write
+    finally:
+        server.MODEL_ROUTES_FILE, server.MODEL_ROUTES_RELOAD_INTERVAL, server._routes_failed_mtime = saved
+        server.reload_routing_table()
+
+
+def model_ids(client):
+    return {model['id'] for model in client.get('/v1/models', headers=auth()).get_json()['data']}
+
+
+def test_models_resolve_by_exact_id_and_longest_prefix(server):
+    table = server.RoutingTable(server.PROVIDERS, [], {'openai': ['gpt-4o-'], 'xai': ['gpt-4o-x']})
+
+    provider, upstream_model = table.resolve('gpt-4o-mini')
+    assert (provider.id, upstream_model) == ('openai', 'gpt-4o-mini')
+    assert table.resolve('gpt-4o-xl')[0].id == 'xai'
+    assert table.resolve('claude-3-haiku-20240307')[0].id == 'anthropic'
+    assert table.resolve('gemini-1.5-pro')[0].id == 'google'
+    assert table.resolve('llama-3') is None
+
+
+def test_aliases_and_listed_models_take_precedence(server):
+    models = [{"id": "house-model", "provider": "anthropic"}]
+    table = server.RoutingTable(server.PROVIDERS, models, aliases={"fast": "gpt-4o-mini", "house": "house-model"})
+
+    provider, upstream_model = table.resolve('fast')
+    assert (provider.id, upstream_model) == ('openai', 'gpt-4o-mini')
+    assert table.resolve('house')[0].id == 'anthropic'
+    assert table.get_model('house')['id'] == 'house-model'
+
+
+def test_unknown_models_are_rejected(client):
+    response = client.post('/v1/chat/completions', json=completion('llama-3'), headers=auth())
+
+    assert response.status_code == 400
+    assert response.get_json()['error']['code'] == 'model_not_supported'
+
+
+def test_routes_file_adds_models_and_aliases(client, routes_file, use_upstream, upstream):
+    routes_file({
+        "providers": {"anthropic": {"models": ["house-claude"]}},
+        "aliases": {"sonnet": "claude-3-5-sonnet-20241022"}
+    }, 2000)
+    balancer = use_upstream('anthropic', upstream.url)
+
+    assert 'house-claude' in model_ids(client)
+    assert client.get('/v1/models/house-claude', headers=auth()).get_json()['owned_by'] == 'anthropic'
+    response = client.post('/v1/chat/completions', json=completion('sonnet'), headers=auth())
+    assert response.status_code == 200
+    assert response.get_json()['choices'][0]['message']['content']
+    assert upstream_calls(balancer) == 1
+
+
+def test_routes_file_changes_are_picked_up(client, routes_file):
+    routes_file({"providers": {"openai": {"models": ["house-gpt"]}}}, 2000)
+    assert 'house-gpt' in model_ids(client)
+
+    routes_file({"providers": {"openai": {"models": ["house-gpt-2"]}}}, 3000)
+    ids = model_ids(client)
+    assert 'house-gpt-2' in ids
+    assert 'house-gpt' not in ids
+
+
+def test_broken_routes_file_keeps_the_table_and_warns_once(client, routes_file, caplog):
+    routes_file({"providers": {"openai": {"models": ["house-gpt"]}}}, 2000)
+    assert 'house-gpt' in model_ids(client)
+
+    routes_file('{"providers": ', 3000)
+    with caplog.at_level(logging.WARNING):
+        assert 'house-gpt' in model_ids(client)
+        assert 'house-gpt' in model_ids(client)
+    warnings = [record for record in caplog.records if 'Failed to reload' in record.getMessage()]
+    assert len(warnings) == 1
+
+    routes_file({"providers": {"openai": {"models": ["house-gpt-fixed"]}}}, 4000)
+    assert 'house-gpt-fixed' in model_ids(client)
+
+
+def test_reload_endpoint_reports_a_broken_file(client, routes_file):
+    routes_file('not json', 2000)
+
+    response = client.post('/api/routes/reload', headers=auth())
+
+    assert response.status_code == 500
+    assert response.get_json()['error']['code'] == 'routes_reload_failed'
@@ -0,0 +1,64 @@
+"""Non-streaming Claude/Gemini completions assembled from upstream streams (user-024)"""
+
+import json
+
+import pytest
+
+from conftest import FAKE_TOKENS, auth, completion
+
+
+def comparable(body):
+    """A completion without the fields that differ between two calls"""
+    return {key: value for key, value in body.items() if key not in ('id', 'created')}
+
+
+@pytest.mark.parametrize('model', ['claude-3-5-sonnet-20241022', 'gemini-1.5-flash'])
+def test_assembled_completion_matches_the_buffered_one(server, client, monkeypatch, model):
+    monkeypatch.setattr(server, 'UPSTREAM_STREAM_ASSEMBLY', False)
+    buffered = client.post('/v1/chat/completions', json=completion(model), headers=auth())
+    monkeypatch.setattr(server, 'UPSTREAM_STREAM_ASSEMBLY', True)
+    assembled = client.post('/v1/chat/completions', json=completion(model), headers=auth())
+
+    assert (buffered.status_code, assembled.status_code) == (200, 200)
+    assert comparable(assembled.get_json()) == comparable(buffered.get_json())
+    assert assembled.get_json()['choices'][0]['message']['content'] == 'tok ' * FAKE_TOKENS
+
+
+def test_tool_calls_are_assembled(server):
+    events = [
+        ('start', 'chatcmpl-1'),
+        ('content', 'Checking '),
+        ('content', 'café.'),
+        ('tool_call', {"index": 0, "id": "toolu_1", "type": "function",
+                       "function": {"name": "get_weather", "arguments": ""}}),
+        ('tool_call', {"index": 0, "function": {"arguments": '{"city": '}}),
+        ('tool_call', {"index": 0, "function": {"arguments": '"Paris"}'}}),
+        ('finish', 'tool_calls'),
+        ('usage', {"prompt_tokens": 3, "completion_tokens": 4, "total_tokens": 7}),
+    ]
+
+    result, error = server.assemble_completion(iter(events), 'claude-3-5-sonnet-20241022')
+
+    assert error is None
+    assert result['id'] == 'chatcmpl-1'
+    choice = result['choices'][0]
+    assert choice['finish_reason'] == 'tool_calls'
+    assert choice['message']['content'] == 'Checking café.'
+    call, = choice['message']['tool_calls']
+    assert (call['id'], call['function']['name']) == ('toolu_1', 'get_weather')
+    assert json.loads(call['function']['arguments']) == {"city": "Paris"}
+    assert result['usage']['total_tokens'] == 7
+
+
+def test_output_before_a_failure_is_kept(server):
+    error = {"message": "connection reset", "code": "upstream_stream_interrupted"}
+
+    partial, partial_error = server.assemble_completion(
+        iter([('start', 'chatcmpl-2'), ('content', 'Hel'), ('error', error)]), 'gemini-1.5-flash'
+    )
+    empty, empty_error = server.assemble_completion(iter([('error', error)]), 'gemini-1.5-flash')
+
+    assert partial['choices'][0]['message']['content'] == 'Hel'
+    assert partial['choices'][0]['finish_reason'] is None
+    assert partial_error == error
+    assert (empty, empty_error) == (None, error)
@@ -0,0 +1,103 @@
+"""Local prompt token counts and the context window precheck (user-017)"""
+
+import pytest
+
+from conftest import auth, completion, upstream_calls
+
+
+@pytest.fixture
+def estimator(server, monkeypatch):
+    """A fresh estimator that always estimates (as without tiktoken), uncalibrated"""
+    estimator = server.TokenEstimator()
+    estimator.tiktoken_checked = True
+    monkeypatch.setattr(server, 'token_estimator', estimator)
+    return estimator
+
+
+@pytest.fixture
+def balancer(use_upstream, upstream):
+    return use_upstream('openai', upstream.url)
+
+
+@pytest.fixture
+def house_model(server, monkeypatch):
+    """An OpenAI model with a 100-token context window from the routes file"""
+    models = [{"id": "house-gpt", "provider": "openai", "context_window": 100}]
+    monkeypatch.setattr(server, '_routing_table', server.RoutingTable(server.PROVIDERS, models))
+
+
+def post(client, body):
+    return client.post('/v1/chat/completions', json=body, headers=auth())
+
+
+def test_prompt_over_the_context_window_is_rejected_locally(client, estimator, balancer):
+    response = post(client, completion('gpt-4', 'word ' * 40000))
+
+    assert response.status_code == 400
+    error = response.get_json()['error']
+    assert (error['code'], error['param']) == ('context_length_exceeded', 'messages')
+    assert '8192 tokens' in error['message']
+    assert upstream_calls(balancer) == 0
+
+
+def test_max_tokens_count_against_the_window(client, estimator, balancer):
+    assert post(client, completion('gpt-4', max_tokens=9000)).status_code == 400
+    assert post(client, completion('gpt-4', max_completion_tokens=9000)).status_code == 400
+    assert post(client, completion('gpt-4', max_tokens=1000)).status_code == 200
+    assert upstream_calls(balancer) == 1
+
+
+def test_estimates_get_the_tolerance(client, estimator, balancer, house_model):
+    # 'abcd' * n is estimated at 3 (reply) + 3 (message) + n + 1 tokens
+    within_tolerance = post(client, completion('house-gpt', 'abcd' * 98))
+    over_tolerance = post(client, completion('house-gpt', 'abcd' * 110))
+
+    assert within_tolerance.status_code == 200
+    assert over_tolerance.status_code == 400
+    assert 'maximum context length is 100 tokens' in over_tolerance.get_json()['error']['message']
+
+
+def test_precheck_can_be_switched_off(client, server, monkeypatch, estimator, balancer):
+    monkeypatch.setattr(server, 'TOKEN_PRECHECK', False)
+
+    assert post(client, completion('gpt-4', 'word ' * 40000)).status_code == 200
+    assert upstream_calls(balancer) == 1
+
+
+def test_context_windows_come_from_the_longest_prefix(server, estimator):
+    table = server.RoutingTable(server.PROVIDERS, [])
+
+    assert table.context_window('gpt-4-32k-0613') == 32768
+    assert table.context_window('gpt-4-0613') == 8192
+    assert table.context_window('claude-3-haiku-20240307') == 200000
+    assert table.context_window('house-model') is None
+
+
+def test_messages_are_counted_per_part(server, estimator):
+    messages = [
+        {"role": "system", "content": "abcd" * 10},
+        {"role": "user", "name": "ann", "content": [
+            {"type": "text", "text": "abcd" * 5},
+            {"type": "image_url", "image_url": {"url": "https://example.com/cat.png"}},
+        ]},
+    ]
+
+    tokens, exact = estimator.count_messages(messages, 'openai', 'gpt-4o')
+
+    assert exact is False
+    # reply, 2 messages, the two texts, the image, and the name plus its extra token
+    assert tokens == 3 + 2 * 3 + 11 + 6 + estimator.TOKENS_PER_IMAGE + 1 + 1
+
+
+def test_estimates_are_calibrated_against_reported_usage(server, estimator):
+    estimator.calibrate('anthropic', 1000, 2000)
+    assert estimator.calibration['anthropic'] == pytest.approx(1.1)
+
+    # Small prompts are dominated by overhead and do not calibrate
+    estimator.calibrate('google', 100, 1000)
+    assert 'google' not in estimator.calibration
+
+    before, _ = estimator.count_messages([{"role": "user", "content": "abcd" * 1000}], 'openai')
+    estimator.calibration['openai'] = 2.0
+    after, _ = estimator.count_messages([{"role": "user", "content": "abcd" * 1000}], 'openai')
+    assert after == before * 2
@@ -0,0 +1,27 @@
+"""Keep-alive upstream sessions and /api/upstream/pools (user-001)"""
+
+from conftest import auth, completion
+
+
+def pool_stats(client, provider_id):
+    pools = client.get('/api/upstream/pools', headers=auth()).get_json()['data']
+    return next((pool for pool in pools if pool['provider'] == provider_id), None)
+
+
+def test_sequential_requests_reuse_one_connection(client):
+    client.post('/v1/chat/completions', json=completion('gpt-4o-mini', 'warm up'), headers=auth())
+    before = pool_stats(client, 'openai')
+
+    for i in range(5):
+        response = client.post('/v1/chat/completions', json=completion('gpt-4o-mini', f'ping {i}'), headers=auth())
+        assert response.status_code == 200
+        assert response.get_json()['choices'][0]['message']['content']
+
+    after = pool_stats(client, 'openai')
+    assert after['new_connections'] == before['new_connections']
+    assert after['reused_connections'] - before['reused_connections'] >= 5
+    assert after['keep_alive'] is True
+
+
+def test_pool_stats_require_the_api_key(client):
+    assert client.get('/api/upstream/pools').status_code == 401